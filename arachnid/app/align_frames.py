@@ -89,6 +89,14 @@ Tunable Options
     
     Gap between pairs for L1/L2 alignment
 
+.. option:: --single-precision <BOOL>
+    
+    Transform the frames in single precision, which halves the memory required
+
+.. option:: --scratch-dir <FILENAME>
+    
+    Directory for a memory-mapped scratch file holding the Fourier transformed frames, empty means keep them in memory
+
 Diagnostic Options
 ==================
 
@@ -150,12 +158,18 @@ from ..core.util import plotting
 import scipy.fftpack
 import scipy.ndimage
 import numpy
+import multiprocessing.pool
+import collections
 import logging
+import tempfile
 import os
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 
+_shift_frequency_cache = collections.OrderedDict()
+_shift_frequency_cache_size = 16
+
 def process(filename, benchmark=False, **extra):
     '''Concatenate files and write to a single output file
         
@@ -187,9 +201,48 @@ def process(filename, benchmark=False, **extra):
         write_coordinates(coords, **extra)
     return filename, coords
 
-def fft_in_memory(filename, gain_file="", bin_factor=1.0, **extra):
+def fft_in_memory(filename, scratch_dir="", **extra):
     ''' Precalculate the FFT of each frame in the movie stack.
     
+    The Fourier transformed frames are spilled to a memory-mapped scratch file 
+    as they are transformed, a window of frames at a time (see :py:func:`iter_fft`), 
+    so only the pages currently in use need to be resident. The scratch file is
+    created in the system temporary directory unless a scratch directory is given.
+    
+    :Parameters:
+    
+        filename : str
+                   Filename for movie stack
+        scratch_dir : str
+                      Directory for the memory-mapped scratch file, empty means the
+                      system temporary directory
+        extra : dict
+                Unused keyword arguments
+    
+    :Returns:
+    
+        fourier_frames : array
+                         Memory-mapped stack of Fourier transforms of each frame
+    
+    .. codeauthor:: Robert Langlois <rl2528@columbia.edu>
+    .. codeauthor:: Ryan Hyde Smith <rhs2132@columbia.edu>
+    '''
+    
+    _logger.info("Caching FFT in scratch file")
+    fourier_frames = None
+    for i, frame in enumerate(iter_fft(filename, **extra)):
+        if fourier_frames is None:
+            fourier_frames = scratch_stack(scratch_dir if scratch_dir != "" else None, (ndimage_file.count_images(filename), )+frame.shape, frame.dtype)
+        fourier_frames[i] = frame
+    return fourier_frames
+
+def iter_fft(filename, gain_file="", bin_factor=1.0, single_precision=False, thread_count=1, **extra):
+    ''' Iterate over the FFT of each frame in the movie stack
+    
+    The frames are read and transformed a window of `thread_count` frames at a 
+    time, so only the current window is held in memory. With more than one 
+    thread, the frames of a window are transformed by a pool of threads.
+    
     :Parameters:
     
         filename : str
@@ -198,31 +251,94 @@ def fft_in_memory(filename, gain_file="", bin_factor=1.0, **extra):
                     Filename for gain normalization image
         bin_factor : float
                      Factor to downsample frame images
+        single_precision : bool
+                           Transform the frames in single precision
+        thread_count : int
+                       Number of threads used to transform the frames
         extra : dict
                 Unused keyword arguments
     
     :Returns:
     
-        fourier_frames : list
-                         List of Fourier transforms of each frame
+        frame : array
+                Fourier transform of the next frame
+    '''
+    
+    dtype = numpy.float32 if single_precision else numpy.float
+    gain = ndimage_file.read_image(gain_file).astype(dtype) if gain_file != "" else None
+    thread_count = max(1, thread_count)
+    pool = multiprocessing.pool.ThreadPool(thread_count) if thread_count > 1 else None
+    transform = lambda frame: fft_frame(frame, gain, dtype, bin_factor, **extra)
+    transform_all = pool.map if pool is not None else map
+    try:
+        frames = []
+        for frame in ndimage_file.iter_images(filename):
+            frames.append(frame)
+            if len(frames) < thread_count: continue
+            for fframe in transform_all(transform, frames): yield fframe
+            frames = []
+        for fframe in transform_all(transform, frames): yield fframe
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def fft_frame(frame, gain, dtype, bin_factor=1.0, **extra):
+    ''' Normalize the window of a single frame and calculate its FFT
     
-    .. codeauthor:: Robert Langlois <rl2528@columbia.edu>
-    .. codeauthor:: Ryan Hyde Smith <rhs2132@columbia.edu>
+    :Parameters:
+    
+        frame : array
+                Movie frame
+        gain : array
+               Gain normalization image, None if no gain normalization
+        dtype : dtype
+                Floating point type used for the frame
+        bin_factor : float
+                     Factor to downsample frame images
+        extra : dict
+                Unused keyword arguments
+    
+    :Returns:
+    
+        frame : array
+                Fourier transform of the frame
     '''
     
-    gain = ndimage_file.read_image(gain_file) if gain_file != "" else None
-    fourier_frames = []
-    _logger.info("Caching FFT in memory")
-    for frame in ndimage_file.iter_images(filename):
-        frame = frame.astype(numpy.float)
-        if gain is not None: numpy.multiply(frame, gain, frame)
-        x, y, w, h = get_window(frame, **extra)
-        frame = frame[y:y+h, x:x+w].copy()
-        enhance_image.normalize_standard(frame, var_one=True, out=frame)
-        frame = scipy.fftpack.fft2(frame)
-        if bin_factor > 1.0: frame = ndimage_interpolate.resample_fft_fast(frame, bin_factor, True)
-        fourier_frames.append(frame)
-    return fourier_frames
+    frame = frame.astype(dtype)
+    if gain is not None: numpy.multiply(frame, gain, frame)
+    x, y, w, h = get_window(frame, **extra)
+    frame = frame[y:y+h, x:x+w].copy()
+    enhance_image.normalize_standard(frame, var_one=True, out=frame)
+    frame = scipy.fftpack.fft2(frame, overwrite_x=True)
+    if bin_factor > 1.0: frame = ndimage_interpolate.resample_fft_fast(frame, bin_factor, True)
+    return frame
+
+def scratch_stack(scratch_dir, shape, dtype):
+    ''' Create a stack backed by a memory-mapped scratch file
+    
+    The scratch file is removed as soon as it is created, its space is
+    released when the stack is no longer referenced.
+    
+    :Parameters:
+    
+        scratch_dir : str
+                      Directory for the scratch file, None for the system 
+                      temporary directory
+        shape : tuple
+                Shape of the stack
+        dtype : dtype
+                Data type of the stack
+    
+    :Returns:
+    
+        stack : array
+                Memory-mapped stack
+    '''
+    
+    fd = tempfile.TemporaryFile(prefix='align_frames_', dir=scratch_dir)
+    try: return numpy.memmap(fd, dtype=dtype, mode='w+', shape=shape)
+    finally: fd.close()
 
 def align_in_memory(filename, mode=0, **extra):
     ''' Align frames from a movie stack in memory
@@ -232,6 +348,10 @@ def align_in_memory(filename, mode=0, **extra):
         #. Sequential
         #. L2
     
+    Sequential alignment streams the frames through a window (see :py:func:`iter_fft`),
+    so memory is a small multiple of a single frame. L2 alignment compares every pair
+    of frames, which are spilled to a scratch file (see :py:func:`fft_in_memory`).
+    
     :Parameters:
     
         filename : str
@@ -251,15 +371,17 @@ def align_in_memory(filename, mode=0, **extra):
     .. codeauthor:: Ryan Hyde Smith <rhs2132@columbia.edu>
     '''
     
-    fourier_frames = fft_in_memory(filename, **extra)
     if mode == 0:
         _logger.info("Sequential alignment")
-        trans = align_sequential(fourier_frames, **extra)
+        trans, avg = stream_sequential(iter_fft(filename, **extra), **extra)
+        _logger.info("Alignment finished")
+        write_perdiogram(scipy.fftpack.ifft2(avg).real, 0, **extra)
     else:
+        fourier_frames = fft_in_memory(filename, **extra)
         _logger.info("L2 alignment")
         trans = align_l2(fourier_frames, **extra)
-    _logger.info("Alignment finished")
-    write_perdiogram(fourier_frames, 0, trans, **extra)
+        _logger.info("Alignment finished")
+        write_perdiogram(fourier_frames, 0, trans, **extra)
     trans *= extra['bin_factor']
     return trans
 
@@ -289,40 +411,38 @@ def benchmark_in_memory(filename, **extra):
     '''
     
     fourier_frames = fft_in_memory(filename, **extra)
-    avg = average_fft(fourier_frames)
+    avg = average_fft(fourier_frames, **extra)
     write_perdiogram(avg, 0, **extra)
     _logger.info("Begin sequential")
     trans = align_sequential(fourier_frames, **extra)
-    avg = average_fft(fourier_frames, trans)
+    avg = average_fft(fourier_frames, trans, **extra)
     pow1 = write_perdiogram(avg, 1, **extra)
     _logger.info("Begin l2")
     trans = align_l2(fourier_frames, **extra)
-    avg = average_fft(fourier_frames, trans)
+    avg = average_fft(fourier_frames, trans, **extra)
     pow2=write_perdiogram(avg, 2, **extra)
     _logger.info("Begin mean displacement")
     trans = align_mean_displacement(fourier_frames, **extra)
-    avg = average_fft(fourier_frames, trans)
+    avg = average_fft(fourier_frames, trans, **extra)
     pow4=write_perdiogram(avg, 4, **extra)
     write_powerspectra_1D((pow1, pow2, pow4), ('Sequential', 'L2', 'Mean'), **extra)
     #trans *= extra['bin_factor']
     return []
 
-def align_mean_displacement(fourier_frames, upsampling=2, search_radius=50, lowpass_sigma=None, **extra):
+def align_mean_displacement(fourier_frames, upsampling=2, search_radius=50, lowpass_sigma=None, thread_count=1, **extra):
     '''
     '''
     
     filter_kernel=None
     if lowpass_sigma is not None:
         filter_kernel = scipy.fftpack.ifftshift(ndimage_filter.gaussian_lowpass_kernel(fourier_frames[0].shape, lowpass_sigma, numpy.float))
-    else: filter_kernel=1.0
     
     index = numpy.triu_indices(len(fourier_frames), 1)
     cache = numpy.zeros((len(fourier_frames), len(fourier_frames), 3))
     
-    for i, j in zip(*index):
-        y, x, p = alignment.xcorr_dft_peak(fourier_frames[i]*filter_kernel, fourier_frames[j], upsampling, search_radius)
-        cache[i, j] = (x,y,p)
-        cache[j, i] = (-x,-y,p)
+    peaks = alignment.xcorr_dft_peak_batch(fourier_frames, fourier_frames, numpy.column_stack(index), upsampling, search_radius, filter_kernel, thread_count)
+    cache[index[0], index[1]] = peaks[:, (1, 0, 2)]
+    cache[index[1], index[0]] = peaks[:, (1, 0, 2)]*(-1, -1, 1)
     
     trans = numpy.zeros((len(fourier_frames), 2))
     idx = numpy.arange(1, len(fourier_frames), dtype=numpy.int)
@@ -341,20 +461,53 @@ def align_sequential(fourier_frames, upsampling=2, search_radius=50, lowpass_sig
     @author: Robert Langlois
     '''
     
+    return stream_sequential(fourier_frames, upsampling, search_radius, lowpass_sigma)[0]
+
+def stream_sequential(fourier_frames, upsampling=2, search_radius=50, lowpass_sigma=None, **extra):
+    ''' Align each frame to the sum of the frames aligned before it
+    
+    Each frame is used once, in order, so the frames may come from an iterator
+    such as :py:func:`iter_fft`. The sum of the shifted frames is accumulated
+    as the frames are aligned.
+    
+    :Parameters:
+    
+        fourier_frames : iterable
+                         Fourier transform of each frame
+        upsampling : int
+                     Upsampling factor for the peak search
+        search_radius : int
+                        Maximum search radius
+        lowpass_sigma : float, optional
+                        Width of the Gaussian lowpass filter applied to the reference
+        extra : dict
+                Unused keyword arguments
+    
+    :Returns:
+    
+        trans : array
+                Translation of each frame
+        avg : array
+              Fourier transform of the sum of the shifted frames
+    '''
+    
+    fourier_frames = iter(fourier_frames)
+    ref = next(fourier_frames).copy()
+    avg = ref.copy()
     filter_kernel=None
-    trans = numpy.zeros((len(fourier_frames), 2))
-    ref = fourier_frames[0].copy()
     if lowpass_sigma is not None:
         filter_kernel = scipy.fftpack.ifftshift(ndimage_filter.gaussian_lowpass_kernel(ref.shape, lowpass_sigma, numpy.float))
-    for i, frame in enumerate(fourier_frames[1:]):
+    trans = [(0.0, 0.0)]
+    for frame in fourier_frames:
         if filter_kernel is not None: numpy.multiply(ref, filter_kernel, ref)
         y, x, p1 = alignment.xcorr_dft_peak(ref, frame, upsampling, search_radius)
-        trans[i+1, :]=(x,y)
-        #print i+1, trans[i+1, :], trans[i+1, :]-trans[i, :], p1
-        ref += scipy.ndimage.fourier_shift(frame, (-trans[i+1, 1], -trans[i+1, 0]), -1, 0)
-    return trans
+        trans.append((x, y))
+        shifted = scipy.ndimage.fourier_shift(frame, (-y, -x), -1, 0)
+        ref += shifted
+        avg += shifted
+    return numpy.asarray(trans, dtype=numpy.float), avg
 
-def align_l2(fourier_frames, upsampling=2, search_radius=50, lowpass_sigma=None, gap=5, **extra):
+def align_l2(fourier_frames, upsampling=2, search_radius=50, lowpass_sigma=None, gap=5, thread_count=1, **extra):
     '''
     .. codeauthor:: Robert Langlois <rl2528@columbia.edu>
     .. codeauthor:: Ryan Hyde Smith <rhs2132@columbia.edu>
@@ -363,7 +516,6 @@ def align_l2(fourier_frames, upsampling=2, search_radius=50, lowpass_sigma=None,
     filter_kernel=None
     if lowpass_sigma is not None:
         filter_kernel = scipy.fftpack.ifftshift(ndimage_filter.gaussian_lowpass_kernel(fourier_frames[0].shape, lowpass_sigma, numpy.float))
-    else: filter_kernel=1.0
     
     pairs = []
     for i in xrange(len(fourier_frames)-1):
@@ -373,9 +525,7 @@ def align_l2(fourier_frames, upsampling=2, search_radius=50, lowpass_sigma=None,
     A = numpy.zeros((len(pairs), len(fourier_frames)-1))
     for i, p in enumerate(pairs):
         A[i, p[0]:p[1]] = 1
-    b = numpy.zeros((len(pairs), 2))
-    for i, p in enumerate(pairs):
-        b[i, 1], b[i, 0] = alignment.xcorr_dft_peak(fourier_frames[p[0]]*filter_kernel, fourier_frames[p[1]], upsampling, search_radius)[:2]
+    b = alignment.xcorr_dft_peak_batch(fourier_frames, fourier_frames, pairs, upsampling, search_radius, filter_kernel, thread_count)[:, 1::-1]
     x0 = numpy.linalg.lstsq(A, b)[0]
     trans = numpy.zeros((len(fourier_frames), 2))
     trans[1:] = x0.cumsum(axis=0)
@@ -388,17 +538,128 @@ def align_l2(fourier_frames, upsampling=2, search_radius=50, lowpass_sigma=None,
     '''
     return trans
 
-def average_fft(fourier_frames, trans=None, do_ifft=True):
+def average_fft(fourier_frames, trans=None, do_ifft=True, thread_count=1, **extra):
+    ''' Sum the Fourier transformed frames after shifting each frame
+    
+    The rows of the frames are split into `thread_count` bands and each thread
+    sums every frame over its own band of a single accumulator. Each shift is
+    applied with phase ramps built from the frequencies cached for the frame shape.
+    
+    :Parameters:
+    
+        fourier_frames : list or array
+                         Fourier transform of each frame
+        trans : array, optional
+                Translation of each frame
+        do_ifft : bool
+                  Return the inverse Fourier transform of the sum
+        thread_count : int
+                       Number of threads used to sum the frames
+        extra : dict
+                Unused keyword arguments
+    
+    :Returns:
+    
+        avg : array
+              Sum of the frames
+    '''
+    
+    avg = numpy.zeros(fourier_frames[0].shape, dtype=fourier_frames[0].dtype)
+    thread_count = max(1, min(thread_count, avg.shape[0]))
+    bands = numpy.linspace(0, avg.shape[0], thread_count+1).astype(numpy.int)
+    fy, fx = _shift_frequencies(avg.shape)
+    def accumulate(index):
+        rows = slice(bands[index], bands[index+1])
+        band = avg[rows]
+        shifted = numpy.empty_like(band) if trans is not None else None
+        for i in xrange(len(fourier_frames)):
+            if trans is None:
+                band += fourier_frames[i][rows]
+            else:
+                ramp = _phase_ramp(fy[rows], fx, -trans[i, 1], -trans[i, 0], band.dtype)
+                band += numpy.multiply(fourier_frames[i][rows], ramp, shifted)
+    if thread_count > 1:
+        pool = multiprocessing.pool.ThreadPool(thread_count)
+        try: pool.map(accumulate, xrange(thread_count))
+        finally:
+            pool.close()
+            pool.join()
+    else: accumulate(0)
+    return scipy.fftpack.ifft2(avg).real if do_ifft else avg
+
+def fourier_shift(frame, dy, dx, out=None):
+    ''' Shift a Fourier transformed frame with separable phase ramps
+    
+    This gives the same result as `scipy.ndimage.fourier_shift(frame, (dy, dx), -1, 0)`.
+    
+    :Parameters:
+    
+        frame : array
+                Fourier transform of a frame
+        dy : float
+             Shift along the y-axis
+        dx : float
+             Shift along the x-axis
+        out : array, optional
+              Output array
+    
+    :Returns:
+    
+        out : array
+              Fourier transform of the shifted frame
+    '''
+    
+    fy, fx = _shift_frequencies(frame.shape)
+    return numpy.multiply(frame, _phase_ramp(fy, fx, dy, dx, frame.dtype), out)
+
+def _phase_ramp(fy, fx, dy, dx, dtype):
+    ''' Build the separable phase ramp of a shift
+    
+    :Parameters:
+    
+        fy : array
+             Phase of a unit shift along the y-axis for each row
+        fx : array
+             Phase of a unit shift along the x-axis for each column
+        dy : float
+             Shift along the y-axis
+        dx : float
+             Shift along the x-axis
+        dtype : dtype
+                Data type of the ramp
+    
+    :Returns:
+    
+        ramp : array
+               Phase ramp
     '''
+    
+    return numpy.multiply.outer(numpy.exp(fy*dy), numpy.exp(fx*dx)).astype(dtype)
+
+def _shift_frequencies(shape):
+    ''' Get the phase ramp frequencies for a frame shape
+    
+    :Parameters:
+    
+        shape : tuple
+                Shape of the Fourier transformed frame
+    
+    :Returns:
+    
+        fy : array
+             Phase of a unit shift along the y-axis
+        fx : array
+             Phase of a unit shift along the x-axis
     '''
     
-    avg = numpy.zeros_like(fourier_frames[0])
-    for i, frame in enumerate(fourier_frames):
-        if trans is None:
-            avg += frame
-        else:
-            avg += scipy.ndimage.fourier_shift(frame, (-trans[i, 1], -trans[i, 0]), -1, 0)
-    return scipy.fftpack.ifft2(avg).real if do_ifft else avg
+    shape = tuple(shape)
+    try:
+        freq = _shift_frequency_cache.pop(shape)
+    except KeyError:
+        freq = (-2j*numpy.pi*numpy.fft.fftfreq(shape[0]), -2j*numpy.pi*numpy.fft.fftfreq(shape[1]))
+        if len(_shift_frequency_cache) >= _shift_frequency_cache_size: _shift_frequency_cache.popitem(last=False)
+    _shift_frequency_cache[shape] = freq
+    return freq
 
 def write_average_with_path(avg, trans, waypoint_file="", **extra):
     '''
@@ -417,13 +678,7 @@ def powerspectra(fourier_frames, trans=None, window_size=256, pad=1, overlap=0.5
     '''
     '''
     
-    avg = numpy.zeros_like(fourier_frames[0])
-    for i, frame in enumerate(fourier_frames):
-        if trans is not None:
-            avg += scipy.ndimage.fourier_shift(frame, (-trans[i, 1], -trans[i, 0]), -1, 0)
-        else:
-            avg += frame
-    avg = scipy.fftpack.ifft2(avg).real
+    avg = average_fft(fourier_frames, trans, **extra)
     avg = scipy.fftpack.fft2(avg)
     avg = scipy.fftpack.fftshift(avg).real
     return ndimage_interpolate.downsample(numpy.ascontiguousarray(avg), (window_size, window_size))
@@ -472,8 +727,8 @@ def write_perdiogram(avg, index=0, trans=None, diagnostic_file="", **extra):
     '''
     
     if diagnostic_file == "": return
-    if isinstance(avg, list) and trans is not None:
-        avg = average_fft(avg, trans)
+    if trans is not None:
+        avg = average_fft(avg, trans, **extra)
     pow = perdiogram(avg, **extra)
     write_pow(pow, index, diagnostic_file, **extra)
     return pow
@@ -596,6 +851,10 @@ def initialize(files, param):
     if param['waypoint_file']!="":
         try:os.makedirs(os.path.dirname(param['waypoint_file']))
         except: pass
+    if param['scratch_dir']!="" and param['mode'] != 0:
+        _logger.info("Spilling Fourier transformed frames to scratch: %s"%param['scratch_dir'])
+        try:os.makedirs(param['scratch_dir'])
+        except: pass
     
     if 'selection_file' in param and param['selection_file'] != "":
         if os.path.exists(param['selection_file']):
@@ -665,6 +924,8 @@ def setup_options(parser, pgroup=None, main_option=False):
     group.add_option("", gap=5,             help="Gap between pairs for L1/L2 alignment")
     group.add_option("", mode=("Sequential", "L2"), help="Alignment mode", default=1)
     group.add_option("", crop=[0, 0, -1, -1], help="Window size for the alignment")
+    group.add_option("", single_precision=False, help="Transform the frames in single precision, which halves the memory required")
+    group.add_option("", scratch_dir="",     help="Directory for a memory-mapped scratch file holding the Fourier transformed frames for L2 alignment, empty means the system temporary directory", gui=dict(filetype="save"))
     
     dgroup = OptionGroup(parser, "Diagnostic", "Options to control diagnostic output",  id=__name__)
     dgroup.add_option("", benchmark=False,   help="Run every alignment algorithm on the same set of micrographs for benchmarking")
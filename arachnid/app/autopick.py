@@ -138,7 +138,7 @@ This is not a complete list of options available to this script, for additional
 .. Created on Dec 21, 2011
 .. codeauthor:: Robert Langlois <rl2528@columbia.edu>
 '''
-from ..core.app import program
+from ..core.app import program, file_processor
 from ..util import bench
 from ..core.image import ndimage_utility, ndimage_filter
 from ..core.learn import dimensionality_reduction
@@ -149,6 +149,7 @@ from ..core.util import drawing
 from ..core.image import ndimage_file
 #import numpy # pylint: disable=W0611
 import numpy.linalg
+import scipy.fftpack
 import scipy.spatial
 import scipy.stats
 import lfcpick
@@ -158,6 +159,10 @@ import os
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 
+prefetch, release_prefetch = file_processor.prefetch_images, file_processor.release_images
+
+_template_spectrum_cache = {}
+
 def process(filename, disk_mult_range, id_len=0, **extra):
     '''Concatenate files and write to a single output file
         
@@ -212,10 +217,10 @@ def process(filename, disk_mult_range, id_len=0, **extra):
         
     coords = format_utility.create_namedtuple_list(peaks, "Coord", "id,peak,x,y",numpy.arange(1, len(peaks)+1, dtype=numpy.int)) if peaks.shape[0] > 0 else []
     write_example(mic, coords, filename, **extra)
-    format.write(extra['output'], coords, default_format=format.spiderdoc)
+    format.write(extra['output'], numpy.hstack((numpy.arange(1, len(peaks)+1)[:, numpy.newaxis], peaks)), header="id,peak,x,y".split(','), default_format=format.spiderdoc)
     return filename, peaks
 
-def search(img, disable_prune=False, limit_template=0, limit=0, experimental=False, **extra):
+def search(img, disable_prune=False, limit_template=0, limit=0, experimental=False, peaks=None, **extra):
     ''' Search a micrograph for particles using a template
     
     Args:
@@ -224,6 +229,9 @@ def search(img, disable_prune=False, limit_template=0, limit=0, experimental=Fal
               Micrograph image
         disable_prune : bool
                         Disable the removal of bad particles
+        peaks : array, optional
+                Peaks from template matching, if None match the template 
+                created from the options
         extra : dict
                 Unused key word arguments
     
@@ -233,8 +241,9 @@ def search(img, disable_prune=False, limit_template=0, limit=0, experimental=Fal
                 List of peaks: height and coordinates
     '''
     
-    template = lfcpick.create_template(**extra)
-    peaks = template_match(img, template, **extra)
+    if peaks is None:
+        template = lfcpick.create_template(**extra)
+        peaks = template_match(img, template, **extra)
     peaks=cull_boundary(peaks, img.shape, **extra)
     if len(peaks.squeeze())==0: return []
     index = numpy.argsort(peaks[:,0])[::-1]
@@ -262,6 +271,10 @@ def search(img, disable_prune=False, limit_template=0, limit=0, experimental=Fal
 def search_range(img, disk_mult_range, **extra):
     ''' Search a micrograph for particles using a template
     
+    The correlation maps for every template size come from a single transform
+    of the micrograph, see :py:func:`template_match_range`. The peaks of each 
+    size are still found and classified separately, then merged.
+    
     Args:
         
         img : array
@@ -281,10 +294,10 @@ def search_range(img, disk_mult_range, **extra):
     coords_last = None
     disk_mult_range = numpy.asarray(disk_mult_range)
     #max_mult = disk_mult_range.max()
-    for disk_mult in disk_mult_range:
+    for disk_mult, peaks in zip(disk_mult_range, template_match_range(img, disk_mult_range, **extra)):
         try:
             #coords = search(img, mask_mult=float(disk_mult)/max_mult, **extra)[::-1]
-            coords = search(img, **extra)[::-1]
+            coords = search(img, peaks=peaks, **extra)[::-1]
         except:
             _logger.error("Error for disk_mult=%f"%(disk_mult))
             raise
@@ -322,6 +335,86 @@ def template_match(img, template_image, pixel_diameter, **extra):
     if peaks.ndim == 1: peaks = numpy.asarray(peaks).reshape((len(peaks)/3, 3))
     return peaks
 
+def template_match_range(img, disk_mult_range, pixel_diameter, **extra):
+    ''' Find peaks in the micrograph for each template in a range of sizes
+    
+    The filtered micrograph is transformed once and correlated with the 
+    Fourier transform of each template, which is cached across micrographs 
+    by :py:func:`template_spectrum`. This gives the same peaks as calling 
+    :py:func:`template_match` for each template.
+    
+    Args:
+        
+        img : array
+              Micrograph
+        disk_mult_range : list
+                          List of disk multipliers
+        pixel_diameter : int
+                         Diameter of particle in pixels
+        extra : dict
+                Unused key word arguments
+          
+    Returns:
+        
+        peaks : iterator
+                List of peaks including peak size, x-coordinate, y-coordinate
+                for each disk multiplier
+    '''
+    
+    _logger.debug("Filter micrograph")
+    img = ndimage_filter.gaussian_highpass(img, 0.25/(pixel_diameter/2.0), 2)
+    fimg = scipy.fftpack.fft2(img)
+    extra.pop('disk_mult', None)
+    for disk_mult in disk_mult_range:
+        _logger.debug("Template-matching - %f"%disk_mult)
+        cc_map = scipy.fftpack.ifft2(fimg*template_spectrum(img.shape, img.dtype, disk_mult=disk_mult, pixel_diameter=pixel_diameter, **extra)).real.astype(img.dtype)
+        cc_map = scipy.fftpack.fftshift(cc_map)
+        _logger.debug("Find peaks")
+        peaks = lfcpick.search_peaks(cc_map, pixel_diameter, **extra)
+        if peaks.ndim == 1: peaks = numpy.asarray(peaks).reshape((len(peaks)/3, 3))
+        yield peaks
+
+def template_spectrum(shape, dtype, template="", disk_mult=1.0, bin_factor=1.0, disable_bin=False, ds_kernel=None, window=None, pixel_diameter=None, **extra):
+    ''' Get the conjugate Fourier transform of a template padded to the size of the micrograph
+    
+    The transform is cached for each micrograph shape and set of template parameters.
+    
+    Args:
+        
+        shape : tuple
+                Shape of the micrograph
+        dtype : dtype
+                Data type of the micrograph
+        template : str
+                   Filename of the template, if empty use a soft disk
+        disk_mult : float
+                    Mulitplier to control size of soft disk template
+        bin_factor : float
+                     Image downsampling factor
+        disable_bin : bool
+                      If true, do not downsample the template
+        ds_kernel : array
+                    Precomputed kernel for downsampling the template
+        window : int
+                 Size of the window in pixels
+        pixel_diameter : int
+                         Diameter of particle in pixels
+        extra : dict
+                Unused key word arguments
+          
+    Returns:
+        
+        spectrum : array
+                   Conjugate Fourier transform of the padded template
+    '''
+    
+    kernel = numpy.asarray(ds_kernel).tostring() if ds_kernel is not None else None
+    key = (tuple(shape), numpy.dtype(dtype).str, template, disk_mult if template == "" else None, bin_factor, disable_bin, kernel, window, pixel_diameter)
+    if key not in _template_spectrum_cache:
+        img = lfcpick.create_template(template, disk_mult, bin_factor, disable_bin, ds_kernel, window, pixel_diameter).astype(dtype)
+        _template_spectrum_cache[key] = scipy.fftpack.fft2(ndimage_utility.pad_image(img, shape)).conj()
+    return _template_spectrum_cache[key]
+
 def merge_coords(coords1, coords2, pixel_diameter, **extra):
     '''
     '''
@@ -428,29 +521,29 @@ def classify_windows(mic, scoords, dust_sigma=4.0, xray_sigma=4.0, disable_thres
     masksm = dgmask
     maskap = ndimage_utility.model_disk(1, win_shape)*-1+1
     vfeat = numpy.zeros((len(scoords)))
-    data = numpy.zeros((len(scoords), numpy.sum(masksm>0.5)))
     
     mask = ndimage_utility.model_disk(int(radius*1.2+1), (window, window)) * (ndimage_utility.model_disk(int(radius*0.9), win_shape)*-1+1)
-    datar=None
     
-    imgs=[]
     _logger.debug("Windowing %d particles"%len(scoords))
-    for i, win in enumerate(ndimage_utility.for_each_window(mic, scoords, window, 1.0)):
-        if (i%10)==0: _logger.debug("Windowing particle: %d"%i)
-        #win=ndimage_filter.ramp(win)
-        imgs.append(win.copy())
-        
-        ndimage_utility.replace_outlier(win, dust_sigma, xray_sigma, None, win)
-        ar = ndimage_utility.compress_image(ndimage_utility.normalize_standard(win, mask, False), mask)
-        
-        if datar is None: datar=numpy.zeros((len(scoords), ar.shape[0])) 
-        datar[i, :] = ar
-        if vfeat is not None:
-            vfeat[i] = numpy.sum(ndimage_utility.segment(ndimage_utility.dog(win, radius), 1024)*dgmask)
-        amp=ndimage_utility.fftamp(win)*maskap
-        ndimage_utility.vst(amp, amp)
-        ndimage_utility.normalize_standard(amp, masksm, out=amp)
-        ndimage_utility.compress_image(amp, masksm, data[i])
+    wins = ndimage_utility.crop_window_batch(mic, scoords, window, 1.0)
+    ndimage_utility.replace_outlier_batch(wins, dust_sigma, xray_sigma, wins)
+    
+    datar = ndimage_utility.compress_image_batch(wins, mask)
+    datar -= datar.mean(axis=1)[:, numpy.newaxis]
+    
+    if vfeat is not None:
+        dog = ndimage_utility.dog_batch(wins, radius)
+        th = unary_classification.otsu_batch(dog, 1024)
+        vfeat[:] = numpy.sum((dog > th[:, numpy.newaxis, numpy.newaxis])*dgmask, axis=(1, 2))
+    
+    amp = numpy.fft.fftshift(numpy.fft.fftn(wins, axes=(1, 2)), axes=(1, 2))
+    amp = numpy.abs(amp*amp.conjugate())*maskap
+    ndimage_utility.vst(amp, amp)
+    data = ndimage_utility.compress_image_batch(amp, masksm)
+    data -= data.mean(axis=1)[:, numpy.newaxis]
+    std = data.std(axis=1)
+    std[std == 0] = 1.0
+    data /= std[:, numpy.newaxis]
     
     _logger.debug("Performing PCA")
     feat, idx = dimensionality_reduction.pca(data, data, 1)[:2]
@@ -15,7 +15,7 @@ values using the 2D CTF model.
 .. codeauthor:: Robert Langlois <rl2528@columbia.edu>
 ''' 
 
-from ..core.app import program
+from ..core.app import program, file_processor
 from ..core.image import ndimage_file
 from ..core.image import ndimage_utility
 from ..core.image import ndimage_interpolate
@@ -37,6 +37,10 @@ import os
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 
+prefetch, release_prefetch = file_processor.prefetch_images, file_processor.release_images
+
+_model_table_cache = {}
+
 def process(filename, id_len=0, use_8bit=False, **extra):#, neig=1, nstd=1.5
     '''Concatenate files and write to a single output file
         
@@ -371,8 +375,7 @@ def esimate_defocus_range(powspec, awindow_size=64, overlap=0.9, **extra):
     roo = subtract_background(ppow.mean(axis=0), window)
     beg = first_zero(roo)
     end = energy_cutoff(roo[beg:])+beg
-    for i in xrange(len(raw)):
-        defocus[i] = estimate_1D(subtract_background(raw[i], window), beg, end, **extra)
+    defocus[:] = estimate_1D_batch(numpy.asarray([subtract_background(r, window) for r in raw]), beg, end, **extra)
     
     min_defocus = defocus.min()
     max_defocus = defocus.max()
@@ -579,13 +582,93 @@ def estimate_1D(roo, beg, end, ampcont, cs, voltage, apix, bfactor=0.0, defocus_
                   Defocus of image
     '''
     
-    best=(1e20, None)
-    for p in numpy.arange(defocus_start, defocus_end, 0.1, dtype=numpy.float):
-        err = numpy.sum(numpy.square(model_fit_error_1d(p*1e4, roo, beg, end, ampcont, cs, voltage, apix, bfactor)))
-        if err < best[0]: best = (err, p*1e4)
-    p0=[best[1]]
-    dz1, = scipy.optimize.leastsq(model_fit_error_1d,p0,args=(roo, beg, end, ampcont, cs, voltage, apix, bfactor))[0]
-    return dz1
+    return estimate_1D_batch(roo[numpy.newaxis], beg, end, ampcont, cs, voltage, apix, bfactor, defocus_start, defocus_end)[0]
+
+def estimate_1D_batch(roos, beg, end, ampcont, cs, voltage, apix, bfactor=0.0, defocus_start=0.1, defocus_end=8.0, **extra):
+    ''' Find the defocus for each background-subtracted 1D power spectra
+    
+    The coarse search over the defocus range is evaluated for every 1D power spectra 
+    at once using a table of models that is cached across micrographs. Each defocus is 
+    then refined with a least-squares fit.
+    
+    :Parameters:
+        
+        roos : array
+               1D, background-subtracted power spectra (one per row)
+        beg : int
+              Starting ring
+        end : int
+              Last ring
+        ampcont : float
+                  Amplitude contrast in percent
+        cs : float
+             Spherical abberation in mm
+        voltage : float
+                  Electron energy in kV
+        apix : float
+               Pixel size
+        bfactor : float
+                  Fall off in angstroms^2
+        defocus_start : float
+                        Start of the defocus search range in microns
+        defocus_end : float
+                      End of the defocus search range in microns
+        extra : dict
+                Unused keyword arguments
+    
+    :Returns:
+        
+        defocus : array
+                  Defocus of each 1D power spectra
+    '''
+    
+    defocus, models = model_table(roos.shape[1], ampcont, cs, voltage, apix, bfactor, defocus_start, defocus_end)
+    err = numpy.sum(numpy.square(models[numpy.newaxis, :, beg:end]-roos[:, numpy.newaxis, beg:end]), axis=2)
+    guess = defocus[numpy.argmin(err, axis=1)]
+    out = numpy.zeros(len(roos))
+    for i in xrange(len(roos)):
+        out[i], = scipy.optimize.leastsq(model_fit_error_1d,[guess[i]],args=(roos[i], beg, end, ampcont, cs, voltage, apix, bfactor))[0]
+    return out
+
+def model_table(n, ampcont, cs, voltage, apix, bfactor=0.0, defocus_start=0.1, defocus_end=8.0):
+    ''' Get the squared 1D CTF model for each defocus in the coarse search range
+    
+    The table is cached, so it is computed once for all micrographs with the
+    same size and microscope parameters.
+    
+    :Parameters:
+        
+        n : int
+            Size of the 1D power spectra
+        ampcont : float
+                  Amplitude contrast in percent
+        cs : float
+             Spherical abberation in mm
+        voltage : float
+                  Electron energy in kV
+        apix : float
+               Pixel size
+        bfactor : float
+                  Fall off in angstroms^2
+        defocus_start : float
+                        Start of the defocus search range in microns
+        defocus_end : float
+                      End of the defocus search range in microns
+    
+    :Returns:
+        
+        defocus : array
+                  Defocus in angstroms for each model
+        models : array
+                 Squared 1D CTF model for each defocus (one per row)
+    '''
+    
+    key = (n, ampcont, cs, voltage, apix, bfactor, defocus_start, defocus_end)
+    if key not in _model_table_cache:
+        defocus = numpy.arange(defocus_start, defocus_end, 0.1, dtype=numpy.float)*1e4
+        models = numpy.asarray([ctf_model.transfer_function_1D(n, p, ampcont, cs, voltage, apix, bfactor)**2 for p in defocus])
+        _model_table_cache[key] = (defocus, models)
+    return _model_table_cache[key]
     
 def generate_powerspectra(filename, bin_factor, window_size, overlap, pad=1, offset=0, from_power=False, **extra):
     ''' Generate a power spectra using a perdiogram
@@ -707,20 +790,17 @@ def initialize(files, param):
                 os.makedirs(os.path.dirname(param['pow_file']))
             except: pass
             _logger.info("Writing power spectra to %s"%param['pow_file'])
+        saved=[]
         try:
             defvals = format.read(param['output'], map_ids=True)
-        except:
-            param['output_offset']=0
+        except: pass
         else:
-            saved=[]
             for filename in param['finished']:
                 fid = spider_utility.spider_id(filename)
                 if fid not in defvals: 
                     files.append(filename)
                     continue
                 saved.append(defvals[fid])
-            if len(saved) > 0: format.write(param['output'], saved)
-            param['output_offset']=len(saved)
         
         if param['cs'] == 0.0:
             _logger.info("Using CTF model appropriate for 0 CS")
@@ -728,21 +808,22 @@ def initialize(files, param):
             select = format.read(param['selection_file'], numeric=True)
             files = selection_utility.select_file_subset(files, select, param.get('id_len', 0), len(param['finished']) > 0)
         param['defocus_header']="id,defocus_u,defocus_v,astig_ang,defocus_avg,astig_mag,error".split(",")
+        param['defocus_writer'] = format.DocumentWriter(param['output'], format=format.spiderdoc, header=None if len(saved) > 0 else param['defocus_header'])
+        if len(saved) > 0: param['defocus_writer'].write(saved)
         param['defocus_arr'] = numpy.zeros((len(files), 7))
     return files
 
-def reduce_all(filename, file_completed, defocus_arr, output_offset, output, defocus_header, **extra):
+def reduce_all(filename, file_completed, defocus_arr, defocus_writer, **extra):
     # Process each input file in the main thread (for multi-threaded code)
     
     filename, defocus_vals = filename
     if len(defocus_vals) > 0:
         defocus_arr[file_completed-1, :len(defocus_vals)]=defocus_vals
-        mode = 'a' if (file_completed+output_offset) > 1 else 'w'
-        format.write(output, defocus_vals.reshape((1, defocus_vals.shape[0])), format=format.spiderdoc, 
-                             header=defocus_header, mode=mode, write_offset=file_completed+output_offset)
+        defocus_writer.write(defocus_vals.reshape((1, defocus_vals.shape[0])))
+        defocus_writer.flush()
     return filename
 
-def finalize(files, defocus_arr, output, dpi=300, **extra):
+def finalize(files, defocus_arr, output, dpi=300, defocus_writer=None, **extra):
     ''' Write out plots summarizing CTF features of the input images
     
     These plots include
@@ -763,10 +844,13 @@ def finalize(files, defocus_arr, output, dpi=300, **extra):
                  Output filename 
         dpi : int
               Resolution of plot in dots per inch
+        defocus_writer : DocumentWriter
+                         Writer for the CTF parameters of each file
         extra : dict
                 Unused keyword arguments
     '''
     
+    if defocus_writer is not None: defocus_writer.close()
     if len(files) > 0:
         defocus = (defocus_arr[:, 1]+defocus_arr[:, 2])/2.0
         magnitude = numpy.abs((defocus_arr[:, 1]-defocus_arr[:, 2])/2.0)
@@ -110,7 +110,7 @@ This is not a complete list of options available to this script, for additional
 .. Created on Aug 2, 2012
 .. codeauthor:: Robert Langlois <rl2528@columbia.edu>
 '''
-from ..core.app import program
+from ..core.app import program, file_processor
 from ..core.image import ndimage_utility, ndimage_file, ndimage_interpolate
 from ..core.metadata import format_utility, format, spider_params, spider_utility, selection_utility
 from ..core.parallel import mpi_utility
@@ -121,6 +121,8 @@ import numpy
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 
+prefetch, release_prefetch = file_processor.prefetch_images, file_processor.release_images
+
 def process(filename, id_len=0, **extra):
     '''Concatenate files and write to a single output file
     
@@ -44,6 +44,7 @@ def batch(files, image_file, output, rand_subset=0, experimental=False, experime
     if rand_subset: _logger.info("Drawing random subset: %d"%rand_subset)
     if extra['scale_spi']: _logger.info("Scaling translations for pySPIDER")
     if extra['thread_count']: _logger.info("Using %d threads"%extra['thread_count'])
+    if extra['backproject_engine'] == 2: _logger.info("Using NumPy gridding for backprojection")
     
     openmp.set_thread_count(1)
     align, image_size = None, None
@@ -116,6 +117,7 @@ def setup_options(parser, pgroup=None, main_option=False):
     group.add_option("",     experimental_2d=False,     help="Test 2d representation of alignment")
     group.add_option("",     class_index=0,             help="Select a specifc class within the alignment file")
     group.add_option("",     negate_trans=False,        help="Negate the translations")
+    group.add_option("",     backproject_engine=('Auto', 'SPIDER', 'NumPy'), help="Backprojection engine, Auto uses NumPy gridding when the SPIDER extension is not available", default=0)
     pgroup.add_option_group(group)
     if main_option:
         pgroup.add_option("-i", input_files=[], help="List of alignment files, e.g. data.star", required_file=True, gui=dict(filetype="open"))
@@ -0,0 +1,13 @@
+''' Unit testing for each module in :mod:`arachnid.app`
+
+.. currentmodule:: arachnid.app.tests
+
+.. autosummary::
+    :nosignatures:
+    :toctree: api_generated/
+    :template: api_module.rst
+    
+    test_align_frames
+    test_autopick
+
+'''
@@ -0,0 +1,58 @@
+''' Unit tests for the align_frames module
+'''
+from .. import align_frames
+from ...core.image import ndimage_file
+import numpy, numpy.testing, scipy.ndimage
+import tempfile
+import shutil
+import os
+
+def _fourier_frames(count=6, shape=(64, 64)):
+    '''
+    '''
+    
+    rand = numpy.random.RandomState(0)
+    img = scipy.ndimage.gaussian_filter(rand.normal(size=shape), 2)
+    shifts = numpy.cumsum(rand.uniform(-1.5, 1.5, (count, 2)), axis=0)
+    shifts[0] = 0
+    return [scipy.ndimage.fourier_shift(numpy.fft.fft2(img), s, -1, 0)+numpy.fft.fft2(rand.normal(0, 0.05, shape)) for s in shifts]
+
+def test_stream_sequential():
+    '''
+    '''
+    
+    frames = _fourier_frames()
+    trans, avg = align_frames.stream_sequential(iter(frames), 4, 10)
+    numpy.testing.assert_allclose(trans, align_frames.align_sequential(frames, 4, 10))
+    numpy.testing.assert_allclose(numpy.fft.ifft2(avg).real, align_frames.average_fft(frames, trans), atol=1e-8)
+
+def test_iter_fft():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'movie.spi')
+        frames = numpy.random.RandomState(0).normal(size=(5, 32, 32)).astype(numpy.float32)
+        with ndimage_file.stack_writer(filename) as writer:
+            writer.write_block(frames)
+        ref = list(align_frames.iter_fft(filename, single_precision=True, thread_count=1))
+        for thread_count in (2, 3):
+            fframes = list(align_frames.iter_fft(filename, single_precision=True, thread_count=thread_count))
+            assert(len(fframes) == len(frames))
+            assert(all([f.dtype == numpy.complex64 for f in fframes]))
+            numpy.testing.assert_allclose(numpy.asarray(fframes), numpy.asarray(ref))
+        assert(all([f.dtype == numpy.complex128 for f in align_frames.iter_fft(filename, thread_count=2)]))
+    finally:
+        shutil.rmtree(path)
+
+def test_shift_frequencies():
+    '''
+    '''
+    
+    align_frames._shift_frequency_cache.clear()
+    freq = align_frames._shift_frequencies((8, 8))
+    for i in xrange(align_frames._shift_frequency_cache_size+4):
+        align_frames._shift_frequencies((16, 16+i))
+        assert(align_frames._shift_frequencies((8, 8)) is freq)
+    assert(len(align_frames._shift_frequency_cache) == align_frames._shift_frequency_cache_size)
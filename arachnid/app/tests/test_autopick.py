@@ -0,0 +1,60 @@
+''' Unit tests for the autopick module
+'''
+from .. import autopick
+from ...core.app import program, file_processor
+from ...core.image import ndimage_utility, ndimage_interpolate
+import numpy
+
+def _options(**extra):
+    '''
+    '''
+    
+    parser = program.setup_parser(autopick, file_processor, supports_OMP=True)[0]
+    param = vars(parser.get_default_values())
+    param.update(pixel_diameter=20, window=28, bin_factor=2.0)
+    param.update(extra)
+    param["ds_kernel"] = ndimage_interpolate.sincblackman(param['bin_factor'], dtype=numpy.float32)
+    param['mask'] = ndimage_utility.model_disk(param['pixel_diameter']/2, (param['window'], param['window']))
+    return param
+
+def _micrograph(count=20, shape=(256, 256)):
+    '''
+    '''
+    
+    rand = numpy.random.RandomState(1)
+    mic = rand.normal(size=shape).astype(numpy.float32)
+    yy, xx = numpy.ogrid[:shape[0], :shape[1]]
+    for y, x in rand.randint(30, min(shape)-30, (count, 2)):
+        mic[((yy-y)**2+(xx-x)**2) < 81] += 3
+    return mic
+
+def test_search_range():
+    '''
+    '''
+    
+    param = _options()
+    param.pop('disk_mult_range')
+    autopick._template_spectrum_cache.clear()
+    coords = autopick.search_range(_micrograph(), [0.5, 0.6], **param)
+    assert(coords.ndim == 2 and coords.shape[1] == 3 and len(coords) > 0)
+    assert(len(autopick._template_spectrum_cache) == 2)
+    autopick.search_range(_micrograph(), [0.5, 0.6], **param)
+    assert(len(autopick._template_spectrum_cache) == 2)
+
+def test_template_spectrum_key():
+    '''
+    '''
+    
+    param = _options()
+    param.pop('disk_mult')
+    autopick._template_spectrum_cache.clear()
+    spec1 = autopick.template_spectrum((64, 64), numpy.float32, disk_mult=0.5, **param)
+    param['ds_kernel'] = param['ds_kernel'].copy()
+    assert(autopick.template_spectrum((64, 64), numpy.float32, disk_mult=0.5, **param) is spec1)
+    assert(len(autopick._template_spectrum_cache) == 1)
+    param['ds_kernel'] = param['ds_kernel']*2
+    spec2 = autopick.template_spectrum((64, 64), numpy.float32, disk_mult=0.5, **param)
+    assert(spec2 is not spec1)
+    assert(len(autopick._template_spectrum_cache) == 2)
+    assert(autopick.template_spectrum((64, 64), numpy.float32, disk_mult=0.5, **param) is spec2)
+    assert(len(autopick._template_spectrum_cache) == 2)
@@ -70,6 +70,27 @@ The target module may include any of the following functions:
    :param extra: Dictionary of unused keyword arguments (Options from the command line or config file, plus additional options)
    :returns: None or a new list of files or objects to be processed by other routines
 
+.. py:function:: prefetch(filename, **extra)
+
+   Read the input of a file into memory ahead of processing. When `--prefetch` is set, this is invoked from a background
+   thread of the process that will call :py:func:`process` on the same file. A program whose input files are images
+   read with :py:mod:`arachnid.core.image.ndimage_file` can use :py:func:`prefetch_images` and :py:func:`release_images`:
+   
+   .. sourcecode:: py
+       
+       >>> prefetch, release_prefetch = file_processor.prefetch_images, file_processor.release_images
+
+   :param filename: Input filename to read
+   :param extra: Unused keyword arguments (Options from the command line or config file, plus additional options)
+   :returns: Number of bytes held in memory
+
+.. py:function:: release_prefetch(filename, **extra)
+
+   Release the memory held by :py:func:`prefetch` after the file was processed.
+
+   :param filename: Input filename that was processed
+   :param extra: Unused keyword arguments (Options from the command line or config file, plus additional options)
+
 Each function also has access to the following keyword arguments:
 
     - finished: List of input files that have been processed and thus will not be processed this round
@@ -103,6 +124,14 @@ program architecture.
     
     Test if the program will restart
 
+.. option:: --prefetch <int>
+    
+    Number of input files to read ahead in the background while processing (only if supported by the program)
+
+.. option:: --prefetch-mem <float>
+    
+    Maximum memory in MB held by files read ahead, 0 means no limit
+
 .. end-options
 
 ..todo:: 
@@ -125,10 +154,12 @@ program architecture.
 .. Created on Oct 16, 2010
 .. codeauthor:: Robert Langlois <rl2528@columbia.edu>
 '''
-from ..parallel import mpi_utility
+from ..parallel import mpi_utility, process_tasks
 from ..metadata import spider_utility
+from ..image import ndimage_file
 import tracing
 from progress import progress
+import journal as restart_journal
 import multiprocessing
 import os
 import logging
@@ -175,19 +206,27 @@ def main(files, module, **extra):
     if progname[:4] == 'ara-': progname = progname[4:]
     if progname[:3] == 'sp-': progname = progname[3:]
     restart_file = os.path.join(os.path.dirname(extra['output']), '.restart.'+progname) if 'output' in extra else None
+    journal = restart_journal.RestartJournal(restart_file, mpi_utility.get_rank(**extra)) if restart_file is not None else None
     if extra['worker_count'] > multiprocessing.cpu_count():
         _logger.warn("Number of workers exceeds number of cores: %d > %d"%(extra['worker_count'], multiprocessing.cpu_count()))
     
     _logger.debug("File processer - begin")
     process, initialize, finalize, reduce_all, init_process, init_root = getattr(module, "process"), getattr(module, "initialize", None), getattr(module, "finalize", None), getattr(module, "reduce_all", None), getattr(module, "init_process", None), getattr(module, "init_root", None)
+    prefetch_load, prefetch_release = getattr(module, "prefetch", None), getattr(module, "release_prefetch", None)
     monitor=None
+    stamps = {}
     if mpi_utility.is_root(**extra):
         if init_root is not None:
             _logger.debug("Init-root")
             f = init_root(files, extra)
             if f is not None: files = f
         _logger.debug("Test dependencies1: %d"%len(files))
-        files, finished = check_dependencies(files, restart_file, **extra)
+        if journal is not None:
+            files, finished, entries = check_journal(files, journal, stamps=stamps, **extra)
+            if len(files) > 0:
+                tracing.backup(restart_file)
+                journal.compact(entries)
+        else: files, finished = check_dependencies(files, restart_file, **extra)
         extra['finished'] = finished
         _logger.debug("Test dependencies2: %d"%len(files))
     else: extra['finished']=None
@@ -218,16 +257,13 @@ def main(files, module, **extra):
         _logger.debug("Setup progress monitor")
         monitor = progress(len(files))
     
-    if restart_file is not None: tracing.backup(restart_file)
-    restart_fout = open(restart_file, 'w') if restart_file is not None else None
-    if restart_fout is not None:
-        for f in finished:
-            fileid = spider_utility.spider_id(f) if spider_utility.is_spider_filename(f) else f
-            restart_fout.write(str(fileid)+'\n')
     current = 0
     _logger.debug("Start processing")
     ignored_errors=[0]
-    for index, filename in mpi_utility.mpi_reduce(process, files, init_process=init_process, ignored_errors=ignored_errors, **extra):
+    record = journal is not None and journal_writer(reduce_all, **extra)
+    # Without MPI, the sizes read while checking the journal are reused to schedule the files
+    costs = process_tasks.task_costs(files, extra.get('task_cost'), stamps) if mpi_utility.get_size(**extra) < 2 else None
+    for index, filename in mpi_utility.mpi_reduce(process, files, init_process=init_process, ignored_errors=ignored_errors, prefetch_load=prefetch_load, prefetch_release=prefetch_release, costs=costs, **extra):
         if mpi_utility.is_root(**extra):
             try:
                 monitor.update()
@@ -251,19 +287,252 @@ def main(files, module, **extra):
                 _logger.exception("Error in root process")
                 del files[:]
             else:
-                if restart_fout is not None:
-                    if spider_utility.is_spider_filename(filename): filename=spider_utility.spider_id(filename)
-                    restart_fout.write(str(filename)+'\n')
-                    restart_fout.flush()
+                if record:
+                    if isinstance(filename, tuple): filename = filename[0]
+                    journal.append(restart_id(filename), filename, output_files(filename, **extra), input_files(filename, **extra))
+        elif record:
+            if isinstance(filename, tuple): filename = filename[0]
+            journal.append(restart_id(filename), filename, output_files(filename, **extra), input_files(filename, **extra))
     if ignored_errors[0] > 0:
         see_also="\n\nSee .%s.crash_report for more details"%os.path.basename(sys.argv[0])
         _logger.warn("Errors occurred during run"+see_also)
-    if restart_fout is not None: restart_fout.close()
+    if journal is not None: journal.close()
     if len(files) == 0:
         raise ValueError, "Error in root process"
     if mpi_utility.is_root(**extra):
         if finalize is not None: finalize(files, **extra)
 
+def journal_writer(reduce_all=None, **extra):
+    ''' Test if the current node appends finished files to the restart journal
+    
+    With MPI and no `reduce_all`, each client records the files it processed
+    in its own segment of the journal, which the root merges at the start of 
+    the next run. Otherwise, the root records every file once it has been 
+    reduced, as the outputs written by `reduce_all` must exist before the file 
+    is finished.
+    
+    :Parameters:
+        
+        reduce_all : function, optional
+                     Function that reduces the result of each file on the root
+        extra : dict
+                Unused extra keyword arguments
+    
+    :Returns:
+        
+        record : bool
+                 True if the current node appends to the journal
+    '''
+    
+    if reduce_all is None and mpi_utility.get_size(**extra) > 1:
+        return mpi_utility.is_client_strict(**extra)
+    return mpi_utility.is_root(**extra)
+
+def prefetch_images(filename, **extra):
+    ''' Read the image files of an input into memory ahead of processing
+    
+    :Parameters:
+        
+        filename : str or tuple
+                   Input filename or group tuple of ID and filenames
+        extra : dict
+                Unused keyword arguments
+    
+    :Returns:
+        
+        nbytes : int
+                 Number of bytes held in memory
+    '''
+    
+    return ndimage_file.prefetch(filename[1] if isinstance(filename, tuple) else filename)
+
+def release_images(filename, **extra):
+    ''' Release the memory held for the image files of an input read 
+    by :py:func:`prefetch_images`
+    
+    :Parameters:
+        
+        filename : str or tuple
+                   Input filename or group tuple of ID and filenames
+        extra : dict
+                Unused keyword arguments
+    '''
+    
+    ndimage_file.release_prefetch(filename[1] if isinstance(filename, tuple) else filename)
+
+def check_journal(files, journal, opt_changed=False, force=False, restart_test=False, disable_restart_file=False, stamps=None, **extra):
+    ''' Generate a subset of files required to process from a single scan of the restart
+    journal (see :py:mod:`journal`).
+    
+    A file is finished if the journal holds a record for it, the size and modification time
+    of the input file and of its input dependencies match the record and its output files 
+    exist. A record without output files is not finished. Output files are found with one 
+    directory listing per output directory rather than a call to `stat` per file.
+    
+    If there is no journal, the options request a restart from the beginning, or a record
+    was written by an earlier version without a stamp, then the files are checked with 
+    :py:func:`check_dependencies`.
+    
+    :Parameters:
+    
+        files : list
+                List of input files
+        journal : RestartJournal
+                  Restart journal
+        opt_changed : bool
+                      If true, then options have changed; restart from beginning
+        force : bool
+                Force the program to restart from the beginning
+        restart_test : bool
+                       Test if program will restart
+        disable_restart_file : bool
+                               Ignore the journal and check the dependencies
+        stamps : dict, optional
+                 Filled with the stamp of each input read while checking the
+                 journal, see :py:func:`journal.stamp_input`
+        extra : dict
+                Unused extra keyword arguments
+            
+    :Returns:
+        
+        unfinished : list
+                     List of input filenames to process 
+        finished : list
+                   List of input filenames that satisfy requirements and will not be processed.
+        entries : dict
+                  Journal records for the finished files
+    '''
+    
+    if opt_changed or force or disable_restart_file or not journal.exists():
+        unfinished, finished = check_dependencies(files, journal.filename, opt_changed=opt_changed, force=force, restart_test=restart_test, disable_restart_file=disable_restart_file, **extra)
+        entries = dict([(restart_id(f), restart_journal.stamp(f, output_files(f, **extra), input_files(f, **extra))) for f in finished])
+        return unfinished, finished, entries
+    
+    records = journal.read()
+    listing = {}
+    if stamps is None: stamps = {}
+    unfinished = []
+    finished = []
+    legacy = []
+    entries = {}
+    for f in files:
+        fileid = str(restart_id(f))
+        record = records.get(fileid)
+        if record is None:
+            _logger.debug("Adding: %s because it is not in the restart journal"%str(f))
+            unfinished.append(f)
+        elif record[0] is None:
+            legacy.append(f)
+        elif restart_journal.is_current(record, listing, stamps):
+            finished.append(f)
+            entries[fileid] = record
+        else:
+            _logger.debug("Adding: %s because the input changed or an output is missing"%str(f))
+            unfinished.append(f)
+    if len(legacy) > 0:
+        _logger.debug("Checking dependencies for %d files without a stamp"%len(legacy))
+        legacy_unfinished, legacy_finished = check_dependencies(legacy, journal.filename, **extra)
+        unfinished.extend(legacy_unfinished)
+        finished.extend(legacy_finished)
+        for f in legacy_finished:
+            entries[str(restart_id(f))] = restart_journal.stamp(f, output_files(f, **extra), input_files(f, **extra))
+    if len(finished) > 0:
+        _logger.info("Skipping %d files - all dependencies satisfied (use --force or force: True to reprocess) - processing %d files"%(len(finished), len(unfinished)))
+    if restart_test:
+        sys.exit(0)
+    return unfinished, finished, entries
+
+def restart_id(filename):
+    ''' Get the ID of a file in the restart journal
+    
+    :Parameters:
+        
+        filename : str
+                   Input filename
+    
+    :Returns:
+        
+        fileid : str
+                 SPIDER ID if the filename has one, otherwise the filename
+    '''
+    
+    return spider_utility.spider_id(filename) if spider_utility.is_spider_filename(filename) else filename
+
+def output_files(filename, outfile_deps=[], id_len=0, data_ext=None, **extra):
+    ''' List the output files generated for a single input file
+    
+    Only outputs named with a SPIDER template are listed, outputs shared by all 
+    input files are not.
+    
+    :Parameters:
+        
+        filename : str
+                   Input filename
+        outfile_deps : list
+                       List of output file dependencies
+        id_len : int
+                 Max length of SPIDER ID
+        data_ext : str
+                   If the dependent file does not have an extension, add this extension
+        extra : dict
+                Unused extra keyword arguments
+    
+    :Returns:
+        
+        outputs : list
+                  List of output filenames
+    '''
+    
+    if isinstance(filename, tuple): filename = filename[0]
+    if data_ext is not None and data_ext=="" and isinstance(filename, str):
+        data_ext = os.path.splitext(filename)[1][1:]
+    outputs = []
+    for out in outfile_deps:
+        if out == "" or not spider_utility.is_spider_filename(extra[out]): continue
+        output = spider_utility.spider_filename(extra[out], filename, id_len)
+        if data_ext and os.path.splitext(output)[1] == "": output += '.'+data_ext
+        outputs.append(output)
+    return outputs
+
+def input_files(filename, infile_deps=[], id_len=0, data_ext=None, **extra):
+    ''' List the input files, other than the file itself, that a single input 
+    file depends on
+    
+    An input named with a SPIDER template is listed for the ID of the file, 
+    an input shared by all files is listed as is.
+    
+    :Parameters:
+        
+        filename : str
+                   Input filename
+        infile_deps : list
+                      List of input file dependencies
+        id_len : int
+                 Max length of SPIDER ID
+        data_ext : str
+                   If the dependent file does not have an extension, add this extension
+        extra : dict
+                Unused extra keyword arguments
+    
+    :Returns:
+        
+        inputs : list
+                 List of input filenames
+    '''
+    
+    if isinstance(filename, tuple): filename = filename[0]
+    if data_ext is not None and data_ext=="" and isinstance(filename, str):
+        data_ext = os.path.splitext(filename)[1][1:]
+    inputs = []
+    for dep in infile_deps:
+        if dep == "" or not isinstance(extra.get(dep), str) or extra[dep] == "": continue
+        if spider_utility.is_spider_filename(extra[dep]) and spider_utility.is_spider_filename(filename):
+            input_file = spider_utility.spider_filename(extra[dep], filename, id_len)
+            if data_ext and os.path.splitext(input_file)[1] == "": input_file += '.'+data_ext
+        else: input_file = extra[dep]
+        inputs.append(input_file)
+    return inputs
+
 def check_dependencies(files, restart_file, infile_deps, outfile_deps=[], opt_changed=False, force=False, id_len=0, data_ext=None, restart_test=False, disable_restart_file=False, **extra):
     ''' Generate a subset of files required to process based on changes to input and existing
     output files. Note that this dependency checking is similar to the program `make`.
@@ -305,7 +574,7 @@ def check_dependencies(files, restart_file, infile_deps, outfile_deps=[], opt_ch
                    List of input filenames that satisfy requirements and will not be processed.
     '''
     
-    restart_files = set([f.strip() for f in open(restart_file, 'r').readlines()]) if restart_file is not None and os.path.exists(restart_file) else None
+    restart_files = set([f.split('\t')[0].strip() for f in open(restart_file, 'r').readlines()]) if restart_file is not None and os.path.exists(restart_file) else None
     restart_example = ",".join([v for v in list(restart_files)[:3]]) if restart_files is not None else ""
     if opt_changed or force:
         msg = "configuration file changed" if opt_changed else "--force option specified"
@@ -408,6 +677,8 @@ def setup_options(parser, pgroup=None):
     group.add_option("",   force=False,       help="Force the program to run from the start", dependent=False)
     group.add_option("",   restart_test=False,help="Test if the program will restart", dependent=False)
     group.add_option("",   disable_restart_file=False,help="Disable restart file checking", dependent=False)
+    group.add_option("",   prefetch=0,        help="Number of input files to read ahead in the background while processing (only if supported by the program)", gui=dict(minimum=0), dependent=False)
+    group.add_option("",   prefetch_mem=0.0,  help="Maximum memory in MB held by files read ahead, 0 means no limit", gui=dict(minimum=0), dependent=False)
     pgroup.add_option_group(group)
 
 def check_options(options):
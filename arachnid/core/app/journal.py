@@ -0,0 +1,310 @@
+''' Append-only restart journal for file processing
+
+The journal records each file that was completely processed along with
+the size and modification time of the input file and of the files it
+depends on, and the location of its output files. It consists of an 
+index file, `.restart.<prog>`, and one append-only segment per MPI rank,
+`.restart.<prog>.<rank>`, so no two ranks share a file handle.
+
+Each record is a single tab-separated line written with one call to
+:py:func:`os.write` on a file opened for append. A crash can at worst
+leave a partial last line, which is ignored when the journal is read.
+At the start of a run, the root folds the segments into a new index,
+which replaces the old one atomically. A file is recorded by the rank 
+that finishes it, see :py:func:`~arachnid.core.app.file_processor.journal_writer`.
+
+The index is backward compatible: a line holding only the file ID, as
+written by earlier versions, is read as a record without a stamp.
+'''
+import os
+import glob
+import logging
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.DEBUG)
+
+class RestartJournal(object):
+    ''' Restart journal for a single program
+
+    :Parameters:
+
+    filename : str
+               Name of the index file
+    rank : int
+           Rank of the current node, selects the segment to append
+    '''
+
+    def __init__(self, filename, rank=0):
+        '''Create a journal for the given index file
+        '''
+
+        self.filename = filename
+        self.rank = rank
+        self.fd = None
+
+    def __del__(self):
+        ''' Close the segment
+        '''
+
+        self.close()
+
+    def segment(self, rank=None):
+        ''' Get the filename of the segment for the given rank
+
+        :Parameters:
+
+        rank : int, optional
+               Rank of the node, if None use the current rank
+
+        :Returns:
+
+        filename : str
+                   Name of the segment
+        '''
+
+        if rank is None: rank = self.rank
+        return "%s.%d"%(self.filename, rank)
+
+    def segments(self):
+        ''' List the segments written by all ranks
+
+        :Returns:
+
+        filenames : list
+                    Names of the segments
+        '''
+
+        return [f for f in glob.glob(self.filename+'.*') if os.path.splitext(f)[1][1:].isdigit()]
+
+    def exists(self):
+        ''' Test if the index or any segment exists
+
+        :Returns:
+
+        out : bool
+              True if there is a journal to read
+        '''
+
+        return os.path.exists(self.filename) or len(self.segments()) > 0
+
+    def read(self):
+        ''' Read the index and all segments in a single pass
+
+        :Returns:
+
+        entries : dict
+                  Map file ID to record (input, size, mtime, outputs, inputs), 
+                  where the input is None for a record without a stamp
+        '''
+
+        entries = {}
+        for filename in [self.filename]+sorted(self.segments()):
+            if not os.path.exists(filename): continue
+            fin = open(filename, 'r')
+            try:
+                for line in fin:
+                    if line[-1] != '\n': break # Partial record from a crash
+                    record = parse_record(line)
+                    if record is not None: entries[record[0]] = record[1:]
+            finally: fin.close()
+        return entries
+
+    def compact(self, entries):
+        ''' Replace the index with the given records and remove the segments
+
+        :Parameters:
+
+        entries : dict
+                  Map file ID to record (input, size, mtime, outputs, inputs)
+        '''
+
+        segments = self.segments()
+        self.close()
+        tmp = self.filename+'.tmp'
+        fout = open(tmp, 'w')
+        try:
+            for fileid, record in entries.iteritems():
+                fout.write(format_record(fileid, *record))
+            fout.flush()
+            os.fsync(fout.fileno())
+        finally: fout.close()
+        os.rename(tmp, self.filename)
+        for filename in segments: os.unlink(filename)
+
+    def append(self, fileid, filename=None, outputs=[], inputs=[]):
+        ''' Record a finished file in the segment of the current rank
+
+        :Parameters:
+
+        fileid : str or int
+                 ID of the file
+        filename : str, optional
+                   Input filename to stamp with size and modification time
+        outputs : list
+                  Output filenames
+        inputs : list
+                 Filenames of other inputs the file depends on
+        '''
+
+        if self.fd is None:
+            self.fd = os.open(self.segment(), os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0644)
+        os.write(self.fd, format_record(fileid, *stamp(filename, outputs, inputs)))
+
+    def close(self):
+        ''' Close the segment
+        '''
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def stamp(filename, outputs=[], inputs=[]):
+    ''' Create a record for the given input file
+
+    :Parameters:
+
+    filename : str
+               Input filename, None if the input is not a file
+    outputs : list
+              Output filenames
+    inputs : list
+             Filenames of other inputs the file depends on
+
+    :Returns:
+
+    input : str
+            Input filename, None if it cannot be stamped
+    size : int
+           Size of the input file
+    mtime : float
+            Modification time of the input file
+    outputs : list
+              Output filenames
+    inputs : list
+             List of (filename, size, mtime) for the other inputs, the size
+             is -1 if the file does not exist
+    '''
+
+    if filename is not None and isinstance(filename, str):
+        try: st = os.stat(filename)
+        except OSError: pass
+        else: return filename, st.st_size, st.st_mtime, list(outputs), [stamp_input(f) for f in inputs]
+    return None, 0, 0.0, list(outputs), []
+
+def stamp_input(filename):
+    ''' Get the size and modification time of an input file
+
+    :Parameters:
+
+    filename : str
+               Input filename
+
+    :Returns:
+
+    filename : str
+               Input filename
+    size : int
+           Size of the file, -1 if it does not exist
+    mtime : float
+            Modification time of the file
+    '''
+
+    try: st = os.stat(filename)
+    except OSError: return filename, -1, 0.0
+    return filename, st.st_size, st.st_mtime
+
+def format_record(fileid, filename, size, mtime, outputs, inputs=[]):
+    ''' Format a record as a single line
+
+    :Parameters:
+
+    fileid : str or int
+             ID of the file
+    filename : str
+               Input filename, None for a record without a stamp
+    size : int
+           Size of the input file
+    mtime : float
+            Modification time of the input file
+    outputs : list
+              Output filenames
+    inputs : list
+             List of (filename, size, mtime) for the other inputs
+
+    :Returns:
+
+    line : str
+           Record terminated by a newline
+    '''
+
+    if filename is None: return "%s\n"%str(fileid)
+    inputs = ";".join(["%s|%d|%r"%dep for dep in inputs])
+    return "%s\t%s\t%d\t%r\t%s\t%s\n"%(str(fileid), filename, size, mtime, ";".join(outputs), inputs)
+
+def parse_record(line):
+    ''' Parse a record from a single line
+
+    :Parameters:
+
+    line : str
+           Line from the journal
+
+    :Returns:
+
+    record : tuple
+             (fileid, input, size, mtime, outputs, inputs) or None if the line is empty
+    '''
+
+    vals = line.rstrip('\n').split('\t')
+    if vals[0].strip() == "": return None
+    if len(vals) < 5: return vals[0].strip(), None, 0, 0.0, [], []
+    try:
+        inputs = []
+        if len(vals) > 5:
+            for dep in vals[5].split(';'):
+                if dep == "": continue
+                filename, size, mtime = dep.rsplit('|', 2)
+                inputs.append((filename, int(size), float(mtime)))
+        return vals[0], vals[1], int(vals[2]), float(vals[3]), [f for f in vals[4].split(';') if f != ""], inputs
+    except ValueError:
+        return vals[0], None, 0, 0.0, [], []
+
+def is_current(record, listing=None, stamps=None):
+    ''' Test if a record with a stamp matches the input files on disk and its
+    output files exist
+    
+    A record without output files is never current, as there is nothing to
+    show the file was processed.
+
+    :Parameters:
+
+    record : tuple
+             (input, size, mtime, outputs, inputs)
+    listing : dict, optional
+              Cache of directory listings used to test if the outputs exist
+    stamps : dict, optional
+             Cache of input stamps, see :py:func:`stamp_input`, so an input
+             shared by many records is only stamped once
+
+    :Returns:
+
+    current : bool
+              True if the input files are unchanged and all outputs exist
+    '''
+
+    filename, size, mtime, outputs, inputs = record
+    if len(outputs) == 0: return False
+    if listing is None: listing = {}
+    for output in outputs:
+        path, base = os.path.split(os.path.abspath(output))
+        if path not in listing:
+            try: listing[path] = set(os.listdir(path))
+            except OSError: listing[path] = set()
+        if base not in listing[path]: return False
+    if stamps is None: stamps = {}
+    for dep in inputs:
+        if dep[0] not in stamps: stamps[dep[0]] = stamp_input(dep[0])
+        if stamps[dep[0]] != dep: return False
+    if filename is None: return True
+    if filename not in stamps: stamps[filename] = stamp_input(filename)
+    return stamps[filename] == (filename, size, mtime)
@@ -1013,6 +1013,7 @@ def setup_program_options(parser, main_template, supports_MPI=False, supports_OM
         group.add_option("",   home_prefix="",         help="File directory accessible to all nodes to copy files (optional but recommended for MPI jobs)", gui=dict(filetype="open"), dependent=False)
         group.add_option("",   local_scratch="",       help="File directory on local node to copy files (optional but recommended for MPI jobs)", gui=dict(filetype="save"), dependent=False)
         group.add_option("",   local_temp="",          help="File directory on local node for temporary files (optional but recommended for MPI jobs)", gui=dict(filetype="save"), dependent=False)
+        group.add_option("",   mpi_chunk=0,            help="Number of files per worker handed to a node on request, 0 means split the files evenly before processing", gui=dict(minimum=0), dependent=False)
         gen_group.add_option_group(group)
     if supports_OMP:# and openmp.get_max_threads() > 1:
         prg_group.add_option("-t",   thread_count=1, help="Number of threads per machine, 0 means determine from environment", gui=dict(minimum=0), dependent=False)
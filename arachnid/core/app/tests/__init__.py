@@ -0,0 +1,13 @@
+''' Unit testing for each module in :mod:`arachnid.core.app`
+
+.. currentmodule:: arachnid.core.app.tests
+
+.. autosummary::
+    :nosignatures:
+    :toctree: api_generated/
+    :template: api_module.rst
+    
+    test_file_processor
+    test_journal
+
+'''
@@ -0,0 +1,180 @@
+''' Unit tests for the file_processor module
+'''
+from .. import file_processor, journal
+from ...image import ndimage_file
+from ...parallel import mpi_utility
+import numpy
+import time
+import tempfile
+import shutil
+import os
+
+def _touch(filename, data='x'):
+    '''
+    '''
+    
+    fout = open(filename, 'w')
+    fout.write(data)
+    fout.close()
+
+def test_check_journal():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        extra = dict(infile_deps=['coordinate_file'], outfile_deps=['output'], output=os.path.join(path, 'out_0000.spi'), coordinate_file=os.path.join(path, 'coords_0000.spi'))
+        files = [os.path.join(path, 'mic_%04d.spi'%i) for i in (1, 2, 3)]
+        jour = journal.RestartJournal(os.path.join(path, '.restart.test'))
+        for f in files:
+            _touch(f)
+            for dep in file_processor.output_files(f, **extra)+file_processor.input_files(f, **extra): _touch(dep)
+            jour.append(file_processor.restart_id(f), f, file_processor.output_files(f, **extra), file_processor.input_files(f, **extra))
+        jour.close()
+        assert(file_processor.input_files(files[1], **extra) == [os.path.join(path, 'coords_0002.spi')])
+        stamps = {}
+        unfinished, finished, entries = file_processor.check_journal(files, jour, stamps=stamps, **extra)
+        assert(unfinished == [] and finished == files)
+        assert(set(files).issubset(stamps.keys()) and stamps[files[0]][1] == 1)
+        
+        _touch(os.path.join(path, 'coords_0002.spi'), 'xy')
+        os.unlink(os.path.join(path, 'out_0003.spi'))
+        unfinished, finished, entries = file_processor.check_journal(files, jour, **extra)
+        assert(unfinished == files[1:] and finished == files[:1])
+        assert(entries.keys() == ['1'])
+        
+        extra['outfile_deps'] = []
+        jour.append(file_processor.restart_id(files[0]), files[0], file_processor.output_files(files[0], **extra))
+        jour.close()
+        unfinished, finished, entries = file_processor.check_journal(files, jour, **extra)
+        assert(unfinished == files and finished == [])
+    finally:
+        shutil.rmtree(path)
+
+class _Comm(object):
+    '''
+    '''
+    
+    def __init__(self, rank, size):
+        '''
+        '''
+        
+        self.rank, self.size = rank, size
+    
+    def Get_rank(self):
+        '''
+        '''
+        
+        return self.rank
+    
+    def Get_size(self):
+        '''
+        '''
+        
+        return self.size
+
+def test_journal_writer():
+    '''
+    '''
+    
+    reduce_all = lambda filename, **extra: filename
+    assert(file_processor.journal_writer(None))
+    assert(file_processor.journal_writer(reduce_all))
+    assert([file_processor.journal_writer(None, comm=_Comm(r, 3)) for r in xrange(3)] == [False, True, True])
+    assert([file_processor.journal_writer(reduce_all, comm=_Comm(r, 3)) for r in xrange(3)] == [True, False, False])
+
+class _PrefetchModule(object):
+    '''
+    '''
+    
+    def __init__(self, nbytes=0):
+        '''
+        '''
+        
+        self.nbytes = nbytes
+        self.loaded = []
+        self.released = []
+        self.processed = []
+        self.max_held = 0
+    
+    def prefetch(self, filename, **extra):
+        '''
+        '''
+        
+        self.loaded.append(filename)
+        self.max_held = max(self.max_held, len(self.loaded)-len(self.released))
+        return self.nbytes
+    
+    def release_prefetch(self, filename, **extra):
+        '''
+        '''
+        
+        self.released.append(filename)
+    
+    def process(self, filename, **extra):
+        '''
+        '''
+        
+        time.sleep(0.05)
+        self.processed.append(filename)
+        return filename
+
+def _main_prefetch(files, module, **extra):
+    '''
+    '''
+    
+    extra.update(worker_count=1, infile_deps=[])
+    MPI = mpi_utility.MPI
+    mpi_utility.MPI = None
+    try: file_processor.main(list(files), module, **extra)
+    finally: mpi_utility.MPI = MPI
+
+def test_prefetch():
+    '''
+    '''
+    
+    files = ['mic_%04d.spi'%i for i in xrange(1, 7)]
+    module = _PrefetchModule()
+    _main_prefetch(files, module, prefetch=2)
+    assert(module.processed == files)
+    assert(len(module.loaded) > 0 and set(module.loaded).issubset(files))
+    assert(sorted(module.released) == sorted(module.loaded))
+    
+    module = _PrefetchModule()
+    _main_prefetch(files, module, prefetch=0)
+    assert(module.processed == files)
+    assert(module.loaded == [] and module.released == [])
+
+def test_prefetch_mem():
+    '''
+    '''
+    
+    files = ['mic_%04d.spi'%i for i in xrange(1, 7)]
+    module = _PrefetchModule(1048576)
+    _main_prefetch(files, module, prefetch=4, prefetch_mem=1.5)
+    assert(module.processed == files)
+    assert(sorted(module.released) == sorted(module.loaded))
+    assert(module.max_held <= 2)
+    
+    module = _PrefetchModule(1048576)
+    _main_prefetch(files, module, prefetch=4, prefetch_mem=0)
+    assert(module.processed == files)
+    assert(sorted(module.released) == sorted(module.loaded))
+    assert(module.max_held > 2)
+
+def test_prefetch_images():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'mic_0001.spi')
+        ndimage_file.write_image(filename, numpy.ones((8, 8), dtype=numpy.float32))
+        os.utime(filename, (1e9, 1e9))
+        nbytes = os.path.getsize(filename)
+        assert(file_processor.prefetch_images(filename) == nbytes)
+        assert(file_processor.prefetch_images((1, [filename])) == nbytes)
+        file_processor.release_images((1, [filename]))
+        file_processor.release_images(filename)
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,128 @@
+''' Unit tests for the journal module
+'''
+from .. import journal
+import tempfile
+import shutil
+import os
+
+def _touch(filename, data='x'):
+    '''
+    '''
+    
+    fout = open(filename, 'w')
+    fout.write(data)
+    fout.close()
+
+def test_append_read():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        infile, outfile, depfile = [os.path.join(path, f) for f in ('mic_0001.spi', 'out_0001.spi', 'coords_0001.spi')]
+        for f in (infile, outfile, depfile): _touch(f)
+        jour = journal.RestartJournal(os.path.join(path, '.restart.test'), 1)
+        jour.append('1', infile, [outfile], [depfile, os.path.join(path, 'missing.spi')])
+        jour.append('2')
+        jour.close()
+        entries = jour.read()
+        assert(sorted(entries.keys()) == ['1', '2'])
+        assert(entries['2'][0] is None)
+        record = entries['1']
+        assert(record[0] == infile and record[3] == [outfile])
+        assert(record[4][0] == journal.stamp_input(depfile))
+        assert(record[4][1][1] == -1)
+        assert(journal.is_current(record))
+        os.utime(depfile, (0, 0))
+        assert(not journal.is_current(record))
+        _touch(record[4][1][0])
+        os.utime(depfile, (record[4][0][2], record[4][0][2]))
+        assert(not journal.is_current(record))
+    finally:
+        shutil.rmtree(path)
+
+def test_no_outputs():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        infile = os.path.join(path, 'mic_0001.spi')
+        _touch(infile)
+        assert(not journal.is_current(journal.stamp(infile, [])))
+    finally:
+        shutil.rmtree(path)
+
+def test_partial_record():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        infile, outfile = [os.path.join(path, f) for f in ('mic_0001.spi', 'out_0001.spi')]
+        for f in (infile, outfile): _touch(f)
+        jour = journal.RestartJournal(os.path.join(path, '.restart.test'), 0)
+        jour.append('1', infile, [outfile])
+        jour.close()
+        line = journal.format_record('2', *journal.stamp(infile, [outfile]))
+        fout = open(jour.segment(), 'a')
+        fout.write(line[:len(line)/2])
+        fout.close()
+        assert(jour.read().keys() == ['1'])
+    finally:
+        shutil.rmtree(path)
+
+def test_compact():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        infile, outfile = [os.path.join(path, f) for f in ('mic_0001.spi', 'out_0001.spi')]
+        for f in (infile, outfile): _touch(f)
+        index = os.path.join(path, '.restart.test')
+        _touch(index, '3\n')
+        for rank in (0, 2):
+            jour = journal.RestartJournal(index, rank)
+            jour.append(str(rank+1), infile, [outfile], [infile])
+            jour.close()
+        jour = journal.RestartJournal(index, 0)
+        entries = jour.read()
+        assert(sorted(entries.keys()) == ['1', '3'])
+        del entries['3']
+        jour.compact(entries)
+        assert(jour.segments() == [])
+        assert(jour.read() == entries)
+        assert(sorted(os.listdir(path)) == ['.restart.test', 'mic_0001.spi', 'out_0001.spi'])
+    finally:
+        shutil.rmtree(path)
+
+def test_shared_stamps():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        depfile = os.path.join(path, 'defocus.spi')
+        _touch(depfile)
+        jour = journal.RestartJournal(os.path.join(path, '.restart.test'))
+        for i in xrange(1, 4):
+            infile, outfile = [os.path.join(path, f%i) for f in ('mic_%04d.spi', 'out_%04d.spi')]
+            for f in (infile, outfile): _touch(f)
+            jour.append(str(i), infile, [outfile], [depfile])
+        jour.close()
+        records = jour.read()
+        calls = []
+        stamp_input = journal.stamp_input
+        def count_stamp(filename):
+            calls.append(filename)
+            return stamp_input(filename)
+        journal.stamp_input = count_stamp
+        try:
+            stamps = {}
+            assert(all([journal.is_current(records[k], None, stamps) for k in sorted(records.keys())]))
+        finally: journal.stamp_input = stamp_input
+        assert(calls.count(depfile) == 1)
+        assert(len(calls) == 4)
+    finally:
+        shutil.rmtree(path)
@@ -6,6 +6,7 @@
 '''
 import numpy
 import scipy.fftpack
+import threading
 
 
 def xcorr_dft_peak(f1, f2, usfac, search_radius, y0=0, x0=0):
@@ -43,3 +44,175 @@ def _xcorr_dft_peak(f3, usfac, search_radius, y0=0, x0=0):
     dx = (float(dx) - dftshift)/usfac
     return dy, dx, peak
 
+
+def xcorr_dft_peak_batch(f1, f2, pairs, usfac, search_radius, filter_kernel=None, thread_count=1, batch_mem=64):
+    ''' Find the cross-correlation peak for many pairs of Fourier transforms
+    
+    This gives the same result as calling :py:func:`xcorr_dft_peak` on each pair,
+    `xcorr_dft_peak(f1[i]*filter_kernel, f2[j], usfac, search_radius)`, but the 
+    pairs are evaluated in stacks with DFT kernels that are computed once for 
+    the call. The refinement kernel for each pair is this kernel multiplied by a 
+    phase shift. 
+    
+    The number of pairs in a stack is chosen so the stacks of all threads hold 
+    at most `batch_mem` MB of cross-power spectra, and at least one pair.
+    
+    :Parameters:
+    
+    f1 : list
+         Fourier transform of the first image of each pair
+    f2 : list
+         Fourier transform of the second image of each pair (may be the same as `f1`)
+    pairs : array
+            Index of the first and second image for each pair (Nx2)
+    usfac : int
+            Upsampling factor
+    search_radius : float
+                    Maximum search radius
+    filter_kernel : array, optional
+                    Filter applied to the first image of each pair
+    thread_count : int
+                   Number of threads used to spread the pairs
+    batch_mem : float
+                Maximum memory in MB held by the stacks of pairs of all threads
+    
+    :Returns:
+    
+    peaks : array
+            Location and value of the peak for each pair (Nx3): y, x, peak
+    '''
+    
+    pairs = numpy.asarray(pairs, dtype=numpy.int).reshape((-1, 2))
+    peaks = numpy.zeros((len(pairs), 3))
+    if len(pairs) == 0: return peaks
+    shape = f1[pairs[0, 0]].shape
+    dtype = numpy.result_type(f1[pairs[0, 0]].dtype, f2[pairs[0, 1]].dtype)
+    thread_count = min(max(1, int(thread_count)), len(pairs))
+    batch_size = max(1, int(batch_mem*1048576) // (thread_count*numpy.prod(shape)*numpy.dtype(dtype).itemsize))
+    batches = [slice(b, min(b+batch_size, len(pairs))) for b in xrange(0, len(pairs), batch_size)]
+    coarse = dft_kernels(shape, min(2, usfac), search_radius, dtype=dtype)
+    fine = dft_kernels(shape, usfac, 1.5, True, dtype) if usfac > 2 else None
+    
+    def align_batches(index):
+        for b in index:
+            peaks[b] = _xcorr_dft_peak_batch(f1, f2, pairs[b], coarse, fine, filter_kernel)
+    
+    thread_count = min(thread_count, len(batches))
+    if thread_count == 1:
+        align_batches(batches)
+    else:
+        threads = [threading.Thread(target=align_batches, args=(batches[i::thread_count], )) for i in xrange(thread_count)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    return peaks
+
+def _xcorr_dft_peak_batch(f1, f2, pairs, coarse, fine=None, filter_kernel=None):
+    ''' Find the cross-correlation peak for a stack of pairs
+    
+    :Parameters:
+    
+    f1 : list
+         Fourier transform of the first image of each pair
+    f2 : list
+         Fourier transform of the second image of each pair
+    pairs : array
+            Index of the first and second image for each pair (Nx2)
+    coarse : tuple
+             DFT kernels of the coarse search, see :py:func:`dft_kernels`
+    fine : tuple, optional
+           DFT kernels with phase terms of the refinement, None for no refinement
+    filter_kernel : array, optional
+                    Filter applied to the first image of each pair
+    
+    :Returns:
+    
+    peaks : array
+            Location and value of the peak for each pair (Nx3): y, x, peak
+    '''
+    
+    dtype = numpy.result_type(f1[pairs[0, 0]].dtype, f2[pairs[0, 1]].dtype)
+    f3 = numpy.empty((len(pairs), )+f1[pairs[0, 0]].shape, dtype=dtype)
+    for k, (i, j) in enumerate(pairs):
+        if filter_kernel is not None:
+            numpy.multiply(f1[i], filter_kernel, f3[k])
+            numpy.multiply(f3[k], f2[j].conj(), f3[k])
+        else: numpy.multiply(f1[i], f2[j].conj(), f3[k])
+    kerny, kernx, dftshift, usfac = coarse
+    y, x, p = _dft_peak(numpy.matmul(numpy.matmul(kerny, f3), kernx), dftshift, usfac)
+    if fine is not None:
+        kerny, kernx, dftshift, usfac, fy, fx = fine
+        kerny = (kerny[numpy.newaxis]*numpy.exp(numpy.multiply.outer(numpy.rint(usfac*y), fy))[:, numpy.newaxis, :]).astype(dtype)
+        kernx = (kernx[numpy.newaxis]*numpy.exp(numpy.multiply.outer(numpy.rint(usfac*x), fx))[:, :, numpy.newaxis]).astype(dtype)
+        dy, dx, p = _dft_peak(numpy.matmul(numpy.matmul(kerny, f3), kernx), dftshift, usfac)
+        y += dy
+        x += dx
+    return numpy.column_stack((y, x, p))
+
+def _dft_peak(CC, dftshift, usfac):
+    ''' Find the peak in each upsampled cross-correlation map of a stack
+    
+    :Parameters:
+    
+    CC : array
+         Stack of upsampled cross-correlation maps
+    dftshift : float
+               Offset of zero shift in the map
+    usfac : int
+            Upsampling factor
+    
+    :Returns:
+    
+    dy : array
+         Shift along y for each map
+    dx : array
+         Shift along x for each map
+    peak : array
+           Value of the peak in each map
+    '''
+    
+    idx = numpy.argmax(CC.reshape((CC.shape[0], -1)), axis=1)
+    dy, dx = numpy.unravel_index(idx, CC.shape[1:])
+    peak = CC.reshape((CC.shape[0], -1))[numpy.arange(len(idx)), idx].real
+    return (dy - dftshift)/float(usfac), (dx - dftshift)/float(usfac), peak
+
+def dft_kernels(shape, usfac, search_radius, phase=False, dtype=numpy.complex):
+    ''' Get the DFT kernels that upsample the cross-correlation around zero shift
+    
+    :Parameters:
+    
+    shape : tuple
+            Shape of the Fourier transform
+    usfac : int
+            Upsampling factor
+    search_radius : float
+                    Maximum search radius
+    phase : bool
+            Also return the frequency terms used to shift the kernels
+    dtype : dtype
+            Data type of the kernels
+    
+    :Returns:
+    
+    kerny : array
+            Kernel applied to the rows
+    kernx : array
+            Kernel applied to the columns
+    dftshift : float
+               Offset of zero shift in the upsampled map
+    usfac : int
+            Upsampling factor
+    fy : array, optional
+         Phase term for a unit shift along y (only if `phase` is True)
+    fx : array, optional
+         Phase term for a unit shift along x (only if `phase` is True)
+    '''
+    
+    ny, nx = shape
+    noyx = numpy.ceil(search_radius*usfac)
+    dftshift = numpy.fix(numpy.ceil(search_radius*usfac)/2)
+    freqy = scipy.fftpack.ifftshift(numpy.arange(ny) - numpy.floor(ny/2))
+    freqx = scipy.fftpack.ifftshift(numpy.arange(nx) - numpy.floor(nx/2))
+    kerny = numpy.exp((-2j*numpy.pi/(ny*usfac)*(numpy.arange(noyx) - dftshift)[:, numpy.newaxis])*freqy[numpy.newaxis, :]).astype(dtype)
+    kernx = numpy.exp((-2j*numpy.pi/(nx*usfac)*(numpy.arange(noyx) - dftshift)[:, numpy.newaxis])*freqx[numpy.newaxis, :]).T.astype(dtype)
+    if not phase: return kerny, kernx, dftshift, usfac
+    return kerny, kernx, dftshift, usfac, -2j*numpy.pi/(ny*usfac)*freqy, -2j*numpy.pi/(nx*usfac)*freqx
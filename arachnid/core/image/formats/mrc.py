@@ -381,6 +381,42 @@ def is_volume(filename):
     else: h = read_mrc_header(filename)
     return h['nz'][0] == h['nx'][0] and h['nz'][0] == h['ny'][0]
 
+def read_layout(entry, no_strict_mrc=False):
+    ''' Decode the layout of an MRC file held in the handle cache
+    
+    The header is parsed once and the result is stored with the
+    cached file handle.
+    
+    :Parameters:
+    
+    entry : CachedFile
+            Open file returned by `util.open_cached`
+    no_strict_mrc : bool
+                    Perform strict MRC header checking (recommended) - Only
+                    EPU MRC files and Yifan's frame alignment require this
+                    to be off.
+    
+    :Returns:
+        
+    info : dict
+           Dictionary with the header array `h`, `dtype`, `count`, `swap`,
+           the data `offset` and expected file size `total`
+    '''
+    
+    info = entry.info.get('mrc')
+    if info is not None: return info
+    with entry.lock:
+        entry.fd.seek(0)
+        h = read_mrc_header(entry.fd, no_strict_mrc)
+    info = dict(h=h)
+    info['dtype'] = numpy.dtype(mrc2numpy[h['mode'][0]])
+    info['count'] = count_images(h)
+    info['offset'] = 1024+int(h['nsymbt'])
+    info['total'] = info['offset']+int(h['nx'][0])*int(h['ny'][0])*int(h['nz'][0])*info['dtype'].itemsize
+    info['swap'] = header_image_dtype.newbyteorder()[0]==h.dtype[0]
+    entry.info['mrc'] = info
+    return info
+
 def count_images(filename, no_strict_mrc=False):
     ''' Count the number of images in the file
     
@@ -400,6 +436,10 @@ def count_images(filename, no_strict_mrc=False):
     '''
     
     if hasattr(filename, 'dtype'): h=filename
+    elif util.is_cacheable(filename):
+        entry = util.open_cached(filename)
+        try: return read_layout(entry, no_strict_mrc)['count']
+        finally: util.release_cached(entry)
     else: h = read_mrc_header(filename, no_strict_mrc)
     return h['nz'][0]
 
@@ -425,36 +465,110 @@ def iter_images(filename, index=None, header=None, no_strict_mrc=False):
           Array with image information from the file
     '''
     
-    f = util.uopen(filename, 'rb')
+    entry = util.open_cached(filename)
     if index is None: index = 0
     try:
-        h = read_mrc_header(f, no_strict_mrc)
-        count = count_images(h)
-        #if header is not None:  util.update_header(header, h, mrc2ara, 'mrc')
-        tmp=read_header(h)
-        if header is not None: header.update(tmp)
+        info = read_layout(entry, no_strict_mrc)
+        h = info['h']
+        count = info['count']
+        if header is not None: header.update(read_header(h))
         d_len = h['nx'][0]*h['ny'][0]
-        dtype = numpy.dtype(mrc2numpy[h['mode'][0]])
-        offset = 1024+int(h['nsymbt'])+ 0 * d_len * dtype.itemsize
-        try:
-            f.seek(int(offset))
-        except:
-            _logger.error("%s -- %s"%(str(offset), str(offset.__class__.__name__)))
-            raise
+        dtype = info['dtype']
         if not hasattr(index, '__iter__'): index =  xrange(index, count)
         else: index = index.astype(numpy.int)
-        last = 0
-        total = file_size(f)
-        if total != (1024+int(h['nsymbt'])+int(h['nx'][0])*int(h['ny'][0])*int(h['nz'][0])*dtype.itemsize): raise util.InvalidHeaderException, "file size != header: %d != %d -- %d"%(total, (1024+int(h['nsymbt'])+int(h['nx'][0])*int(h['ny'][0])*int(h['nz'][0])*dtype.itemsize), int(h['nsymbt']))
+        total = entry.file_size()
+        if total != info['total']: raise util.InvalidHeaderException, "file size != header: %d != %d -- %d"%(total, info['total'], int(h['nsymbt']))
         for i in index:
-            if i != (last+1): f.seek(int(1024+int(h['nsymbt'])+ i * d_len * dtype.itemsize))
-            out = util.fromfile(f, dtype=dtype, count=d_len)
-            
+            out = entry.read(info['offset']+ i * d_len * dtype.itemsize, dtype, d_len)
             out = reshape_data(out, h, index, count)
-            if header_image_dtype.newbyteorder()[0]==h.dtype[0]: out = out.byteswap()
+            if info['swap']: out = out.byteswap()
             yield out
     finally:
-        util.close(filename, f)
+        util.release_cached(entry)
+
+def read_images(filename, index, out=None, rows=None, no_strict_mrc=False):
+    ''' Read a selection of images in any order from an MRC stack
+    
+    Images are read in order of their position in the file and consecutive
+    images are read together with a single read.
+    
+    :Parameters:
+    
+    filename : str or file object
+               Filename or open stream for a file
+    index : array
+            Indices of the images to read in any order
+    out : array, optional
+          Output array, if None, a new array is created
+    rows : array, optional
+           Row of `out` for each index, if None, rows follow `index`
+    no_strict_mrc : bool
+                    Perform strict MRC header checking (recommended) - Only
+                    EPU MRC files and Yifan's frame alignment require this
+                    to be off.
+    
+    :Returns:
+        
+    out : array
+          Array where each row is an image from the file
+    '''
+    
+    index = numpy.asarray(index, dtype=numpy.int64)
+    if rows is None: rows = numpy.arange(len(index))
+    entry = util.open_cached(filename)
+    try:
+        info = read_layout(entry, no_strict_mrc)
+        h = info['h']
+        count = info['count']
+        shape = (int(h['ny'][0]), int(h['nx'][0]))
+        if out is None: out = numpy.empty((len(index), )+shape, dtype=info['dtype'])
+        if len(index) == 0: return out
+        if index.min() < 0: raise ValueError, "Cannot have a negative index"
+        if index.max() >= count: raise IOError, "Index exceeds number of images in stack: %d < %d"%(index.max(), count)
+        total = entry.file_size()
+        if total != info['total']: raise util.InvalidHeaderException, "file size != header: %d != %d -- %d"%(total, info['total'], int(h['nsymbt']))
+        dtype = info['dtype'].newbyteorder() if info['swap'] else info['dtype']
+        d_len = shape[0]*shape[1]
+        for first, n, pos in util.coalesce_runs(index, d_len*dtype.itemsize):
+            block = entry.read(info['offset'] + first * d_len * dtype.itemsize, dtype, n*d_len)
+            out[rows[pos]] = block.reshape((n, )+shape)
+    finally:
+        util.release_cached(entry)
+    return out
+
+def mmap_stack(filename, no_strict_mrc=False):
+    ''' Map an MRC stack into memory without reading it
+    
+    Images are read from the OS page cache as they are accessed, which is
+    shared between processes mapping the same file.
+    
+    :Parameters:
+    
+    filename : str
+               Name of the file
+    no_strict_mrc : bool
+                    Perform strict MRC header checking (recommended) - Only
+                    EPU MRC files and Yifan's frame alignment require this
+                    to be off.
+    
+    :Returns:
+        
+    out : memmap
+          Read-only array of shape (nz, ny, nx)
+    '''
+    
+    if not util.is_cacheable(filename): raise ValueError, "Memory mapping requires the name of an uncompressed file"
+    entry = util.open_cached(filename)
+    try:
+        info = read_layout(entry, no_strict_mrc)
+        h = info['h']
+        total = entry.file_size()
+        if total != info['total']: raise util.InvalidHeaderException, "file size != header: %d != %d -- %d"%(total, info['total'], int(h['nsymbt']))
+        dtype = info['dtype'].newbyteorder() if info['swap'] else info['dtype']
+        shape = (int(h['nz'][0]), int(h['ny'][0]), int(h['nx'][0]))
+        return numpy.memmap(entry.filename, dtype=dtype, mode='r', offset=info['offset'], shape=shape)
+    finally:
+        util.release_cached(entry)
 
 def valid_image(filename, no_strict_mrc=False):
     ''' Test if the image is valid
@@ -508,30 +622,27 @@ def read_image(filename, index=None, header=None, cache=None, no_strict_mrc=Fals
     '''
     
     idx = 0 if index is None else index
-    f = util.uopen(filename, 'rb')
+    entry = util.open_cached(filename)
     try:
-        h = read_mrc_header(f, no_strict_mrc)
-        #if header is not None: util.update_header(header, h, mrc2ara, 'mrc')
-        tmp = read_header(h, force_volume=force_volume)
-        if header is not None: header.update(tmp)
-        count = count_images(h)
+        info = read_layout(entry, no_strict_mrc)
+        h = info['h']
+        if header is not None: header.update(read_header(h, force_volume=force_volume))
+        count = info['count']
         if idx >= count: raise IOError, "Index exceeds number of images in stack: %d < %d"%(idx, count)
         if index is None and (count == h['nx'][0] or force_volume):
             d_len = h['nx'][0]*h['ny'][0]*h['nz'][0]
         else:
             d_len = h['nx'][0]*h['ny'][0]
-        dtype = numpy.dtype(mrc2numpy[h['mode'][0]])
-        offset = 1024+int(h['nsymbt']) + idx * d_len * dtype.itemsize
-        total = file_size(f)
-        if total != (1024+int(h['nsymbt'])+int(h['nx'][0])*int(h['ny'][0])*int(h['nz'][0])*dtype.itemsize): raise util.InvalidHeaderException, "file size != header: %d != %d -- %s, %d"%(total, (1024+int(h['nsymbt'])+int(h['nx'][0])*int(h['ny'][0])*int(h['nz'][0])*dtype.itemsize), str(idx), int(h['nsymbt']))
-        f.seek(int(offset))
-        out = util.fromfile(f, dtype=dtype, count=d_len)
+        dtype = info['dtype']
+        offset = info['offset'] + idx * d_len * dtype.itemsize
+        total = entry.file_size()
+        if total != info['total']: raise util.InvalidHeaderException, "file size != header: %d != %d -- %s, %d"%(total, info['total'], str(idx), int(h['nsymbt']))
+        out = entry.read(offset, dtype, d_len)
         out = reshape_data(out, h, index, count, force_volume)
-        if header_image_dtype.newbyteorder()[0]==h.dtype[0]: out = out.byteswap()
+        if info['swap']: out = out.byteswap()
     finally:
-        util.close(filename, f)
+        util.release_cached(entry)
     #assert(numpy.alltrue(numpy.logical_not(numpy.isnan(out))))
-    #if header_image_dtype.newbyteorder()==h.dtype:out = out.byteswap()
     return out
 
 def reshape_data(out, h, index, count, force_volume=False):
@@ -594,6 +705,69 @@ def is_writable(filename):
            ext == 'ccp4' or \
            ext == 'map'
 
+def _image_header(img, header=None, index=None):
+    ''' Create an MRC header describing the given image
+    
+    :Parameters:
+    
+    img : array
+          Image array
+    header : dict, optional
+             Dictionary of header values
+    index : int, optional
+            Index to write image in the stack
+    
+    :Returns:
+    
+    header : array
+             Header array of type `header_image_dtype`
+    '''
+    
+    h = numpy.zeros(1, header_image_dtype)
+    util.update_header(h, mrc_defaults, ara2mrc)
+    pix = header.get('apix', 1.0) if header is not None else 1.0
+    header=util.update_header(h, header, ara2mrc, 'mrc')
+    header['nx'] = img.T.shape[0]
+    header['ny'] = img.T.shape[1] if img.ndim > 1 else 1
+    if header['nz'] == 0:
+        header['nz'] = img.shape[2] if img.ndim > 2 else 1
+    header['mode'] = numpy2mrc[img.dtype.type]
+    header['mx'] = header['nx']
+    header['my'] = header['ny']
+    header['mz'] = header['nz']
+    header['xlen'] = header['nx']*pix
+    header['ylen'] = header['ny']*pix
+    header['zlen'] = header['nz']*pix
+    header['alpha'] = 90
+    header['beta'] = 90
+    header['gamma'] = 90
+    header['mapc'] = 1
+    header['mapr'] = 2
+    header['maps'] = 3
+    header['amin'] = numpy.min(img)
+    header['amax'] = numpy.max(img)
+    header['amean'] = numpy.mean(img)
+    
+    header['map'] = 'MAP'
+    header['byteorder'] = byteorderint2[sys.byteorder] #'DA\x00\x00'
+    header['nlabels'] = 1
+    header['label0'] = 'Created by Arachnid'
+    
+    #header['byteorder'] = numpy.fromstring('\x44\x41\x00\x00', dtype=header['byteorder'].dtype)
+    
+    #header['rms'] = numpy.std(img)
+    if img.ndim == 3:
+        header['nxstart'] = header['nx'] / -2
+        header['nystart'] = header['ny'] / -2
+        header['nzstart'] = header['nz'] / -2
+    if index is not None:
+        stack_count = index+1
+        header['nz'] = stack_count
+        header['mz'] = stack_count
+        header['zlen'] = stack_count
+        #header['zorigin'] = stack_count/2.0
+    return header
+
 def write_image(filename, img, index=None, header=None, inplace=False):
     ''' Write an image array to a file in the MRC format
     
@@ -619,49 +793,7 @@ def write_image(filename, img, index=None, header=None, inplace=False):
     mode = 'rb+' if index is not None and (index > 0 or inplace and index > -1) else 'wb+'
     f = util.uopen(filename, mode)
     if header is None or not hasattr(header, 'dtype') or not is_format_header(header):
-        h = numpy.zeros(1, header_image_dtype)
-        util.update_header(h, mrc_defaults, ara2mrc)
-        pix = header.get('apix', 1.0) if header is not None else 1.0
-        header=util.update_header(h, header, ara2mrc, 'mrc')
-        header['nx'] = img.T.shape[0]
-        header['ny'] = img.T.shape[1] if img.ndim > 1 else 1
-        if header['nz'] == 0:
-            header['nz'] = img.shape[2] if img.ndim > 2 else 1
-        header['mode'] = numpy2mrc[img.dtype.type]
-        header['mx'] = header['nx']
-        header['my'] = header['ny']
-        header['mz'] = header['nz']
-        header['xlen'] = header['nx']*pix
-        header['ylen'] = header['ny']*pix
-        header['zlen'] = header['nz']*pix
-        header['alpha'] = 90
-        header['beta'] = 90
-        header['gamma'] = 90
-        header['mapc'] = 1
-        header['mapr'] = 2
-        header['maps'] = 3
-        header['amin'] = numpy.min(img)
-        header['amax'] = numpy.max(img)
-        header['amean'] = numpy.mean(img)
-        
-        header['map'] = 'MAP'
-        header['byteorder'] = byteorderint2[sys.byteorder] #'DA\x00\x00'
-        header['nlabels'] = 1
-        header['label0'] = 'Created by Arachnid'
-        
-        #header['byteorder'] = numpy.fromstring('\x44\x41\x00\x00', dtype=header['byteorder'].dtype)
-        
-        #header['rms'] = numpy.std(img)
-        if img.ndim == 3:
-            header['nxstart'] = header['nx'] / -2
-            header['nystart'] = header['ny'] / -2
-            header['nzstart'] = header['nz'] / -2
-        if index is not None:
-            stack_count = index+1
-            header['nz'] = stack_count
-            header['mz'] = stack_count
-            header['zlen'] = stack_count
-            #header['zorigin'] = stack_count/2.0
+        h = header = _image_header(img, header, index)
     
     try:
         if inplace:
@@ -673,8 +805,95 @@ def write_image(filename, img, index=None, header=None, inplace=False):
         img.tofile(f)
     finally:
         util.close(filename, f)
-        
+        util.invalidate_cache(filename)
 
+class StackWriter(util.StackWriter):
+    ''' Write a stack of images in the MRC format through a single open file
+    
+    Images are appended with a single buffered write per block and the
+    header, including the image count and pixel statistics over the whole
+    stack, is written once when the writer is closed.
+    
+    :Parameters:
+    
+    filename : str
+               Name of the output file
+    header : dict, optional
+             Dictionary of header values
+    index : int
+            Index of the first image to write, if greater than zero,
+            the stack is extended rather than overwritten
+    count : int, optional
+            Expected number of images in the stack used to preallocate the file
+    '''
+    
+    def open(self, img):
+        ''' Open the output file and prepare the header for the given image
+        
+        :Parameters:
+        
+        img : array
+              First image to be written
+        '''
+        
+        header = self.header
+        if header is None and hasattr(img, 'header'): header=img.header
+        try: self.dtype = numpy.dtype(mrc2numpy[numpy2mrc[img.dtype.type]])
+        except:
+            raise TypeError, "Unsupported type for MRC writing: %s"%str(img.dtype)
+        self.shape = img.shape
+        if header is None or not hasattr(header, 'dtype') or not is_format_header(header):
+            header = _image_header(img.astype(self.dtype), header, 0)
+        self.h = header
+        self.offset = 1024+int(header['nsymbt'])
+        self.imgsize = img.size*self.dtype.itemsize
+        self.nz = 0
+        self.stats = None
+        mode = 'rb+' if self.index > 0 else 'wb+'
+        self.fd = util.uopen(self.filename, mode)
+        if self.index > 0:
+            h = read_mrc_header(self.fd)
+            self.nz = int(h['nz'][0])
+            self.stats = (float(h['amin'][0]), float(h['amax'][0]), float(h['amean'][0])*self.nz, self.nz)
+        if self.count is not None:
+            size = self.offset + (self.index+self.count) * self.imgsize
+            if file_size(self.fd) < size: self.fd.truncate(size)
+    
+    def write_data(self, imgs):
+        ''' Write a block of images at the current index
+        
+        :Parameters:
+        
+        imgs : array
+               Array of images where the first dimension indexes the image
+        '''
+        
+        if imgs.shape[1:] != self.shape: raise ValueError, "Image shape does not match stack: %s != %s"%(str(imgs.shape[1:]), str(self.shape))
+        imgs = numpy.ascontiguousarray(imgs, dtype=self.dtype)
+        stats = (float(imgs.min()), float(imgs.max()), float(imgs.sum(dtype=numpy.float64))/imgs[0].size, len(imgs))
+        if self.stats is not None:
+            stats = (min(stats[0], self.stats[0]), max(stats[1], self.stats[1]), stats[2]+self.stats[2], stats[3]+self.stats[3])
+        self.stats = stats
+        self.fd.seek(self.offset + self.index * self.imgsize)
+        imgs.tofile(self.fd)
+    
+    def finalize(self):
+        ''' Write the stack header
+        '''
+        
+        header = self.h
+        stack_count = max(self.nz, self.index)
+        header['nz'] = stack_count
+        header['mz'] = stack_count
+        header['zlen'] = stack_count
+        if self.stats is not None:
+            header['amin'] = self.stats[0]
+            header['amax'] = self.stats[1]
+            header['amean'] = self.stats[2]/max(self.stats[3], 1)
+        if self.count is not None:
+            self.fd.truncate(self.offset + stack_count * self.imgsize)
+        self.fd.seek(0)
+        header.tofile(self.fd)
 
 if __name__ == '__main__':
     
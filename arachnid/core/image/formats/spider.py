@@ -214,7 +214,7 @@ def read_spider_header(filename, index=None):
     f = util.uopen(filename, 'rb')
     try:
         #curr = f.tell()
-        h = numpy.fromfile(f, dtype=header_dtype, count=1)
+        h = util.fromfile(f, dtype=header_dtype, count=1)
         if not is_readable(h):
             h = h.newbyteorder()
         if not is_readable(h): raise IOError, "Not a SPIDER file"
@@ -232,7 +232,7 @@ def read_spider_header(filename, index=None):
             except:
                 _logger.error("Offset: %s"%str(offset))
                 raise
-            h = numpy.fromfile(f, dtype=h.dtype, count=1)
+            h = util.fromfile(f, dtype=h.dtype, count=1)
     finally:
         util.close(filename, f)
     return h
@@ -265,6 +265,72 @@ def valid_image(filename):
     finally:
         util.close(filename, f)
 
+def read_layout(entry):
+    ''' Decode the layout of a SPIDER file held in the handle cache
+    
+    The header is parsed once and the result is stored with the
+    cached file handle.
+    
+    :Parameters:
+    
+    entry : CachedFile
+            Open file returned by `util.open_cached`
+    
+    :Returns:
+        
+    info : dict
+           Dictionary with the header array `h`, `dtype`, `shape`, `swap` and
+           the header, data and image lengths in bytes
+    '''
+    
+    info = entry.info.get('spider')
+    if info is not None: return info
+    with entry.lock:
+        entry.fd.seek(0)
+        h = read_spider_header(entry.fd)
+    info = dict(h=h)
+    info['dtype'] = numpy.dtype(spi2numpy[float(h['iform'])])
+    info['header'] = read_header(h)
+    info['h_len'] = int(h['labbyt'])
+    info['d_len'] = int(h['nx']) * int(h['ny']) * int(h['nz'])
+    info['i_len'] = info['d_len'] * 4
+    info['count'] = count_images(h)
+    info['istack'] = int(h['istack'])
+    info['swap'] = header_dtype.newbyteorder()[0]==h.dtype[0]
+    if int(h['nz']) > 1:   info['shape'] = (int(h['nz']), int(h['ny']), int(h['nx']))
+    elif int(h['ny']) > 1: info['shape'] = (int(h['ny']), int(h['nx']))
+    else:                  info['shape'] = None
+    entry.info['spider'] = info
+    return info
+
+def _read_data(entry, info, offset):
+    ''' Read a single image at the given offset
+    
+    :Parameters:
+    
+    entry : CachedFile
+            Open file returned by `util.open_cached`
+    info : dict
+           Layout returned by `read_layout`
+    offset : int
+             Absolute byte offset of the image data
+    
+    :Returns:
+        
+    out : array
+          Array with image information from the file
+    '''
+    
+    out = entry.read(offset, info['dtype'], info['d_len'])
+    if info['swap']: out = out.byteswap()
+    if info['shape'] is not None:
+        try:
+            out = out.reshape(info['shape'])
+        except:
+            _logger.error("%s == %d != %d"%(str(info['shape']), numpy.prod(info['shape']), out.ravel().shape[0]))
+            raise
+    return out
+
 def read_image(filename, index=None, header=None):
     ''' Read an image from the specified file in the SPIDER format
     
@@ -283,53 +349,34 @@ def read_image(filename, index=None, header=None):
           Array with image information from the file
     '''
     
-    f = util.uopen(filename, 'rb')
-    h = None
+    entry = util.open_cached(filename)
     try:
         if index is None: index = 0
-        h = read_spider_header(f)
-        dtype = numpy.dtype(spi2numpy[float(h['iform'])])
-        #if header_dtype.newbyteorder()==h.dtype: dtype = dtype.newbyteorder() # - changed
-        #if header is not None: util.update_header(header, h, spi2ara, 'spi')
-        tmp=read_header(h)
-        if header is not None: header.update(tmp)
-        
-        h_len = int(h['labbyt'])
-        d_len = int(h['nx']) * int(h['ny']) * int(h['nz'])
-        i_len = d_len * 4
+        info = read_layout(entry)
+        h = info['h']
+        if header is not None: header.update(info['header'])
         
-        count = count_images(h)
+        h_len = info['h_len']
+        i_len = info['i_len']
+        count = info['count']
         
         if index >= count: raise IOError, "Index exceeds number of images in stack: %d < %d"%(index, count)
         
-        if count > 1 and int(h['istack']) == 0: raise ValueError, "Improperly formatted SPIDER header - not stack but contains mutliple images"
-        offset = h_len*2 + index * (h_len+i_len) if int(h['istack']) > 0 else h_len
-        if count > 1 or h['istack'] == 2:
-            if file_size(f) != (h_len + count * (h_len+i_len)): 
-                raise ValueError, "file size != header: %d != %d - count: %d -- nx:%d,ny:%d,nz:%d"%(file_size(f), (h_len + count * (h_len+i_len)), count, int(h['nx']), int(h['ny']), int(h['nz']))
+        if count > 1 and info['istack'] == 0: raise ValueError, "Improperly formatted SPIDER header - not stack but contains mutliple images"
+        offset = h_len*2 + index * (h_len+i_len) if info['istack'] > 0 else h_len
+        size = entry.file_size()
+        if count > 1 or info['istack'] == 2:
+            if size != (h_len + count * (h_len+i_len)): 
+                raise ValueError, "file size != header: %d != %d - count: %d -- nx:%d,ny:%d,nz:%d"%(size, (h_len + count * (h_len+i_len)), count, int(h['nx']), int(h['ny']), int(h['nz']))
         else:
-            if file_size(f) != (h_len + count * i_len): 
-                f.seek(h_len + index * (h_len+i_len))
-                h2 = read_spider_header(f)
-                raise ValueError, "file size != header: %d != %d - %d + %d * %d -- %d,%d == %d,%d -- count: "%(file_size(f), (h_len + count * i_len), h_len, count, i_len, int(h['istack']), int(h['imgnum']), int(h2['istack']), int(h2['imgnum']), int(h['maxim'])  )
-        try:
-            f.seek(offset)
-        except:
-            _logger.error("Offset: %s"%str(offset))
-            raise
-        out = numpy.fromfile(f, dtype=dtype, count=d_len)
-        if header_dtype.newbyteorder()[0]==h.dtype[0]: out = out.byteswap()
-        #assert(out.ravel().shape[0]==d_len)
-        if int(h['nz']) > 1:   out = out.reshape(int(h['nz']), int(h['ny']), int(h['nx']))
-        elif int(h['ny']) > 1: 
-            try:
-                out = out.reshape(int(h['ny']), int(h['nx']))
-            except:
-                _logger.error("%d != %d*%d = %d"%(out.ravel().shape[0], int(h['nx']), int(h['ny']), int(h['nx'])*int(h['ny'])))
-                raise
+            if size != (h_len + count * i_len): 
+                with entry.lock:
+                    entry.fd.seek(h_len + index * (h_len+i_len))
+                    h2 = read_spider_header(entry.fd)
+                raise ValueError, "file size != header: %d != %d - %d + %d * %d -- %d,%d == %d,%d -- count: "%(size, (h_len + count * i_len), h_len, count, i_len, int(h['istack']), int(h['imgnum']), int(h2['istack']), int(h2['imgnum']), int(h['maxim'])  )
+        out = _read_data(entry, info, offset)
     finally:
-        util.close(filename, f)
-    #if header_image_dtype.newbyteorder()==h.dtype:out = out.byteswap()
+        util.release_cached(entry)
     return out
 
 def iter_images(filename, index=None, header=None):
@@ -350,81 +397,138 @@ def iter_images(filename, index=None, header=None):
           Array with image information from the file
     '''
     
-    f = util.uopen(filename, 'rb')
+    entry = util.open_cached(filename)
     if index is None: index = 0
     try:
-        h = read_spider_header(f)
-        dtype = numpy.dtype(spi2numpy[float(h['iform'])])
-        #if header_dtype.newbyteorder()==h.dtype: dtype = dtype.newbyteorder()
-        #if header is not None: util.update_header(header, h, spi2ara, 'spi')
-        tmp=read_header(h)
-        if header is not None:  header.update(tmp)
-        h_len = int(h['labbyt'])
-        d_len = int(h['nx']) * int(h['ny']) * int(h['nz'])
-        i_len = d_len * 4
-        count = count_images(h)
+        info = read_layout(entry)
+        h = info['h']
+        if header is not None:  header.update(info['header'])
+        h_len = info['h_len']
+        i_len = info['i_len']
+        count = info['count']
         if numpy.any(index >= count):  raise IOError, "Index exceeds number of images in stack: %s < %d"%(str(index), count)
-        #offset = h_len + 0 * (h_len+i_len)
         
-        size = ( h_len + count * (h_len+i_len) ) if int(h['istack']) > 0 else (h_len + i_len)
+        size = ( h_len + count * (h_len+i_len) ) if info['istack'] > 0 else (h_len + i_len)
         
-        if file_size(f) != size:
-            raise ValueError, "file size != header: %d != %d - %d -- %d,%d,%d"%(file_size(f), (h_len + count * (h_len+i_len)), count, int(h['nx']), int(h['ny']), int(h['nz']))
-        try:
-            f.seek(h_len)
-        except:
-            _logger.error("Offset: %s"%str(h_len))
-            raise
-        if int(h['istack']) == 0: # This file contains a single image!
-            out = numpy.fromfile(f, dtype=dtype, count=d_len)
-            if header_dtype.newbyteorder()[0]==h.dtype[0]: out = out.byteswap()
-            if int(h['nz']) > 1:    out = out.reshape(int(h['nz']), int(h['ny']), int(h['nx']))
-            elif int(h['ny']) > 1:  out = out.reshape(int(h['ny']), int(h['nx']))
-            yield out
+        if entry.file_size() != size:
+            raise ValueError, "file size != header: %d != %d - %d -- %d,%d,%d"%(entry.file_size(), (h_len + count * (h_len+i_len)), count, int(h['nx']), int(h['ny']), int(h['nz']))
+        if info['istack'] == 0: # This file contains a single image!
+            yield _read_data(entry, info, h_len)
             return
         
         if not hasattr(index, '__iter__'): index =  xrange(index, count)
         else: index = index.astype(numpy.int)
-        last=-1
-        if count > 1 and int(h['istack']) == 0: raise ValueError, "Improperly formatted SPIDER header - not stack but contains mutliple images"
         
         for i in index:
             if i < 0: raise ValueError, "Cannot have a negative index"
-            if i != (last+1): 
-                offset = h_len*2 + i * (h_len+i_len)
-                try:
-                    f.seek(int(offset))
-                except:
-                    _logger.error("Offset: %s"%str(offset))
-                    _logger.error("i: %s"%str(i))
-                    raise
-            else: 
-                f.seek(h_len, 1)
-            last=i
-            out = numpy.fromfile(f, dtype=dtype, count=d_len)
-            if header_dtype.newbyteorder()[0]==h.dtype[0]: out = out.byteswap()
-            if int(h['nz']) > 1:   
-                try:
-                    out = out.reshape(int(h['nz']), int(h['ny']), int(h['nx']))
-                except:
-                    _logger.error("%d, %d, %d == %d == %d", int(h['nz']), int(h['ny']), int(h['nx']), numpy.prod((int(h['nz']), int(h['ny']), int(h['nx']))), out.shape[0])
-                    raise
-            elif int(h['ny']) > 1: 
-                try:
-                    out = out.reshape(int(h['ny']), int(h['nx']))
-                except:
-                    _logger.error("(%d < %d) -- %d, %d == %d == %d", i, count, int(h['ny']), int(h['nx']), numpy.prod((int(h['ny']), int(h['nx']))), out.shape[0])
-                    raise
+            offset = h_len*2 + i * (h_len+i_len)
+            try:
+                out = _read_data(entry, info, offset)
+            except:
+                _logger.error("Offset: %s"%str(offset))
+                _logger.error("(%d < %d)"%(i, count))
+                raise
             yield out
     finally:
-        util.close(filename, f)
+        util.release_cached(entry)
+
+def read_images(filename, index, out=None, rows=None):
+    ''' Read a selection of images in any order from a SPIDER stack
+    
+    Images are read in order of their position in the file and consecutive
+    images are read together, header and all, with a single read.
+    
+    :Parameters:
+    
+    filename : str or file object
+               Filename or open stream for a file
+    index : array
+            Indices of the images to read in any order
+    out : array, optional
+          Output array, if None, a new array is created
+    rows : array, optional
+           Row of `out` for each index, if None, rows follow `index`
+    
+    :Returns:
+        
+    out : array
+          Array where each row is an image from the file
+    '''
+    
+    index = numpy.asarray(index, dtype=numpy.int64)
+    if rows is None: rows = numpy.arange(len(index))
+    entry = util.open_cached(filename)
+    try:
+        info = read_layout(entry)
+        h = info['h']
+        h_len = info['h_len']
+        i_len = info['i_len']
+        count = info['count']
+        shape = info['shape'] if info['shape'] is not None else (info['d_len'], )
+        if out is None: out = numpy.empty((len(index), )+shape, dtype=info['dtype'])
+        if len(index) == 0: return out
+        if index.min() < 0: raise ValueError, "Cannot have a negative index"
+        if index.max() >= count: raise IOError, "Index exceeds number of images in stack: %d < %d"%(index.max(), count)
+        if info['istack'] == 0:
+            out[rows] = _read_data(entry, info, h_len)
+            return out
+        size = h_len + count * (h_len+i_len)
+        if entry.file_size() != size:
+            raise ValueError, "file size != header: %d != %d - %d -- %d,%d,%d"%(entry.file_size(), size, count, int(h['nx']), int(h['ny']), int(h['nz']))
+        dtype = info['dtype'].newbyteorder() if info['swap'] else info['dtype']
+        record = numpy.dtype([('header', 'V%d'%h_len), ('data', dtype, shape)])
+        for first, n, pos in util.coalesce_runs(index, record.itemsize):
+            block = entry.read(h_len + first * (h_len+i_len), record, n)['data']
+            out[rows[pos]] = block
+    finally:
+        util.release_cached(entry)
+    return out
+
+def mmap_stack(filename):
+    ''' Map a SPIDER stack into memory without reading it
+    
+    The SPIDER format places a header before every image in a stack, so the
+    returned array is a strided view over the file that skips these headers.
+    Images are read from the OS page cache as they are accessed, which is
+    shared between processes mapping the same file.
+    
+    :Parameters:
+    
+    filename : str
+               Name of the file
+    
+    :Returns:
+        
+    out : memmap
+          Read-only array of shape (count, ny, nx) or (count, nz, ny, nx)
+    '''
+    
+    if not util.is_cacheable(filename): raise ValueError, "Memory mapping requires the name of an uncompressed file"
+    entry = util.open_cached(filename)
+    try:
+        info = read_layout(entry)
+        h = info['h']
+        h_len = info['h_len']
+        i_len = info['i_len']
+        count = info['count']
+        size = ( h_len + count * (h_len+i_len) ) if info['istack'] > 0 else (h_len + i_len)
+        if entry.file_size() != size:
+            raise ValueError, "file size != header: %d != %d - %d -- %d,%d,%d"%(entry.file_size(), size, count, int(h['nx']), int(h['ny']), int(h['nz']))
+        dtype = info['dtype'].newbyteorder() if info['swap'] else info['dtype']
+        shape = info['shape'] if info['shape'] is not None else (info['d_len'], )
+        if info['istack'] == 0:
+            return numpy.memmap(entry.filename, dtype=dtype, mode='r', offset=h_len, shape=(1, )+shape)
+        record = numpy.dtype([('header', 'V%d'%h_len), ('data', dtype, shape)])
+        return numpy.memmap(entry.filename, dtype=record, mode='r', offset=h_len, shape=(count, ))['data']
+    finally:
+        util.release_cached(entry)
 
 def count_images(filename):
     ''' Count the number of images in the file
     
     :Parameters:
     
-    filename : str or file objectfou
+    filename : str or file object
                Filename or open stream for a file
     
     :Returns:
@@ -434,6 +538,10 @@ def count_images(filename):
     '''
     
     if hasattr(filename, 'dtype'): h=filename
+    elif util.is_cacheable(filename):
+        entry = util.open_cached(filename)
+        try: return read_layout(entry)['count']
+        finally: util.release_cached(entry)
     else: h = read_spider_header(filename)
     return max(int(h['maxim'][0]), 1)
 
@@ -455,6 +563,75 @@ def is_writable(filename):
     ext = os.path.splitext(filename)[1][1:].lower()
     return ext == 'spi'
 
+def _image_header(img, header=None):
+    ''' Create a SPIDER header describing the given image
+    
+    :Parameters:
+    
+    img : array
+          Image array
+    header : dict, optional
+             Dictionary of header values
+    
+    :Returns:
+    
+    header : array
+             Header array of type `header_dtype`
+    '''
+    
+    h = numpy.zeros(1, header_dtype)
+    even = header['fourier_even'] if header is not None and 'fourier_even' in header else None
+    util.update_header(h, spi_defaults, ara2spi)
+    header=util.update_header(h, header, ara2spi, 'spi')
+    
+    # Image size in header
+    header['nx'] = img.T.shape[0]
+    header['ny'] = img.T.shape[1] if img.ndim > 1 else 1
+    header['nz'] = img.T.shape[2] if img.ndim > 2 else 1
+    
+    header['lenbyt'] = img.shape[0]*4
+    header['labrec'] = 1024 / int(header['lenbyt'])
+    if 1024%int(header['lenbyt']) != 0: 
+        header['labrec'] = int(header['labrec'])+1
+    header['labbyt'] = int(header['labrec'] ) * int(header['lenbyt'])
+    header['irec'] = header['labrec']+header['nx']
+    
+    # 
+    #header['irec']
+    if numpy.iscomplexobj(img):
+        header['iform'] = 3 if img.ndim == 3 else 1
+        # determine even or odd Fourier - assumes other dim are padded appropriately
+        if even is None:
+            v = int(round(float(img.shape[1])/img.shape[0]))
+            v = img.shape[1]/v
+            even = (v%2)==0
+        if even:
+            header['iform'] = -22  if img.ndim == 3 else -12 
+        else:
+            header['iform'] = -21  if img.ndim == 3 else -11 
+    else:
+        header['iform'] = 3 if img.ndim == 3 else 1 
+    return header
+
+def _header_record(header):
+    ''' Layout the header values as a record of the size of the header
+    
+    :Parameters:
+    
+    header : array
+             Header array of type `header_dtype`
+    
+    :Returns:
+    
+    fheader : array
+              Header record as written to the file
+    '''
+    
+    fheader = numpy.zeros(int(header['labbyt'])/4, dtype=numpy.float32)
+    for name, idx in _header_map.iteritems(): 
+        fheader[idx-1]=float(header[name])
+    return fheader
+
 def write_image(filename, img, index=None, header=None, inplace=False):
     ''' Write an image array to a file in the MRC format
     
@@ -488,44 +665,11 @@ def write_image(filename, img, index=None, header=None, inplace=False):
         raise
     try:
         if header is None or not hasattr(header, 'dtype') or not is_format_header(header):
-            h = numpy.zeros(1, header_dtype)
-            even = header['fourier_even'] if header is not None and 'fourier_even' in header else None
-            util.update_header(h, spi_defaults, ara2spi)
-            header=util.update_header(h, header, ara2spi, 'spi')
-            
-            # Image size in header
-            header['nx'] = img.T.shape[0]
-            header['ny'] = img.T.shape[1] if img.ndim > 1 else 1
-            header['nz'] = img.T.shape[2] if img.ndim > 2 else 1
-            
-            header['lenbyt'] = img.shape[0]*4
-            header['labrec'] = 1024 / int(header['lenbyt'])
-            if 1024%int(header['lenbyt']) != 0: 
-                header['labrec'] = int(header['labrec'])+1
-            header['labbyt'] = int(header['labrec'] ) * int(header['lenbyt'])
-            imgsize = img.ravel().shape[0]*4
-            headsize = int(header['labbyt'])
-            header['irec'] = header['labrec']+header['nx']
-            
-            # 
-            #header['irec']
-            if numpy.iscomplexobj(img):
-                header['iform'] = 3 if img.ndim == 3 else 1
-                # determine even or odd Fourier - assumes other dim are padded appropriately
-                if even is None:
-                    v = int(round(float(img.shape[1])/img.shape[0]))
-                    v = img.shape[1]/v
-                    even = (v%2)==0
-                if even:
-                    header['iform'] = -22  if img.ndim == 3 else -12 
-                else:
-                    header['iform'] = -21  if img.ndim == 3 else -11 
-            else:
-                header['iform'] = 3 if img.ndim == 3 else 1 
+            header = _image_header(img, header)
+        imgsize = img.ravel().shape[0]*4
+        headsize = int(header['labbyt'])
         
-        fheader = numpy.zeros(int(header['labbyt'])/4, dtype=numpy.float32)
-        for name, idx in _header_map.iteritems(): 
-            fheader[idx-1]=float(header[name])
+        fheader = _header_record(header)
         
         if inplace:
             f.seek(index * (imgsize + headsize)+headsize+headsize)
@@ -544,7 +688,93 @@ def write_image(filename, img, index=None, header=None, inplace=False):
         img.tofile(f)
     finally:
         util.close(filename, f)
+        util.invalidate_cache(filename)
 
+class StackWriter(util.StackWriter):
+    ''' Write a stack of images in the SPIDER format through a single open file
+    
+    Each image is written with its own header in a single buffered write
+    and the overall stack header is written once when the writer is closed.
+    
+    :Parameters:
+    
+    filename : str
+               Name of the output file
+    header : dict, optional
+             Dictionary of header values
+    index : int
+            Index of the first image to write, if greater than zero,
+            the stack is extended rather than overwritten
+    count : int, optional
+            Expected number of images in the stack used to preallocate the file
+    '''
+    
+    def open(self, img):
+        ''' Open the output file and prepare the header for the given image
+        
+        :Parameters:
+        
+        img : array
+              First image to be written
+        '''
+        
+        header = self.header
+        if header is None and hasattr(img, 'header'): header=img.header
+        self.dtype = numpy.complex64 if numpy.iscomplexobj(img) else numpy.float32
+        self.shape = img.shape
+        if header is None or not hasattr(header, 'dtype') or not is_format_header(header):
+            header = _image_header(img, header)
+        self.fheader = _header_record(header)
+        self.fheader[_header_map['istack']-1] = 0
+        self.fheader[_header_map['maxim']-1] = 0
+        self.headsize = int(header['labbyt'])
+        self.imgsize = img.size*numpy.dtype(self.dtype).itemsize
+        self.maxim = 0
+        mode = 'rb+' if self.index > 0 else 'wb+'
+        try:
+            self.fd = util.uopen(self.filename, mode)
+        except:
+            _logger.error("Mode: %s - Index: %s"%(str(mode), str(self.index)))
+            raise
+        if self.index > 0:
+            self.maxim = count_images(read_spider_header(self.fd))
+        if self.count is not None:
+            size = self.headsize + (self.index+self.count) * (self.imgsize + self.headsize)
+            if file_size(self.fd) < size: self.fd.truncate(size)
+    
+    def write_data(self, imgs):
+        ''' Write a block of images at the current index
+        
+        :Parameters:
+        
+        imgs : array
+               Array of images where the first dimension indexes the image
+        '''
+        
+        if imgs.shape[1:] != self.shape: raise ValueError, "Image shape does not match stack: %s != %s"%(str(imgs.shape[1:]), str(self.shape))
+        try: imgs = imgs.astype(self.dtype)
+        except: raise TypeError, "Unsupported type for SPIDER writing: %s"%str(imgs.dtype)
+        n = len(imgs)
+        hlen = self.fheader.shape[0]
+        buf = numpy.empty((n, hlen+self.imgsize/4), dtype=numpy.float32)
+        buf[:, :hlen] = self.fheader
+        buf[:, _header_map['imgnum']-1] = numpy.arange(self.index+1, self.index+n+1)
+        buf[:, hlen:] = imgs.reshape((n, -1)).view(numpy.float32)
+        self.fd.seek(self.index * (self.imgsize + self.headsize)+self.headsize)
+        buf.tofile(self.fd)
+    
+    def finalize(self):
+        ''' Write the stack header
+        '''
+        
+        fheader = self.fheader.copy()
+        fheader[_header_map['maxim']-1] = max(self.maxim, self.index)
+        fheader[_header_map['imgnum']-1] = max(self.maxim, self.index)
+        fheader[_header_map['istack']-1] = 2
+        if self.count is not None:
+            self.fd.truncate(self.headsize + max(self.maxim, self.index) * (self.imgsize + self.headsize))
+        self.fd.seek(0)
+        fheader.tofile(self.fd)
 
 def file_size(fileobject):
     fileobject.seek(0,2) # move the cursor to the end of the file
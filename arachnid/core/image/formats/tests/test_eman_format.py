@@ -26,10 +26,12 @@ def test_is_readable():
     '''
     '''
     
-    empty_image = numpy.zeros((78,78))
-    eman_format.write_image(test_file, empty_image)
-    assert(eman_format.is_readable(test_file))
-    os.unlink(test_file)
+    try:
+        empty_image = numpy.zeros((78,78))
+        eman_format.write_image(test_file, empty_image)
+        assert(eman_format.is_readable(test_file))
+    finally:
+        if os.path.exists(test_file): os.unlink(test_file)
 
 def test_read_header():
     '''
@@ -41,31 +43,37 @@ def test_iter_images():
     '''
     '''
     
-    empty_image = numpy.zeros((78,78))
-    empty_image2 = numpy.ones((78,78))
-    eman_format.write_image(test_file, empty_image)#, 0)
-    #eman_format.write_image(test_file, empty_image2, 1)
-    for i, img in enumerate(eman_format.iter_images(test_file)):
-        ref = empty_image if i == 0 else empty_image2
-        numpy.testing.assert_allclose(ref, img)
-    os.unlink(test_file)
+    try:
+        empty_image = numpy.zeros((78,78))
+        empty_image2 = numpy.ones((78,78))
+        eman_format.write_image(test_file, empty_image)#, 0)
+        #eman_format.write_image(test_file, empty_image2, 1)
+        for i, img in enumerate(eman_format.iter_images(test_file)):
+            ref = empty_image if i == 0 else empty_image2
+            numpy.testing.assert_allclose(ref, img)
+    finally:
+        if os.path.exists(test_file): os.unlink(test_file)
     
 def test_read_image():
     '''
     '''
     
-    empty_image = numpy.zeros((78,78))
-    eman_format.write_image(test_file, empty_image)
-    numpy.testing.assert_allclose(empty_image, eman_format.read_image(test_file))
-    os.unlink(test_file)
+    try:
+        empty_image = numpy.zeros((78,78))
+        eman_format.write_image(test_file, empty_image)
+        numpy.testing.assert_allclose(empty_image, eman_format.read_image(test_file))
+    finally:
+        if os.path.exists(test_file): os.unlink(test_file)
     
 def test_write_image():
     '''
     '''
     
-    empty_image = numpy.zeros((78,78))
-    eman_format.write_image(test_file, empty_image)
-    numpy.testing.assert_allclose(empty_image, eman_format.read_image(test_file))
-    os.unlink(test_file)
+    try:
+        empty_image = numpy.zeros((78,78))
+        eman_format.write_image(test_file, empty_image)
+        numpy.testing.assert_allclose(empty_image, eman_format.read_image(test_file))
+    finally:
+        if os.path.exists(test_file): os.unlink(test_file)
 
 
@@ -4,7 +4,7 @@
 .. codeauthor:: Robert Langlois <rl2528@columbia.edu>
 '''
 
-from .. import spider, eman_format
+from .. import spider, eman_format, util
 import numpy, os
 
 test_file = 'test.spi'
@@ -114,5 +114,138 @@ def test_write_stack():
     finally:
         os.unlink(test_file)
 
+def test_read_image_cached():
+    '''
+    '''
+    
+    try:
+        empty_image1 = numpy.random.rand(78,200).astype('<f4')
+        empty_image2 = numpy.random.rand(78,200).astype('<f4')
+        spider.write_image(test_file, empty_image1, 0)
+        spider.write_image(test_file, empty_image2, 1)
+        for i in xrange(3):
+            numpy.testing.assert_allclose(empty_image2, spider.read_image(test_file, 1))
+            numpy.testing.assert_allclose(empty_image1, spider.read_image(test_file, 0))
+        assert(spider.count_images(test_file) == 2)
+        spider.write_image(test_file, empty_image1, 2)
+        assert(spider.count_images(test_file) == 3)
+        numpy.testing.assert_allclose(empty_image1, spider.read_image(test_file, 2))
+    finally:
+        os.unlink(test_file)
+
+def test_mmap_stack():
+    '''
+    '''
+    
+    try:
+        imgs = numpy.random.rand(3,78,200).astype('<f4')
+        for i, img in enumerate(imgs):
+            spider.write_image(test_file, img, i)
+        stack = spider.mmap_stack(test_file)
+        assert(stack.shape == imgs.shape)
+        numpy.testing.assert_allclose(imgs, stack)
+        numpy.testing.assert_allclose(imgs[[2, 0]], stack[[2, 0]])
+        del stack
+    finally:
+        os.unlink(test_file)
+
+def test_stack_writer():
+    '''
+    '''
+    
+    try:
+        imgs = numpy.random.rand(4,78,200).astype('<f4')
+        with spider.StackWriter(test_file) as writer:
+            writer.write_block(imgs[:2])
+            writer.write(imgs[2])
+        with spider.StackWriter(test_file, index=3) as writer:
+            writer.write(imgs[3])
+        assert(spider.count_images(test_file) == 4)
+        for i, img in enumerate(spider.iter_images(test_file)):
+            numpy.testing.assert_allclose(imgs[i], img)
+    finally:
+        os.unlink(test_file)
+
+def test_format_stack_writer():
+    '''
+    '''
+    
+    try:
+        imgs = numpy.random.rand(3,78,200).astype('<f4')
+        with util.StackWriter(test_file, format=spider) as writer:
+            writer.write_block(imgs[:2])
+            writer.write(imgs[2])
+        assert(spider.count_images(test_file) == 3)
+        for i, img in enumerate(spider.iter_images(test_file)):
+            numpy.testing.assert_allclose(imgs[i], img)
+        try: util.StackWriter(test_file).write(imgs[0])
+        except ValueError: pass
+        else: assert(False)
+    finally:
+        os.unlink(test_file)
+
+def test_read_images():
+    '''
+    '''
+    
+    try:
+        imgs = numpy.random.rand(6,78,200).astype('<f4')
+        for i, img in enumerate(imgs):
+            spider.write_image(test_file, img, i)
+        index = numpy.asarray([4, 1, 2, 3, 0, 4])
+        numpy.testing.assert_allclose(imgs[index], spider.read_images(test_file, index))
+    finally:
+        os.unlink(test_file)
 
 
+def _read_random_images(args):
+    '''
+    '''
+    
+    seed, count = args
+    rng = numpy.random.RandomState(seed)
+    errors = 0
+    for i in rng.randint(0, count, 2000):
+        img = spider.read_image(test_file, int(i))
+        if not numpy.all(img == i): errors += 1
+    return errors
+
+def test_read_image_fork():
+    '''
+    '''
+    
+    import multiprocessing
+    try:
+        count = 8
+        for i in xrange(count):
+            spider.write_image(test_file, numpy.zeros((78,200), dtype='<f4')+i, i)
+        numpy.testing.assert_allclose(numpy.zeros((78,200))+3, spider.read_image(test_file, 3))
+        pool = multiprocessing.Pool(8)
+        try: errors = pool.map(_read_random_images, [(i, count) for i in xrange(8)])
+        finally: pool.terminate()
+        assert(sum(errors) == 0)
+    finally:
+        os.unlink(test_file)
+
+def test_read_image_rewritten():
+    '''
+    '''
+    
+    other_file = 'test_other.spi'
+    try:
+        img1 = numpy.random.rand(128,64).astype('<f4')
+        img2 = numpy.random.rand(64,128).astype('<f4')
+        spider.write_image(test_file, img1)
+        spider.write_image(other_file, img2)
+        assert(os.path.getsize(test_file) == os.path.getsize(other_file))
+        numpy.testing.assert_allclose(img1, spider.read_image(test_file))
+        st = os.stat(test_file)
+        data = open(other_file, 'rb').read()
+        fout = open(test_file, 'r+b')
+        try: fout.write(data)
+        finally: fout.close()
+        os.utime(test_file, (st.st_atime, st.st_mtime))
+        numpy.testing.assert_allclose(img2, spider.read_image(test_file))
+    finally:
+        os.unlink(test_file)
+        if os.path.exists(other_file): os.unlink(other_file)
@@ -5,17 +5,618 @@
 '''
 import numpy, os, bz2
 from ..ndimage import ndimage
+import collections
+import threading
+import cStringIO
 import logging
+import time
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 
+_mtime_resolution = 2.0 # Coarsest modification time resolution of common file systems (FAT)
+_head_size = 1024
+
 class InvalidHeaderException(Exception):
     ''' Thrown when the image file has an invalid header
     '''
     
     pass
 
+class CachedFile(object):
+    ''' Open read-only file handle along with information decoded
+    from its header
+    
+    Decoded information is stored by each format in the `info`
+    dictionary, e.g. the parsed header, data type and byte offsets,
+    and lives as long as the file is unchanged.
+    
+    A handle opened by the cache is private to the process that opened
+    it: a process forked while the entry is alive reopens the file 
+    rather than share the file offset with its parent.
+    
+    :Parameters:
+    
+    filename : str
+               Name of the file
+    fd : File, optional
+         File object opened by the caller (not closed by the cache)
+    stamp : tuple, optional
+            Identity of the file on disk: (inode, size, mtime)
+    data : str, optional
+           Contents of the file read ahead of time, reads are served 
+           from memory rather than the file
+    '''
+    
+    def __init__(self, filename, fd=None, stamp=None, data=None):
+        ''' Create a cached file entry
+        '''
+        
+        self.filename = filename
+        self.owner = fd is None
+        self.data = data
+        if data is not None: fd = cStringIO.StringIO(data)
+        self._fd = uopen(filename, 'rb') if fd is None else fd
+        self.pid = os.getpid()
+        self.stamp = stamp
+        self.size = stamp[1] if stamp is not None else None
+        self.info = {}
+        self.lock = threading.RLock()
+        self.refs = 0
+        self.evicted = False
+        self.head = None
+        self.verified = True
+        if stamp is not None and not is_settled(stamp):
+            self.verified = False
+            self.head = read_head(filename) if data is None else data[:_head_size]
+    
+    @property
+    def fd(self):
+        ''' File handle owned by the current process
+        
+        :Returns:
+        
+        fd : File
+             Open file handle
+        '''
+        
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.lock = threading.RLock()
+            if self.owner and self.data is None and self._fd is not None:
+                self._fd = uopen(self.filename, 'rb')
+        return self._fd
+    
+    def is_current(self, stamp):
+        ''' Test if the entry still describes the file on disk
+        
+        A file rewritten in place with the same size during the 
+        modification time resolution of the file system keeps its stamp,
+        so until the stamp is older than the resolution, the start of the 
+        file is compared as well.
+        
+        :Parameters:
+        
+        stamp : tuple
+                Identity of the file on disk: (inode, size, mtime)
+        
+        :Returns:
+        
+        current : bool
+                  True if the entry matches the file
+        '''
+        
+        if stamp != self.stamp: return False
+        if self.verified: return True
+        settled = is_settled(stamp)
+        if read_head(self.filename) != self.head: return False
+        self.verified = settled
+        return True
+    
+    def file_size(self):
+        ''' Get the size of the file in bytes
+        
+        :Returns:
+        
+        size : int
+               Size of the file in bytes
+        '''
+        
+        if self.size is None:
+            with self.lock:
+                pos = self.fd.tell()
+                self.fd.seek(0, 2)
+                self.size = self.fd.tell()
+                self.fd.seek(pos)
+        return self.size
+    
+    def read(self, offset, dtype, count):
+        ''' Read an array from an absolute byte offset in the file
+        
+        :Parameters:
+        
+        offset : int
+                 Absolute byte offset in the file
+        dtype : dtype
+                Data type of the array
+        count : int
+                Number of elements to read
+        
+        :Returns:
+        
+        out : array
+              Array read from the file
+        '''
+        
+        if self.data is not None:
+            return numpy.frombuffer(self.data, numpy.dtype(dtype), int(count), int(offset)).copy()
+        fd = self.fd
+        with self.lock:
+            fd.seek(int(offset))
+            return fromfile(fd, numpy.dtype(dtype), int(count))
+    
+    def close(self):
+        ''' Close the file handle if it is no longer referenced
+        '''
+        
+        self.evicted = True
+        if self.refs == 0 and self.owner and self._fd is not None:
+            self._fd.close()
+            self._fd = None
+            self.data = None
+
+class FileCache(object):
+    ''' Process-local least-recently used cache of open file handles
+    
+    Entries are keyed by the absolute path of the file and are
+    reopened when the inode, size or modification time of the
+    file changes. A forked process starts with an empty cache.
+    
+    :Parameters:
+    
+    maxsize : int
+              Maximum number of open file handles
+    '''
+    
+    def __init__(self, maxsize=64):
+        ''' Create an empty cache
+        '''
+        
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.pid = os.getpid()
+    
+    def _check_fork(self):
+        ''' Drop the entries inherited from the parent process
+        '''
+        
+        if self.pid == os.getpid(): return
+        self.pid = os.getpid()
+        self.lock = threading.RLock()
+        entries, self.entries = self.entries, collections.OrderedDict()
+        for entry in entries.itervalues():
+            if entry.refs == 0: entry.close()
+            else: entry.evicted = True
+    
+    def acquire(self, filename):
+        ''' Get a referenced entry for the file, opening it if necessary
+        
+        :Parameters:
+        
+        filename : str
+                   Name of the file
+        
+        :Returns:
+        
+        entry : CachedFile
+                Open file with cached header information
+        '''
+        
+        key = os.path.abspath(filename)
+        st = os.stat(key)
+        stamp = (st.st_ino, st.st_size, st.st_mtime)
+        self._check_fork()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and not entry.is_current(stamp):
+                entry.close()
+                entry = None
+            if entry is None: entry = CachedFile(key, stamp=stamp)
+            entry.refs += 1
+            self.entries[key] = entry
+            self._trim(self.maxsize)
+        return entry
+    
+    def preload(self, filename):
+        ''' Read the whole file into memory and add it to the cache, 
+        replacing any open entry
+        
+        :Parameters:
+        
+        filename : str
+                   Name of the file
+        
+        :Returns:
+        
+        nbytes : int
+                 Number of bytes held in memory
+        '''
+        
+        key = os.path.abspath(filename)
+        st = os.stat(key)
+        stamp = (st.st_ino, st.st_size, st.st_mtime)
+        if not is_settled(stamp): return 0 # File may still change without changing its stamp
+        fin = open(key, 'rb')
+        try: data = fin.read()
+        finally: fin.close()
+        if len(data) != st.st_size: stamp = None # File changed while reading
+        self._check_fork()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None: entry.close()
+            if stamp is None: return 0
+            self.entries[key] = CachedFile(key, stamp=stamp, data=data)
+            self._trim(self.maxsize)
+        return len(data)
+    
+    def release(self, entry):
+        ''' Release a reference to an entry
+        
+        :Parameters:
+        
+        entry : CachedFile
+                Entry returned by `acquire`
+        '''
+        
+        self._check_fork()
+        with self.lock:
+            entry.refs -= 1
+            if entry.evicted: entry.close()
+    
+    def invalidate(self, filename=None):
+        ''' Remove a file or all files from the cache
+        
+        :Parameters:
+        
+        filename : str, optional
+                   Name of the file, if None, clear the cache
+        '''
+        
+        self._check_fork()
+        with self.lock:
+            if filename is None:
+                self._trim(0)
+            else:
+                entry = self.entries.pop(os.path.abspath(filename), None)
+                if entry is not None: entry.close()
+    
+    def resize(self, maxsize):
+        ''' Set the maximum number of open file handles
+        
+        :Parameters:
+        
+        maxsize : int
+                  Maximum number of open file handles
+        '''
+        
+        with self.lock:
+            self.maxsize = maxsize
+            self._trim(maxsize)
+    
+    def _trim(self, maxsize):
+        ''' Close the least recently used entries until the
+        cache holds no more than the given number
+        
+        :Parameters:
+        
+        maxsize : int
+                  Maximum number of entries to keep
+        '''
+        
+        while len(self.entries) > maxsize:
+            self.entries.popitem(last=False)[1].close()
+
+_file_cache = FileCache()
+
+def is_settled(stamp):
+    ''' Test if a file can no longer change without changing its stamp
+    
+    :Parameters:
+    
+    stamp : tuple
+            Identity of the file on disk: (inode, size, mtime)
+    
+    :Returns:
+    
+    settled : bool
+              True if the modification time is older than the
+              resolution of the file system
+    '''
+    
+    return time.time() - stamp[2] > _mtime_resolution
+
+def read_head(filename):
+    ''' Read the start of a file, which holds the header
+    
+    :Parameters:
+    
+    filename : str
+               Name of the file
+    
+    :Returns:
+    
+    head : str
+           First bytes of the file, None if it cannot be read
+    '''
+    
+    try:
+        fin = open(filename, 'rb')
+        try: return fin.read(_head_size)
+        finally: fin.close()
+    except IOError: return None
+
+def is_cacheable(filename):
+    ''' Test if the file handle can be held in the cache
+    
+    :Parameters:
+    
+    filename : str or file object
+               Filename or open stream for a file
+    
+    :Returns:
+    
+    out : bool
+          True if filename is a name of a regular uncompressed file
+    '''
+    
+    return hasattr(filename, 'find') and os.path.splitext(filename)[1] != '.bz2'
+
+def open_cached(filename):
+    ''' Open a file for reading through the process-local handle cache
+    
+    Open streams and compressed files are wrapped in an uncached entry.
+    Each call must be paired with a call to `release_cached`.
+    
+    :Parameters:
+    
+    filename : str or file object
+               Filename or open stream for a file
+    
+    :Returns:
+    
+    entry : CachedFile
+            Open file with cached header information
+    '''
+    
+    if is_cacheable(filename): return _file_cache.acquire(filename)
+    if hasattr(filename, 'find'): entry = CachedFile(filename)
+    else: entry = CachedFile(getattr(filename, 'name', None), fd=filename)
+    entry.refs += 1
+    return entry
+
+def release_cached(entry):
+    ''' Release an entry returned by `open_cached`
+    
+    :Parameters:
+    
+    entry : CachedFile
+            Entry returned by `open_cached`
+    '''
+    
+    if entry.stamp is not None: _file_cache.release(entry)
+    else:
+        entry.refs -= 1
+        entry.close()
+
+def invalidate_cache(filename=None):
+    ''' Remove a file or all files from the handle cache
+    
+    This should be called after a file is modified in place.
+    
+    :Parameters:
+    
+    filename : str, optional
+               Name of the file, if None, clear the cache
+    '''
+    
+    if filename is not None and not hasattr(filename, 'find'): return
+    _file_cache.invalidate(filename)
+
+def preload_cached(filename):
+    ''' Read the whole file into memory ahead of time so that
+    subsequent reads through the handle cache do not touch the disk
+    
+    The memory is held until the file is removed from the cache
+    with `invalidate_cache`.
+    
+    :Parameters:
+    
+    filename : str
+               Name of the file
+    
+    :Returns:
+    
+    nbytes : int
+             Number of bytes held in memory
+    '''
+    
+    if not is_cacheable(filename): return 0
+    return _file_cache.preload(filename)
+
+def set_cache_size(maxsize):
+    ''' Set the maximum number of file handles held open
+    by the cache
+    
+    :Parameters:
+    
+    maxsize : int
+              Maximum number of open file handles
+    '''
+    
+    _file_cache.resize(maxsize)
+
+class StackWriter(object):
+    ''' Write a stack of images through the `write_image` function
+    of a format module
+    
+    Each image is written with a separate call to `write_image`. Formats
+    that support stacks define a subclass that holds a single file open, 
+    writes each image or block of images with a single buffered write and 
+    writes the stack header once when the writer is closed.
+    
+    .. sourcecode:: py
+    
+        with util.StackWriter('stack.spi', format=spider) as writer:
+            for img in imgs: writer.write(img)
+    
+    :Parameters:
+    
+    filename : str
+               Name of the output file
+    header : dict, optional
+             Dictionary of header values
+    index : int
+            Index of the first image to write, if greater than zero,
+            the stack is extended rather than overwritten
+    count : int, optional
+            Expected number of images in the stack used to preallocate the file
+    format : module, optional
+             Format module used to write each image
+    '''
+    
+    def __init__(self, filename, header=None, index=0, count=None, format=None):
+        ''' Create a stack writer
+        '''
+        
+        self.filename = filename
+        self.header = header
+        self.index = index
+        self.count = count
+        self.format = format
+        self.fd = None
+    
+    def __enter__(self):
+        ''' Enter the runtime context of the writer
+        '''
+        
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        ''' Close the writer on exit of the runtime context
+        '''
+        
+        self.close()
+        return False
+    
+    def write(self, img):
+        ''' Append an image to the stack
+        
+        :Parameters:
+        
+        img : array
+              Image array
+        '''
+        
+        img = numpy.asarray(img)
+        self.write_block(img.reshape((1, )+img.shape))
+    
+    def write_block(self, imgs):
+        ''' Append a block of images to the stack
+        
+        :Parameters:
+        
+        imgs : array
+               Array of images where the first dimension indexes the image
+        '''
+        
+        if len(imgs) == 0: return
+        if self.fd is None: self.open(imgs[0])
+        self.write_data(imgs)
+        self.index += len(imgs)
+    
+    def close(self):
+        ''' Write the stack header and close the file
+        '''
+        
+        if self.fd is None: return
+        try:
+            self.finalize()
+        finally:
+            close(self.filename, self.fd)
+            self.fd = None
+            invalidate_cache(self.filename)
+    
+    def open(self, img):
+        ''' Prepare to write the given image, no file is held open
+        as each image is written by the format module
+        
+        :Parameters:
+        
+        img : array
+              First image to be written
+        '''
+        
+        if self.format is None: raise ValueError, "No format given to write %s"%self.filename
+        self.fd = self.filename
+    
+    def write_data(self, imgs):
+        ''' Write a block of images at the current index
+        
+        :Parameters:
+        
+        imgs : array
+               Array of images where the first dimension indexes the image
+        '''
+        
+        for i, img in enumerate(imgs):
+            self.format.write_image(self.filename, img, self.index+i, self.header)
+    
+    def finalize(self):
+        ''' Write the stack header
+        '''
+        
+        pass
+
+max_read_bytes = 1<<26
+
+def coalesce_runs(index, record_size, max_bytes=None):
+    ''' Group an unsorted set of image indices into runs of consecutive
+    images that can each be read from a file at once
+    
+    :Parameters:
+    
+    index : array
+            Image indices in any order
+    record_size : int
+                  Number of bytes between consecutive images in the file
+    max_bytes : int, optional
+                Largest read in bytes, if None use `max_read_bytes`
+    
+    :Returns:
+    
+    runs : list
+           List of tuples (first, count, positions) where first is the index
+           of the first image in the run, count is the number of images and
+           positions are the locations of each image of the run in `index`
+    '''
+    
+    if max_bytes is None: max_bytes = max_read_bytes
+    index = numpy.asarray(index, dtype=numpy.int64)
+    if len(index) == 0: return []
+    order = numpy.argsort(index, kind='mergesort')
+    sindex = index[order]
+    maxlen = max(1, int(max_bytes) // max(1, int(record_size)))
+    breaks = numpy.flatnonzero(numpy.diff(sindex) != 1)+1
+    starts = numpy.concatenate(([0], breaks))
+    ends = numpy.concatenate((breaks, [len(sindex)]))
+    runs = []
+    for beg, end in zip(starts, ends):
+        for b in xrange(beg, end, maxlen):
+            e = min(b+maxlen, end)
+            runs.append((int(sindex[b]), e-b, order[b:e]))
+    return runs
+
 def fromfile(fin, dtype, count, sep=''):
     '''
     '''
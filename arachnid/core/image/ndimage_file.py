@@ -38,6 +38,25 @@ using the following:
 
     imfile.write_image('image.mrc', image)
 
+Open file handles and decoded headers of SPIDER and MRC files are kept in a
+process-local cache, so repeated reads from the same stack only pay for a
+seek and a read. A file is reopened automatically when its size or modification
+time changes; a file modified by other means can be dropped explicitly:
+
+.. sourcecode:: py
+
+    imfile.invalidate_cache('stack.spi')
+
+A micrograph can be read into memory ahead of processing, for example from
+a background thread, and later reads of the file are served from memory until
+it is released:
+
+.. sourcecode:: py
+
+    nbytes = imfile.prefetch('mic_00001.spi')
+    mic = imfile.read_image('mic_00001.spi')
+    imfile.release_prefetch('mic_00001.spi')
+
 .. end-dev
 
 .. Created on Aug 11, 2012
@@ -53,8 +72,11 @@ import ndimage_utility
 import numpy
 import logging
 import os
-from formats.util import InvalidHeaderException
+from formats.util import InvalidHeaderException, invalidate_cache, set_cache_size
+from formats import util as format_util
 InvalidHeaderException;
+invalidate_cache;
+set_cache_size;
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
@@ -88,9 +110,10 @@ def copy_local(filename, selection, local_file, **extra):
         remote_select = numpy.loadtxt(selection_file, delimiter=",")
         if remote_select.shape[0]==selection.shape[0] and numpy.alltrue(remote_select==selection) and count_images(local_file) == selection.shape[0]: return local_file
     
-    for i, img in enumerate(iter_images(filename, selection)):
-        _logger.debug("Caching: %s - %d@%s"%(str(selection[i]), i, local_file))
-        write_image(local_file, img, i)
+    with stack_writer(local_file, count=len(selection)) as writer:
+        for i, img in enumerate(iter_images(filename, selection)):
+            _logger.debug("Caching: %s - %d@%s"%(str(selection[i]), i, local_file))
+            writer.write(img)
     numpy.savetxt(selection_file, selection, delimiter=",")
     return local_file
 
@@ -207,6 +230,11 @@ def read_stack(filename):
               image
     '''
     
+    filename = readlinkabs(filename)
+    if hasattr(get_read_format_except(filename), 'mmap_stack'):
+        try: stack = mmap_stack(filename)
+        except ValueError: pass
+        else: return numpy.asarray(stack, dtype=numpy.float)
     img = read_image(filename)
     count = count_images(filename)
     stack = numpy.zeros((count, )+img.shape)
@@ -214,6 +242,83 @@ def read_stack(filename):
         stack[i, :] = img
     return stack
 
+def mmap_stack(filename):
+    ''' Map an entire stack into memory as a read-only array
+    
+    No image data is read until the array is accessed. Slicing the returned
+    array or gathering rows with an index array does not touch the rest of
+    the file, and the OS page cache is shared between processes mapping the
+    same stack.
+    
+    .. sourcecode:: py
+    
+        stack = imfile.mmap_stack('stack.spi')
+        subset = stack[selection]  # copies only the selected images
+    
+    :Parameters:
+        
+        filename : str
+                   Input filename to read
+    
+    :Returns:
+            
+        out : memmap
+              Read-only array nxm1xm2 where n is the 
+              number of images
+    '''
+    
+    filename = readlinkabs(filename)
+    format = get_read_format_except(filename)
+    if not hasattr(format, 'mmap_stack'):
+        raise IOError, "Memory mapping not supported for format of %s"%filename
+    return format.mmap_stack(filename)
+
+def prefetch(filename):
+    ''' Read the contents of one or more image files into memory ahead of time
+    
+    SPIDER and MRC files are held in the handle cache and later reads
+    are served from memory until :py:func:`release_prefetch` is called. 
+    Other formats are read through once, so they are only held in the 
+    OS page cache.
+    
+    :Parameters:
+        
+        filename : str or list
+                   Input filename or list of filenames
+    
+    :Returns:
+            
+        nbytes : int
+                 Number of bytes held in memory
+    '''
+    
+    if not isinstance(filename, str):
+        return sum([prefetch(f) for f in filename if isinstance(f, str)])
+    filename = readlinkabs(filename)
+    if not os.path.exists(filename) or not format_util.is_cacheable(filename): return 0
+    nbytes = format_util.preload_cached(filename)
+    try: format = get_read_format(filename)
+    except: format = None
+    if format not in (spider, mrc):
+        invalidate_cache(filename)
+        return 0
+    return nbytes
+
+def release_prefetch(filename):
+    ''' Release the memory held for files read by :py:func:`prefetch`
+    
+    :Parameters:
+        
+        filename : str or list
+                   Input filename or list of filenames
+    '''
+    
+    if not isinstance(filename, str):
+        for f in filename:
+            if isinstance(f, str): release_prefetch(f)
+        return
+    if os.path.exists(filename): invalidate_cache(readlinkabs(filename))
+
 def iter_images(filename, index=None, header=None):
     ''' Read a set of images from the given file
     
@@ -290,6 +395,81 @@ def iter_images(filename, index=None, header=None):
     for img in format.iter_images(filename, index, header):
         yield img
 
+def read_images(filename, index, out=None, dtype=None):
+    ''' Read a selection of images, in any order, into a single array
+    
+    Unlike :py:func:`iter_images`, the selection need not be sorted. Images are
+    grouped by file and read in order of their position in each file, where runs
+    of consecutive images are read at once. The images are placed in the output
+    array in the requested order.
+    
+    .. sourcecode:: py
+    
+        selection = numpy.asarray([(12, 5), (3, 0), (12, 4)]) # (file id, index)
+        imgs = imfile.read_images('stack_000.spi', selection)
+    
+    :Parameters:
+        
+        filename : str or dict
+                   Input filename, template of stack filenames or dictionary
+                   mapping a file id to a filename
+        index : array
+                Array of image indices (0-based) for a single stack or
+                2-column array of (file id, image index) pairs
+        out : array, optional
+              Preallocated output array with a row for each selected image
+        dtype : dtype, optional
+                Type of the output array if `out` is not given, if None use the
+                type of the image in the file
+    
+    :Returns:
+            
+        out : array
+              Array where each row is an image in the order of the selection
+    '''
+    
+    index = numpy.asarray(index)
+    if index.ndim == 2 and index.shape[1] == 1: index = index.ravel()
+    if isinstance(filename, list): filename = filename[0]
+    single = hasattr(filename, 'find') and os.path.exists(filename) and count_images(filename) == 1
+    if index.ndim == 1 and not isinstance(filename, dict) and not single:
+        groups = [(filename, numpy.arange(len(index)), index.astype(numpy.int))]
+    else:
+        if index.ndim == 1 or single:
+            fids = (index if index.ndim == 1 else index[:, 0]).astype(numpy.int)
+            offsets = numpy.zeros(len(fids), dtype=numpy.int)
+        else:
+            fids = index[:, 0].astype(numpy.int)
+            offsets = index[:, 1].astype(numpy.int)
+        order = numpy.argsort(fids, kind='mergesort')
+        groups = []
+        for rows in numpy.split(order, numpy.flatnonzero(numpy.diff(fids[order]))+1):
+            if len(rows) == 0: continue
+            id = int(fids[rows[0]])
+            curr_filename = spider_utility.spider_filename(filename, id) if not isinstance(filename, dict) else filename[id]
+            groups.append((curr_filename, rows, offsets[rows]))
+    if len(groups) == 0:
+        if out is None: raise ValueError, "Cannot allocate output for an empty selection"
+        return out
+    
+    if out is None:
+        img = read_image(groups[0][0], int(groups[0][2][0]))
+        out = numpy.empty((len(index), )+img.shape, dtype=img.dtype if dtype is None else dtype)
+    elif out.shape[0] < len(index): raise ValueError, "Output array too small for selection: %d < %d"%(out.shape[0], len(index))
+    for curr_filename, rows, offsets in groups:
+        curr_filename = readlinkabs(curr_filename)
+        format = get_read_format_except(curr_filename)
+        try:
+            if hasattr(format, 'read_images'):
+                format.read_images(curr_filename, offsets, out, rows)
+            else:
+                for row, i in zip(rows, offsets):
+                    out[row] = format.read_image(curr_filename, int(i))
+        except:
+            _logger.error("stack filename: %s - %d to %d"%(curr_filename, numpy.min(offsets), numpy.max(offsets)))
+            raise
+    return out
+
 def count_images(filename):
     ''' Count the number of images in the file
     
@@ -379,7 +559,7 @@ def write_image(filename, img, index=None, header=None, inplace=False):
         raise IOError, "Could not find format for extension of %s"%filename
     format.write_image(filename, img, index, header, inplace)
     
-def write_stack(filename, imgs):
+def write_stack(filename, imgs, header=None):
     ''' Write the given image to the given filename using a format
     based on the file extension, or given type.
     
@@ -389,15 +569,49 @@ def write_stack(filename, imgs):
                    Output filename for the image
         imgs : array
                Image stack data to write out
+        header : dict
+                 Header dictionary
+    '''
+    
+    with stack_writer(filename, header) as writer:
+        if hasattr(imgs, 'ndim'):
+            writer.write_block(imgs)
+        else:
+            for img in imgs: writer.write(img)
+
+def stack_writer(filename, header=None, index=0, count=None):
+    ''' Create a writer that appends images to a stack through a
+    single open file and writes the stack header once on close.
+    
+    .. sourcecode:: py
+    
+        with imfile.stack_writer('stack.spi') as writer:
+            for img in imgs: writer.write(img)
+    
+    :Parameters:
+        
+        filename : str
+                   Output filename for the stack
+        header : dict
+                 Header dictionary
+        index : int
+                Index of the first image to write, if greater than zero,
+                the stack is extended rather than overwritten
+        count : int, optional
+                Expected number of images used to preallocate the file
+    
+    :Returns:
+        
+        writer : StackWriter
+                 Stack writer for the format of the file
     '''
     
     format = get_write_format(filename)
     if format is None: 
         raise IOError, "Could not find format for extension of %s"%filename
-    index = 0
-    for img in imgs:
-        format.write_image(filename, img, index)
-        index += 1
+    if hasattr(format, 'StackWriter'):
+        return format.StackWriter(filename, header, index, count)
+    return format_util.StackWriter(filename, header, index, count, format)
 
 def get_write_format(filename):
     ''' Get the write format for the image
@@ -460,6 +674,28 @@ def get_read_format(filename):
     '''
     
     if not os.path.exists(filename): raise IOError, "Cannot find file: %s"%(filename)
+    if not format_util.is_cacheable(filename): return _probe_format(filename)
+    entry = format_util.open_cached(filename)
+    try:
+        if 'format' not in entry.info:
+            entry.info['format'] = _probe_format(filename)
+        return entry.info['format']
+    finally:
+        format_util.release_cached(entry)
+
+def _probe_format(filename):
+    ''' Test each available format on the given file
+    
+    :Parameters:
+        
+        filename : str
+                   Input file to test
+    
+    :Returns:
+        
+        out : format
+                Read format for given file
+    '''
     
     for f in _formats:
         if f.is_readable(filename): return f
@@ -33,6 +33,8 @@ except:
     tracing.log_import_error('Failed to load _image_utility.so module - certain functions will not be available', _logger)
     _image_utility=None
 
+_polar_half_cache = {}
+
 def mirror(img, out=None):
     ''' Mirror projection (SPIDER convention)
     
@@ -987,8 +989,9 @@ def perdiogram(mic, window_size=256, pad=1, overlap=0.5, offset=0.1, shift=True,
     if offset > 0 and offset < 1.0: offset = int(offset*mic.shape[0])
     step = max(1, window_size*overlap)
     rwin = rolling_window(mic[offset:mic.shape[0]-offset, offset:mic.shape[1]-offset], (window_size, window_size), (step, step))
-    rwin = rwin.reshape((rwin.shape[0]*rwin.shape[1], rwin.shape[2], rwin.shape[3]))
-    return powerspec_avg(rwin, pad, shift) if not ret_more else (powerspec_avg(rwin, pad, shift), rwin.shape[0])
+    avg, total = powerspec_sum_batch((win for row in rwin for win in row), pad)
+    avg = powerspec_fin(powerspec_full(avg), total, shift)
+    return avg if not ret_more else (avg, int(total))
 
 def dct_avg(imgs, pad):
     ''' Calculate an averaged power specra from a set of images
@@ -1057,6 +1060,114 @@ def powerspec_sum(imgs, pad, avg=None, total=0.0, do_ramp=False):
         total += 1.0
     return avg, total
 
+def powerspec_sum_batch(imgs, pad, avg=None, total=0.0, batch_size=32):
+    ''' Calculate the summed power specra of a set of images in batches
+    
+    The images are normalized and padded as in :py:func:`powerspec_sum`, but 
+    `batch_size` images at a time are stacked in a single precision array and 
+    transformed together with a real-input FFT. Only the non-redundant half 
+    of the power spectra is accumulated, use :py:func:`powerspec_full` to 
+    recover the full power spectra.
+    
+    :Parameters:
+    
+    imgs : iterable
+           Iterator of images
+    pad : int
+          Number of times to pad an image
+    avg : array, optional
+          Half power spectra to accumulate
+    total : float
+            Number of images already accumulated
+    batch_size : int
+                 Number of images transformed together
+    
+    :Returns:
+    
+    avg : array
+          Summed half power spectra
+    total : float
+            Number of images accumulated
+    '''
+    
+    if pad is None or pad <= 0: pad = 1
+    batch = []
+    for img in imgs:
+        batch.append(img)
+        if len(batch) < batch_size: continue
+        avg = _powerspec_batch(batch, pad, avg)
+        total += len(batch)
+        batch = []
+    if len(batch) > 0:
+        avg = _powerspec_batch(batch, pad, avg)
+        total += len(batch)
+    return avg, total
+
+def _powerspec_batch(imgs, pad, avg=None):
+    ''' Add the half power specra of a batch of images to the sum
+    
+    :Parameters:
+    
+    imgs : list
+           List of images with the same shape
+    pad : int
+          Number of times to pad an image
+    avg : array, optional
+          Half power spectra to accumulate
+    
+    :Returns:
+    
+    avg : array
+          Summed half power spectra
+    '''
+    
+    stack = numpy.array(imgs, dtype=numpy.float32)
+    axes = (slice(None), numpy.newaxis, numpy.newaxis)
+    stack -= stack.min(axis=(1, 2))[axes]
+    stack /= stack.max(axis=(1, 2))[axes]
+    stack -= stack.mean(axis=(1, 2))[axes]
+    stack /= stack.std(axis=(1, 2))[axes]
+    pad_width = stack.shape[1]*pad
+    if stack.shape[1] != pad_width or stack.shape[2] != pad_width:
+        fill = (stack[:, 0, :].sum(axis=1)+stack[:, :, 0].sum(axis=1)+stack[:, -1, :].sum(axis=1)+stack[:, :, -1].sum(axis=1)) / (stack.shape[1]*2+stack.shape[2]*2 - 4)
+        padded = numpy.empty((len(stack), pad_width, pad_width), dtype=stack.dtype)
+        padded[:] = fill[axes]
+        cx = (pad_width-stack.shape[1])/2
+        cy = (pad_width-stack.shape[2])/2
+        padded[:, cx:cx+stack.shape[1], cy:cy+stack.shape[2]] = stack
+        stack = padded
+    fimg = numpy.fft.rfftn(stack, axes=(1, 2))
+    del stack
+    pow = numpy.square(fimg.real)
+    pow += numpy.square(fimg.imag)
+    if avg is None: avg = pow.sum(axis=0)
+    else: avg += pow.sum(axis=0)
+    return avg
+
+def powerspec_full(avg, shape=None):
+    ''' Expand a half power spectra from a real-input FFT to the full power spectra
+    
+    :Parameters:
+    
+    avg : array
+          Half power spectra
+    shape : tuple, optional
+            Shape of the full power spectra, defaults to square
+    
+    :Returns:
+    
+    out : array
+          Full power spectra
+    '''
+    
+    if shape is None: shape = (avg.shape[0], avg.shape[0])
+    out = numpy.empty(shape, dtype=avg.dtype)
+    half = avg.shape[1]
+    out[:, :half] = avg
+    if shape[1] > half:
+        out[:, half:] = avg[(-numpy.arange(shape[0])) % shape[0]][:, shape[1]-numpy.arange(half, shape[1])]
+    return out
+
 def powerspec_fin(avg, total, shift=True):
     '''
     '''
@@ -1082,8 +1193,8 @@ def powerspec_avg(imgs, pad, shift=True):
                   Averaged power spectra
     '''
     
-    avg, total = powerspec_sum(imgs, pad)
-    return powerspec_fin(avg, total, shift)
+    avg, total = powerspec_sum_batch(imgs, pad)
+    return powerspec_fin(powerspec_full(avg), total, shift)
 
 def moving_average(img, window=3, out=None):
     ''' Estimate a moving average with a uniform distribution and given window size
@@ -1359,6 +1470,29 @@ def compress_image(img, mask, out=None):
         out[:] = img.ravel()[mask.ravel()>0.5]
     return out
 
+def compress_image_batch(imgs, mask, out=None):
+    ''' Compress the valid region of each image in a stack with the given mask into a 2D array
+    
+    :Parameters:
+    
+    imgs : numpy.ndarray
+           Stack of images
+    mask : numpy.ndarray
+           Binary mask of valid pixesl
+    out : numpy.ndarray
+          Output 2D-array, one row per image
+    
+    :Returns:
+    
+    out : numpy.ndarray
+          Output 2D-array, one row per image
+    '''
+    
+    vals = imgs.reshape((len(imgs), -1))[:, mask.ravel()>0.5]
+    if out is None: return vals
+    out[:] = vals
+    return out
+
 def uncompress_image(img, mask, out=None):
     ''' Compress the valid region of an image with the given mask into 1D array
     
@@ -1428,11 +1562,39 @@ def polar_half(image, center=None, out=None, rng=None):
           Image in polar space (radius, angle)
     '''
     
-    ny, _ = image.shape[:2]
+    coords, shape = polar_half_coords(image.shape[:2], center, rng)
+    return scipy.ndimage.interpolation.map_coordinates(image, coords).reshape(shape).T
+
+def polar_half_coords(shape, center=None, rng=None):
+    '''Get the sampling coordinates used by :py:func:`polar_half`
     
-    if center is None: center = (image.shape[0]/2+image.shape[0]%2, image.shape[1]/2+image.shape[0]%2)
-    #if center is None: center = (nx // 2, ny // 2)
-    x, y = index_coords(image, center)
+    The coordinates only depend on the shape of the image, the center and 
+    the radius range, so they are cached and reused for every image of 
+    the same shape.
+    
+    :Parameters:
+    
+    shape : tuple
+            Shape of the image
+    center : tuple, optional
+             Center of the polar transform
+    rng : tuple, optional
+          Range of radii
+    
+    :Returns:
+    
+    coords : numpy.ndarray
+             Coordinates to sample in the image (2xN)
+    shape : tuple
+            Shape of the sampled image (radius, angle)
+    '''
+    
+    if center is None: center = (shape[0]/2+shape[0]%2, shape[1]/2+shape[0]%2)
+    key = (tuple(shape), tuple(center), tuple(rng) if rng is not None else None)
+    if key in _polar_half_cache: return _polar_half_cache[key]
+    
+    ny = shape[0]
+    x, y = index_coords(numpy.empty(shape, dtype=numpy.bool), center)
     r, theta = cart2polar(x, y)
     
     if rng is None: rng = (r.min(), r.max())
@@ -1446,8 +1608,9 @@ def polar_half(image, center=None, out=None, rng=None):
     yi += center[1] # back to the lower-left corner...
     xi, yi = xi.flatten(), yi.flatten()
     coords = numpy.vstack((xi, yi))
-
-    return scipy.ndimage.interpolation.map_coordinates(image, coords).reshape((nx, ny)).T
+    coords.setflags(write=False)
+    _polar_half_cache[key] = (coords, (nx, ny))
+    return _polar_half_cache[key]
 
 def polar(image, center=None, out=None, rng=None):
     '''Transform image into log-polar representation
@@ -1635,6 +1798,33 @@ def segment(img, bins=0, mask=None, out=None):
         th = unary_classification.otsu(img.ravel(), bins)
     return numpy.greater(img, th, out)
 
+def dog_batch(imgs, pixel_radius, dog_width=1.2, out=None):
+    ''' Calculate difference of Gaussian over each image in a stack, see :py:func:`dog`
+    
+    :Parameters:
+    
+    imgs : numpy.ndarray
+           Stack of images
+    pixel_radius : int
+                   Radius of the particle in pixels
+    dog_width : float
+                Width of the difference of Gaussian
+    out : numpy.ndarray, optional
+          Output stack
+    
+    :Returns:
+    
+    out : numpy.ndarray
+          Difference of Gaussian stack
+    '''
+    
+    kfact = math.sqrt( (dog_width**2 - 1.0) / (2.0 * dog_width**2 * math.log(dog_width)) )
+    sigma1 = (kfact * pixel_radius)
+    sigmaDiff = sigma1*math.sqrt(dog_width*dog_width-1.0)
+    dlst = scipy.ndimage.gaussian_filter(imgs, sigma=(0, )+(sigma1, )*(imgs.ndim-1))
+    dnxt = scipy.ndimage.gaussian_filter(dlst, sigma=(0, )+(sigmaDiff, )*(imgs.ndim-1))
+    return numpy.subtract(dlst, dnxt, out)
+
 @_em2numpy2em
 def dog(img, pixel_radius, dog_width=1.2, out=None):
     ''' Calculate difference of Gaussian over the given image
@@ -1880,6 +2070,101 @@ def replace_outlier(img, dust_sigma, xray_sigma=None, replace=None, out=None):
     out[img < vsmin]=vsmin
     return out
 
+def replace_outlier_batch(imgs, dust_sigma, xray_sigma=None, out=None):
+    '''Clamp outlier pixels in each image of a stack, see :py:func:`replace_outlier`
+    
+    The statistics, cutoffs and clamping are computed for all images at once. 
+    Outlier pixels are replaced with samples drawn from the normal distribution 
+    with the same mean and standard deviation as their image, then, as with 
+    :py:func:`replace_outlier`, every pixel of the input outside the range of 
+    the inliers is clamped to that range.
+    
+    :Parameters:
+    
+    imgs : numpy.ndarray
+           Stack of images (first axis indexes the image)
+    dust_sigma : float
+                 Number of standard deviations for black pixels
+    xray_sigma : float
+                 Number of standard deviations for white pixels
+    out : numpy.ndarray
+          Output stack
+    
+    :Returns:
+    
+    out : numpy.ndarray
+          Output stack
+    '''
+    
+    if out is None: out = imgs.copy()
+    elif out is not imgs: out[:]=imgs
+    axes = tuple(xrange(1, imgs.ndim))
+    shape = (len(imgs), )+(1, )*(imgs.ndim-1)
+    avg = numpy.mean(imgs, axis=axes).reshape(shape)
+    std = numpy.std(imgs, axis=axes).reshape(shape)
+    vmin = numpy.min(imgs, axis=axes).reshape(shape)
+    vmax = numpy.max(imgs, axis=axes).reshape(shape)
+    valid = vmin != vmax
+    
+    if xray_sigma is None: xray_sigma=dust_sigma if dust_sigma > 0 else -dust_sigma
+    if dust_sigma > 0: dust_sigma = -dust_sigma
+    lcut = avg+std*dust_sigma
+    hcut = avg+std*xray_sigma
+    vsmin = numpy.where(imgs >= lcut, imgs, numpy.inf).min(axis=axes).reshape(shape)
+    vsmin = numpy.where(numpy.isinf(vsmin), vmin, vsmin)
+    vsmax = numpy.where(imgs <= hcut, imgs, -numpy.inf).max(axis=axes).reshape(shape)
+    vsmax = numpy.where(numpy.isinf(vsmax), vmax, vsmax)
+    dust = numpy.logical_and(imgs < lcut, valid)
+    xray = numpy.logical_and(imgs > hcut, valid)
+    high = imgs > vsmax
+    low = imgs < vsmin
+    for sel in (dust, xray):
+        count = numpy.sum(sel)
+        if count == 0: continue
+        out[sel] = (numpy.random.normal(0.0, 1.0, count)*numpy.broadcast_to(std, out.shape)[sel]+numpy.broadcast_to(avg, out.shape)[sel]).astype(out.dtype)
+    out[high] = numpy.broadcast_to(vsmax, out.shape)[high]
+    out[low] = numpy.broadcast_to(vsmin, out.shape)[low]
+    return out
+
+def crop_window_batch(img, coords, window, bin_factor=1.0, out=None):
+    ''' Extract a square window from an image for each coordinate in a list
+    
+    All windows are gathered with a single fancy index into a stack. As with
+    :py:func:`crop_window`, windows that cross the edge of the image wrap around.
+    
+    :Parameters:
+    
+    img : numpy.ndarray
+          Input image
+    coords : list
+             List of coordinates to center of particle
+    window : int
+             Size of the window to be cropped
+    bin_factor : float
+                 Number of times to downsample the coordinates
+    out : numpy.ndarray
+          Output stack of windows, defaults to double precision as 
+          :py:func:`for_each_window`
+                     
+    :Returns:
+    
+    out : numpy.ndarray
+          Output stack of windows (Nxwindowxwindow)
+    '''
+    
+    if len(coords) > 0 and hasattr(coords[0], 'x'):
+        coords = numpy.asarray([(0, coord.x, coord.y) for coord in coords], dtype=numpy.float)
+    coords = numpy.asarray(coords, dtype=numpy.float).reshape((len(coords), -1))
+    offset = window/2
+    x = (coords[:, 1]/bin_factor).astype(numpy.int)-offset
+    y = (coords[:, 2]/bin_factor).astype(numpy.int)-offset
+    index = numpy.arange(window)
+    rows = numpy.mod(y[:, numpy.newaxis]+index, img.shape[0])
+    cols = numpy.mod(x[:, numpy.newaxis]+index, img.shape[1])
+    if out is None: out = numpy.zeros((len(coords), window, window))
+    out[:] = img[rows[:, :, numpy.newaxis], cols[:, numpy.newaxis, :]]
+    return out
+
 @_em2numpy2em
 def crop_window(img, x, y, offset, out=None):
     ''' Extract a square window from an image
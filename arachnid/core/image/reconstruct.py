@@ -6,12 +6,20 @@ Supported Reconstruction Methods
     - BP3F: SPIDER - Kaiser-Bessel Interpolation in Fourier Space
     - BP3N: SPIDER - Nearest-neighbor Interpolation in Fourier Space
 
+Both SPIDER methods are also implemented as vectorized gridding in NumPy,
+which is used when the compiled `_spider_reconstruct` extension cannot be
+loaded or when selected with `backproject_engine`. Batches of 2D Fourier
+transforms are inserted into the 3D Fourier volume with a scatter-add and
+the slice coordinate table for each set of Euler angles is cached.
+
 .. Created on Aug 15, 2012
 .. codeauthor:: Robert Langlois <rl2528@columbia.edu>
 '''
 from ..app import tracing
 from ..parallel import mpi_utility, process_tasks
-import logging, numpy
+from ..orient import spider_transforms
+import logging, numpy, collections
+import scipy.special
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
@@ -23,6 +31,10 @@ except:
     _spider_reconstruct=None
     tracing.log_import_error('Failed to load _spider_reconstruct.so', _logger)
 
+_slice_table_cache = collections.OrderedDict()
+_slice_table_cache_size = 64
+_kaiser_bessel_cache = {}
+
 def reconstruct3_bp3f_mp(image_size, gen1, gen2, align1=None, align2=None, **extra):
     '''Reconstruct three volumes using BP3F
     
@@ -38,6 +50,8 @@ def reconstruct3_bp3f_mp(image_size, gen1, gen2, align1=None, align2=None, **ext
              Input alignment file
     align2 : str
              Input alignment file
+    backproject_engine : int
+                         Backprojection engine: (0) SPIDER if available, otherwise NumPy (1) SPIDER (2) NumPy
     extra : dict
             Unused keyword arguments
     
@@ -51,7 +65,8 @@ def reconstruct3_bp3f_mp(image_size, gen1, gen2, align1=None, align2=None, **ext
           Reconstruction half volume (IF MPI, then only to the root, otherwise None)
     '''
     
-    return reconstruct3_mp(backproject_bp3f, finalize_bp3f, backproject_bp3f_array, image_size, gen1, gen2, align1, align2, **extra)
+    backproject, finalize = bp3f_engine(**extra)
+    return reconstruct3_mp(backproject, finalize, backproject_bp3f_array, image_size, gen1, gen2, align1, align2, **extra)
 
 def reconstruct_bp3f_mp(gen, image_size, align, npad=2, cleanup_fft=True, **extra):
     '''Reconstruct a single volume with the given image generator and alignment
@@ -67,6 +82,8 @@ def reconstruct_bp3f_mp(gen, image_size, align, npad=2, cleanup_fft=True, **extr
             Input alignment file
     npad : int
            Number of times to pad volume
+    backproject_engine : int
+                         Backprojection engine: (0) SPIDER if available, otherwise NumPy (1) SPIDER (2) NumPy
     extra : dict
             Unused keyword arguments
     
@@ -76,8 +93,9 @@ def reconstruct_bp3f_mp(gen, image_size, align, npad=2, cleanup_fft=True, **extr
           Reconstruction volume (IF MPI, then only to the root, otherwise None)
     '''
     
-    fftvol, weight = reconstruct_fft(backproject_bp3f, backproject_bp3f_array, gen, image_size, align, npad, **extra)
-    if mpi_utility.is_root(**extra): return finalize_bp3f(fftvol, weight, image_size, cleanup_fft)
+    backproject, finalize = bp3f_engine(**extra)
+    fftvol, weight = reconstruct_fft(backproject, backproject_bp3f_array, gen, image_size, align, npad, **extra)
+    if mpi_utility.is_root(**extra): return finalize(fftvol, weight, image_size, cleanup_fft)
 
 def finalize_bp3f(fftvol, weight, image_size, cleanup_fft):
     '''
@@ -144,6 +162,8 @@ def reconstruct3_bp3n_mp(image_size, gen1, gen2, align1=None, align2=None, **ext
              Input alignment file
     align2 : str
              Input alignment file
+    backproject_engine : int
+                         Backprojection engine: (0) SPIDER if available, otherwise NumPy (1) SPIDER (2) NumPy
     extra : dict
             Unused keyword arguments
     
@@ -157,7 +177,8 @@ def reconstruct3_bp3n_mp(image_size, gen1, gen2, align1=None, align2=None, **ext
           Reconstruction half volume (IF MPI, then only to the root, otherwise None)
     '''
     
-    return reconstruct3_mp(backproject_bp3n, finalize_bp3n, backproject_bp3n_array, image_size, gen1, gen2, align1, align2, **extra)
+    backproject, finalize = bp3n_engine(**extra)
+    return reconstruct3_mp(backproject, finalize, backproject_bp3n_array, image_size, gen1, gen2, align1, align2, **extra)
 
 def reconstruct_bp3n_mp(gen, image_size, align, npad=2, cleanup_fft=True, **extra):
     '''Reconstruct a single volume with the given image generator and alignment
@@ -169,6 +190,8 @@ def reconstruct_bp3n_mp(gen, image_size, align, npad=2, cleanup_fft=True, **extr
           Generate a sequence of images in the array format
     align : str
             Input alignment file
+    backproject_engine : int
+                         Backprojection engine: (0) SPIDER if available, otherwise NumPy (1) SPIDER (2) NumPy
     extra : dict
             Unused keyword arguments
     
@@ -179,8 +202,9 @@ def reconstruct_bp3n_mp(gen, image_size, align, npad=2, cleanup_fft=True, **extr
     '''
     
     
-    fftvol, weight = reconstruct_fft(backproject_bp3n, backproject_bp3n_array, gen, image_size, align, npad, **extra)
-    if mpi_utility.is_root(**extra): return finalize_bp3n(fftvol, weight, image_size, cleanup_fft)
+    backproject, finalize = bp3n_engine(**extra)
+    fftvol, weight = reconstruct_fft(backproject, backproject_bp3n_array, gen, image_size, align, npad, **extra)
+    if mpi_utility.is_root(**extra): return finalize(fftvol, weight, image_size, cleanup_fft)
     
 def finalize_bp3n(fftvol, weight, image_size, cleanup_fft):
     '''
@@ -220,7 +244,627 @@ def backproject_bp3n_array(image_size, npad=2, **extra):
     '''
     
     pad_size = image_size*npad
-    return dict(forvol=numpy.zeros((image_size+1, pad_size, pad_size), order='C', dtype=numpy.complex64), weight=numpy.zeros((image_size+1, pad_size, pad_size), order='C', dtype=numpy.int32))
+    return dict(forvol=numpy.zeros((pad_size, pad_size, image_size+1), order='C', dtype=numpy.complex64), weight=numpy.zeros((pad_size, pad_size, image_size+1), order='C', dtype=numpy.int32))
+
+def bp3f_engine(backproject_engine=0, **extra):
+    ''' Select the backprojection and finalize functions for BP3F
+    
+    :Parameters:
+    
+    backproject_engine : int
+                         Backprojection engine: (0) SPIDER if available, otherwise NumPy (1) SPIDER (2) NumPy
+    extra : dict
+            Unused keyword arguments
+    
+    :Returns:
+    
+    backproject : function
+                  Backproject a set of images into a Fourier volume
+    finalize : function
+               Convert the Fourier volume into a real space volume
+    '''
+    
+    if _use_spider(backproject_engine): return backproject_bp3f, finalize_bp3f
+    return grid_backproject_bp3f, grid_finalize_bp3f
+
+def bp3n_engine(backproject_engine=0, **extra):
+    ''' Select the backprojection and finalize functions for BP3N
+    
+    :Parameters:
+    
+    backproject_engine : int
+                         Backprojection engine: (0) SPIDER if available, otherwise NumPy (1) SPIDER (2) NumPy
+    extra : dict
+            Unused keyword arguments
+    
+    :Returns:
+    
+    backproject : function
+                  Backproject a set of images into a Fourier volume
+    finalize : function
+               Convert the Fourier volume into a real space volume
+    '''
+    
+    if _use_spider(backproject_engine): return backproject_bp3n, finalize_bp3n
+    return grid_backproject_bp3n, grid_finalize_bp3n
+
+def _use_spider(backproject_engine):
+    ''' Test if the compiled SPIDER engine should be used
+    
+    :Parameters:
+    
+    backproject_engine : int
+                         Backprojection engine: (0) SPIDER if available, otherwise NumPy (1) SPIDER (2) NumPy
+    
+    :Returns:
+    
+    spider : bool
+             True if the SPIDER engine should be used
+    '''
+    
+    if backproject_engine == 1 and _spider_reconstruct is None:
+        raise ImportError, "SPIDER backprojection requires _spider_reconstruct.so, which failed to load"
+    if backproject_engine == 0 and _spider_reconstruct is None:
+        _logger.debug("Using NumPy gridding for backprojection")
+    return backproject_engine != 2 and _spider_reconstruct is not None
+
+def grid_backproject_bp3f(gen, image_size, align, process_number, npad=2, process_image=None, psi='psi', theta='theta', phi='phi', forvol=None, weight=None, batch_size=8, **extra):
+    ''' Backproject a set of images into a Fourier volume with Kaiser-Bessel
+    gridding, equivalent to :py:func:`backproject_bp3f`
+    
+    :Parameters:
+    
+    gen : iterable
+          Enumerated images
+    image_size : int
+                 Image size
+    align : array
+            Alignment parameters (psi, theta, phi) for each image
+    process_number : int
+                     Process number
+    npad : int
+           Number of times to pad volume
+    process_image : function, optional
+                    Preprocess each image
+    psi : str
+          Name of the psi attribute of an alignment record
+    theta : str
+            Name of the theta attribute of an alignment record
+    phi : str
+          Name of the phi attribute of an alignment record
+    forvol : array, optional
+             Fourier volume to accumulate
+    weight : array, optional
+             Weight volume to accumulate
+    batch_size : int
+                 Number of images inserted at one time
+    extra : dict
+            Unused keyword arguments
+    
+    :Returns:
+    
+    forvol : array
+             Fourier volume
+    weight : array
+             Weight volume
+    '''
+    
+    try:
+        pad_size = image_size*npad
+        if forvol is None: forvol = numpy.zeros((pad_size/2+1, pad_size, pad_size), order='F', dtype=numpy.complex64)
+        if weight is None: weight = numpy.zeros((pad_size/2+1, pad_size, pad_size), order='F', dtype=numpy.float32)
+        if not forvol.flags.f_contiguous: forvol = forvol.T
+        if not weight.flags.f_contiguous: weight = weight.T
+        tabi, fltb = kaiser_bessel_table(pad_size)
+        for imgs, angs in _iter_batches(gen, align, batch_size, process_image, psi, theta, phi, **extra):
+            _grid_insert(forvol, weight, imgs, angs, npad, tabi, fltb)
+    except:
+        _logger.exception("Error in backproject worker")
+        raise
+    return forvol, weight
+
+def grid_backproject_bp3n(gen, image_size, align, process_number, npad=2, process_image=None, psi='psi', theta='theta', phi='phi', forvol=None, weight=None, batch_size=8, **extra):
+    ''' Backproject a set of images into a Fourier volume with nearest-neighbor
+    gridding, equivalent to :py:func:`backproject_bp3n`
+    
+    :Parameters:
+    
+    gen : iterable
+          Enumerated images
+    image_size : int
+                 Image size
+    align : array
+            Alignment parameters (psi, theta, phi) for each image
+    process_number : int
+                     Process number
+    npad : int
+           Number of times to pad volume
+    process_image : function, optional
+                    Preprocess each image
+    psi : str
+          Name of the psi attribute of an alignment record
+    theta : str
+            Name of the theta attribute of an alignment record
+    phi : str
+          Name of the phi attribute of an alignment record
+    forvol : array, optional
+             Fourier volume to accumulate
+    weight : array, optional
+             Count volume to accumulate
+    batch_size : int
+                 Number of images inserted at one time
+    extra : dict
+            Unused keyword arguments
+    
+    :Returns:
+    
+    forvol : array
+             Fourier volume
+    weight : array
+             Count volume
+    '''
+    
+    try:
+        pad_size = image_size*npad
+        if forvol is None: forvol = numpy.zeros((pad_size/2+1, pad_size, pad_size), order='F', dtype=numpy.complex64)
+        if weight is None: weight = numpy.zeros((pad_size/2+1, pad_size, pad_size), order='F', dtype=numpy.int32)
+        if not forvol.flags.f_contiguous: forvol = forvol.T
+        if not weight.flags.f_contiguous: weight = weight.T
+        for imgs, angs in _iter_batches(gen, align, batch_size, process_image, psi, theta, phi, **extra):
+            _grid_insert(forvol, weight, imgs, angs, npad)
+    except:
+        _logger.exception("Error in backproject worker")
+        raise
+    return forvol, weight
+
+def grid_finalize_bp3f(fftvol, weight, image_size, cleanup_fft):
+    ''' Convert a Kaiser-Bessel gridded Fourier volume into a real space volume,
+    equivalent to :py:func:`finalize_bp3f`
+    
+    The Fourier volume and weights are modified in place.
+    
+    :Parameters:
+    
+    fftvol : array
+             Fourier volume
+    weight : array
+             Weight volume
+    image_size : int
+                 Image size
+    cleanup_fft : bool
+                  Unused, the NumPy engine keeps no FFT plans
+    
+    :Returns:
+    
+    vol : array
+          Reconstruction volume (x, y, z)
+    '''
+    
+    if fftvol is None: return None
+    if not fftvol.flags.f_contiguous: fftvol = fftvol.T
+    if not weight.flags.f_contiguous: weight = weight.T
+    _symmetrize_plane0(fftvol, weight)
+    sel = weight > 0.1
+    fftvol[sel] /= weight[sel]
+    fftvol[numpy.logical_not(sel)] = 0
+    vol = _grid_volume(fftvol, image_size).astype(weight.dtype)
+    pad_size = fftvol.shape[1]
+    alpha, aaaa, nu = 6.5, 0.9*2.0/pad_size, 1.5
+    lr = _radius_squared(image_size)
+    inside = lr <= (image_size/2)**2
+    sigma = (2*numpy.pi*aaaa)**2*lr[inside]-alpha*alpha
+    art = numpy.sqrt(numpy.abs(sigma))
+    wkb0 = alpha**nu/scipy.special.iv(nu, alpha)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        wkb = numpy.where(sigma > 0, scipy.special.jv(nu, art), scipy.special.iv(nu, art))*wkb0/art**nu
+    wkb[numpy.abs(sigma) < 1.0e-7] = 1.0
+    vol[inside] /= numpy.abs(wkb)
+    return _remove_shell_mean(vol, lr, image_size).T
+
+def grid_finalize_bp3n(fftvol, weight, image_size, cleanup_fft):
+    ''' Convert a nearest-neighbor gridded Fourier volume into a real space volume,
+    equivalent to :py:func:`finalize_bp3n`
+    
+    The Fourier volume and counts are modified in place.
+    
+    :Parameters:
+    
+    fftvol : array
+             Fourier volume
+    weight : array
+             Count volume
+    image_size : int
+                 Image size
+    cleanup_fft : bool
+                  Unused, the NumPy engine keeps no FFT plans
+    
+    :Returns:
+    
+    vol : array
+          Reconstruction volume (x, y, z)
+    '''
+    
+    if fftvol is None: return None
+    if not fftvol.flags.f_contiguous: fftvol = fftvol.T
+    if not weight.flags.f_contiguous: weight = weight.T
+    _symmetrize_plane0(fftvol, weight)
+    sel = weight > 0
+    fftvol[sel] /= weight[sel]
+    vol = _grid_volume(fftvol, image_size).astype(numpy.float32)
+    return _remove_shell_mean(vol, _radius_squared(image_size), image_size).T
+
+def kaiser_bessel_table(pad_size, table_size=4999):
+    ''' Tabulate the generalized Kaiser-Bessel window used by BP3F
+    
+    :Parameters:
+    
+    pad_size : int
+               Size of the padded volume
+    table_size : int
+                 Number of entries in the table
+    
+    :Returns:
+    
+    tabi : array
+           Window indexed by the distance times `fltb`
+    fltb : float
+           Scale from distance to table index
+    '''
+    
+    key = (pad_size, table_size)
+    if key not in _kaiser_bessel_cache:
+        ln2, alpha = 2, 6.5
+        aaaa = 0.9*2.0/pad_size
+        s = numpy.arange(table_size, dtype=numpy.float32)/numpy.float32(float(table_size-1)/(ln2+1))/pad_size
+        xt = numpy.sqrt(numpy.maximum(1.0 - (s/aaaa)**2, 0.0))
+        tabi = numpy.sqrt(alpha*xt)*scipy.special.i1(alpha*xt)/(numpy.sqrt(alpha)*scipy.special.i1(alpha))
+        tabi[s > aaaa] = 0.0
+        _kaiser_bessel_cache[key] = (tabi.astype(numpy.float32), float(table_size)/(ln2+1))
+    return _kaiser_bessel_cache[key]
+
+def slice_table(image_size, npad, psi, theta, phi):
+    ''' Get the coordinates of a central slice in the 3D Fourier volume
+    
+    Each entry maps a Fourier component of the padded 2D projection to a
+    point in the half Fourier volume. Tables are cached for the most recently
+    used Euler angles.
+    
+    :Parameters:
+    
+    image_size : int
+                 Image size
+    npad : int
+           Number of times to pad volume
+    psi : float
+          Euler angle in degrees
+    theta : float
+          Euler angle in degrees
+    phi : float
+          Euler angle in degrees
+    
+    :Returns:
+    
+    src : array
+          Flat index of each component in the half 2D transform
+    flip : array
+           True if the component is conjugated to fall in the half volume
+    coords : array
+             Point in the half volume (3xN) for each component (x, y, z)
+    '''
+    
+    key = (image_size, npad, float(psi), float(theta), float(phi))
+    try:
+        table = _slice_table_cache.pop(key)
+    except KeyError:
+        table = _slice_table(image_size*npad, psi, theta, phi)
+        if len(_slice_table_cache) >= _slice_table_cache_size: _slice_table_cache.popitem(last=False)
+    _slice_table_cache[key] = table
+    return table
+
+def _slice_table(pad_size, psi, theta, phi):
+    ''' Calculate the coordinates of a central slice in the 3D Fourier volume
+    
+    :Parameters:
+    
+    pad_size : int
+               Size of the padded volume
+    psi : float
+          Euler angle in degrees
+    theta : float
+          Euler angle in degrees
+    phi : float
+          Euler angle in degrees
+    
+    :Returns:
+    
+    src : array
+          Flat index of each component in the half 2D transform
+    flip : array
+           True if the component is conjugated to fall in the half volume
+    coords : array
+             Point in the half volume (3xN) for each component (x, y, z)
+    '''
+    
+    n2 = pad_size/2
+    j, i = numpy.mgrid[-n2+1:n2+1, 0:n2+1]
+    sel = numpy.logical_and(i*i+j*j < pad_size*pad_size/4, numpy.logical_not(numpy.logical_and(i == 0, j < 0)))
+    i, j = i[sel], j[sel]
+    dm = spider_transforms.rotation_matrix(psi, theta, phi)[:2].astype(numpy.float32)
+    coords = numpy.dot(dm.T, numpy.vstack((i, j)).astype(numpy.float32))
+    flip = coords[0] < 0
+    coords[:, flip] = -coords[:, flip]
+    src = (j%pad_size)*(n2+1)+i
+    return src, flip, coords
+
+def _iter_batches(gen, align, batch_size, process_image, psi, theta, phi, **extra):
+    ''' Group images and their Euler angles into batches
+    
+    :Parameters:
+    
+    gen : iterable
+          Enumerated images
+    align : array
+            Alignment parameters (psi, theta, phi) for each image
+    batch_size : int
+                 Number of images in each batch
+    process_image : function
+                    Preprocess each image
+    psi : str
+          Name of the psi attribute of an alignment record
+    theta : str
+            Name of the theta attribute of an alignment record
+    phi : str
+          Name of the phi attribute of an alignment record
+    extra : dict
+            Keyword arguments passed to `process_image`
+    
+    :Returns:
+    
+    imgs : list
+           Batch of images
+    angs : list
+           Euler angles (psi, theta, phi) for each image
+    '''
+    
+    use_attr = len(align) > 0 and hasattr(align[0], psi)
+    imgs, angs = [], []
+    for i, img in gen:
+        a = align[i]
+        if process_image is not None: img = process_image(img, a, **extra)
+        imgs.append(img)
+        angs.append((getattr(a, psi), getattr(a, theta), getattr(a, phi)) if use_attr else (a[0], a[1], a[2]))
+        if len(imgs) == batch_size:
+            yield imgs, angs
+            imgs, angs = [], []
+    if len(imgs) > 0: yield imgs, angs
+
+def _grid_insert(forvol, weight, imgs, angs, npad, tabi=None, fltb=None):
+    ''' Insert a batch of projections into the half Fourier volume
+    
+    :Parameters:
+    
+    forvol : array
+             Fourier volume (x, y, z) in Fortran order
+    weight : array
+             Weight or count volume (x, y, z) in Fortran order
+    imgs : list
+           Batch of projections
+    angs : list
+           Euler angles (psi, theta, phi) for each projection
+    npad : int
+           Number of times to pad volume
+    tabi : array, optional
+           Kaiser-Bessel window, if None use nearest-neighbor gridding
+    fltb : float, optional
+           Scale from distance to window index
+    '''
+    
+    image_size = imgs[0].shape[0]
+    n = forvol.shape[1]
+    n2 = n/2
+    fimgs = _padded_fft(imgs, n)
+    vals, coords = [], []
+    for k, ang in enumerate(angs):
+        src, flip, coord = slice_table(image_size, npad, *ang)
+        val = fimgs[k].ravel()[src]
+        val[flip] = val[flip].conj()
+        vals.append(val)
+        coords.append(coord)
+    vals = numpy.concatenate(vals)
+    coords = numpy.hstack(coords)
+    ixn, iyn, izn = (numpy.floor(coords+0.5+n)-n).astype(numpy.int)
+    flat_vol = forvol.ravel(order='F')
+    flat_wgt = weight.ravel(order='F')
+    
+    if tabi is None:
+        sel = numpy.logical_and(ixn <= n2, numpy.logical_and(numpy.abs(iyn) <= n2, numpy.abs(izn) <= n2))
+        index = ixn[sel] + (n2+1)*(iyn[sel]%n + n*(izn[sel]%n))
+        _scatter_add(flat_vol, flat_wgt, index, vals[sel], numpy.ones(len(index), dtype=weight.dtype))
+        return
+    
+    ln2 = 2
+    sel = numpy.logical_and(ixn <= n2-ln2-1, numpy.logical_and(
+                            numpy.logical_and(iyn >= -n2+2+ln2, iyn <= n2-ln2-1),
+                            numpy.logical_and(izn >= -n2+2+ln2, izn <= n2-ln2-1)))
+    vals, coords = vals[sel], coords[:, sel]
+    ixn, iyn, izn = ixn[sel], iyn[sel], izn[sel]
+    offsets = numpy.arange(-ln2, ln2+1)[:, numpy.newaxis]
+    table = lambda d: tabi[numpy.floor(numpy.abs(d)*fltb+0.5).astype(numpy.int)]
+    ixp = ixn+offsets
+    iyp = (iyn+offsets)[:, numpy.newaxis]
+    wxy = table(coords[1]-iyp)*table(coords[0]-ixp)[numpy.newaxis]
+    sel = wxy != 0
+    point = numpy.nonzero(sel)[2]
+    wxy = wxy[sel]
+    sign = numpy.where(ixp >= 0, 1, -1)[numpy.newaxis]
+    index = (numpy.abs(ixp)[numpy.newaxis] + (n2+1)*((sign*iyp)%n))[sel]
+    sign = numpy.broadcast_to(sign, sel.shape)[sel]
+    vals = vals.astype(numpy.complex64)[point]
+    vals = numpy.where(sign > 0, vals, vals.conj())*wxy
+    izn = izn[point]
+    zfrac = coords[2][point]-izn
+    for lz in offsets.ravel():
+        tz = table(zfrac-lz)
+        sel = tz != 0
+        izp = (sign[sel]*(izn[sel]+lz))%n
+        _scatter_add(flat_vol, flat_wgt, index[sel] + (n2+1)*n*izp, vals[sel]*tz[sel], wxy[sel]*tz[sel])
+
+def _padded_fft(imgs, pad_size):
+    ''' Pad a batch of projections and calculate the half Fourier transform
+    
+    The mean outside the inscribed circle is subtracted from each projection
+    before padding and the transform is centered on the padded image.
+    
+    :Parameters:
+    
+    imgs : list
+           Batch of projections
+    pad_size : int
+               Size of the padded image
+    
+    :Returns:
+    
+    fimgs : array
+            Half Fourier transform of each padded projection (N, y, x)
+    '''
+    
+    image_size = imgs[0].shape[0]
+    y, x = numpy.ogrid[:image_size, :image_size]
+    outside = (x-image_size/2)**2+(y-image_size/2)**2 > (image_size/2)**2
+    beg = (pad_size-image_size)/2 + image_size%2
+    pad = numpy.zeros((len(imgs), pad_size, pad_size), dtype=numpy.float32)
+    for k, img in enumerate(imgs):
+        pad[k, beg:beg+image_size, beg:beg+image_size] = img - img[outside].mean(dtype=numpy.float64)
+    fimgs = numpy.fft.rfftn(pad, axes=(1, 2))
+    fimgs[:, 1::2, :] *= -1
+    fimgs[:, :, 1::2] *= -1
+    return fimgs
+
+def _scatter_add(flat_vol, flat_wgt, index, val, wgt):
+    ''' Add values and weights to a flat volume, summing repeated indices
+    
+    Repeated indices are summed with :py:func:`numpy.bincount` when there
+    are enough values to cover a good part of the volume, otherwise the
+    indices are sorted and summed with :py:meth:`numpy.ufunc.reduceat`.
+    
+    :Parameters:
+    
+    flat_vol : array
+               Flat Fourier volume
+    flat_wgt : array
+               Flat weight volume
+    index : array
+            Index of each value in the flat volume
+    val : array
+          Values to add
+    wgt : array
+          Weights to add
+    '''
+    
+    if len(index) == 0: return
+    if len(index)*4 >= len(flat_vol):
+        size = len(flat_vol)
+        flat_vol.real += numpy.bincount(index, val.real, minlength=size)
+        flat_vol.imag += numpy.bincount(index, val.imag, minlength=size)
+        flat_wgt += numpy.bincount(index, wgt, minlength=size).astype(flat_wgt.dtype)
+        return
+    order = numpy.argsort(index)
+    index = index[order]
+    beg = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(index))+1))
+    flat_vol[index[beg]] += numpy.add.reduceat(val[order], beg).astype(flat_vol.dtype)
+    flat_wgt[index[beg]] += numpy.add.reduceat(wgt[order], beg).astype(flat_wgt.dtype)
+
+def _symmetrize_plane0(fftvol, weight):
+    ''' Enforce Friedel symmetry on the x=0 plane of the half Fourier volume
+    
+    :Parameters:
+    
+    fftvol : array
+             Fourier volume (x, y, z)
+    weight : array
+             Weight or count volume (x, y, z)
+    '''
+    
+    n = fftvol.shape[1]
+    idx = numpy.arange(n)
+    idx = idx[idx != n/2]
+    iy, iz = numpy.meshgrid(idx, idx, indexing='ij')
+    sel = numpy.logical_or(iy > 0, iz > 0)
+    iy, iz = iy[sel], iz[sel]
+    my, mz = (-iy)%n, (-iz)%n
+    plane, wplane = fftvol[0], weight[0]
+    val = plane[iy, iz] + plane[my, mz].conj()
+    wgt = wplane[iy, iz] + wplane[my, mz]
+    plane[iy, iz] = val
+    wplane[iy, iz] = wgt
+
+def _grid_volume(fftvol, image_size):
+    ''' Transform a normalized half Fourier volume to real space and crop
+    the center
+    
+    :Parameters:
+    
+    fftvol : array
+             Fourier volume (x, y, z)
+    image_size : int
+                 Image size
+    
+    :Returns:
+    
+    vol : array
+          Cropped real space volume (z, y, x)
+    '''
+    
+    n = fftvol.shape[1]
+    fftvol = fftvol.T
+    fftvol[1::2] *= -1
+    fftvol[:, 1::2] *= -1
+    fftvol[:, :, 1::2] *= -1
+    vol = numpy.fft.irfftn(fftvol, s=(n, n, n))
+    beg = (n-image_size)/2 + image_size%2
+    return vol[beg:beg+image_size, beg:beg+image_size, beg:beg+image_size]
+
+def _radius_squared(image_size):
+    ''' Squared integer distance of each voxel from the center of the volume
+    
+    :Parameters:
+    
+    image_size : int
+                 Image size
+    
+    :Returns:
+    
+    lr : array
+         Squared distance (image_size, image_size, image_size)
+    '''
+    
+    c = image_size/2
+    z, y, x = numpy.ogrid[:image_size, :image_size, :image_size]
+    return (z-c)**2+(y-c)**2+(x-c)**2
+
+def _remove_shell_mean(vol, lr, image_size):
+    ''' Subtract the mean of the outer shell of the inscribed sphere and
+    zero the volume outside the sphere
+    
+    :Parameters:
+    
+    vol : array
+          Real space volume
+    lr : array
+         Squared distance of each voxel from the center
+    image_size : int
+                 Image size
+    
+    :Returns:
+    
+    vol : array
+          Real space volume
+    '''
+    
+    l2, l2p = (image_size/2)**2, (image_size/2-1)**2
+    vol -= vol[numpy.logical_and(lr >= l2p, lr <= l2)].mean(dtype=numpy.float64)
+    vol[lr > l2] = 0
+    return vol
 
 def reconstruct3_mp(backproject, finalize, make_array, image_size, gen1, gen2, align1=None, align2=None, npad=2, cleanup_fft=True, **extra):
     '''Reconstruct three volumes using BP3F
@@ -314,35 +958,27 @@ def reconstruct_fft(backproject, backproject_array, gen, image_size, align, npad
     :Returns:
         
     fftvol : array
-             Fourier volume
+             Fourier volume (summed over all nodes only on the root)
     weight : array
-             Weight volume
+             Weight volume (summed over all nodes only on the root)
     '''
     
     fftvol, weight = None, None
     shmem_array_info=backproject_array(image_size, npad) if shared else None
-    for val in process_tasks.iterate_reduce(gen, backproject, align=align, npad=npad, image_size=image_size, shmem_array_info=shmem_array_info, **extra):
+    for val in process_tasks.iterate_reduce(gen, backproject, align=align, npad=npad, image_size=image_size, shmem_array_info=shmem_array_info, shmem_reduce=shared, **extra):
         if isinstance(val, tuple): v, w = val
         elif isinstance(val, dict):
             v, w = val['forvol'], val['weight']
         else: raise ValueError, "iterate_reduce must return dict or tuple"
         if fftvol is None:
-            if shared:
-                fftvol = v.copy()
-                weight = w.copy()
-            else:
-                fftvol = v
-                weight = w
+            fftvol = v
+            weight = w
         else:
             fftvol += v
             weight += w
     assert(fftvol is not None)
     assert(weight is not None)
-    #_logger.info("begin-block_reduce1: %f"%numpy.sum(fftvol.real))
-    order = 'F' if fftvol.flags.f_contiguous else 'C'
-    mpi_utility.block_reduce(fftvol.ravel(order=order), **extra)
-    #_logger.info("begin-block_reduce2: %f -- %f"%(numpy.sum(fftvol.real), numpy.sum(tmp.real)))
-    order = 'F' if weight.flags.f_contiguous else 'C'
-    mpi_utility.block_reduce(weight.ravel(order=order), **extra)
+    mpi_utility.pipeline_reduce(fftvol, **extra)
+    mpi_utility.pipeline_reduce(weight, **extra)
     return fftvol, weight
 
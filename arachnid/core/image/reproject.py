@@ -1,10 +1,22 @@
 ''' Reproject a 2D slice from a 3D volume
 
+The 3Q projectors use :py:func:`reproject_3q_batch` by default, a NumPy 
+projection engine that follows the conventions of the SPIDER 3Q projector
+in the compiled `_spider_reproject` extension. It calculates the rotation 
+matrices for every set of Euler angles in one step, shares the volume 
+between forked worker processes without copying it and writes each 
+projection directly into the output stack, which may be a memory map. For 
+large sets of angles, it can also project by extracting central slices from
+the Fourier transform of the volume.
+
 .. Created on Mar 8, 2013
 .. codeauthor:: Robert Langlois <rl2528@columbia.edu>
 '''
 from ..app import tracing
 from ..parallel import mpi_utility #, process_tasks
+from ..orient import spider_transforms
+import multiprocessing.sharedctypes
+import scipy.ndimage
 import logging, numpy
 
 _logger = logging.getLogger(__name__)
@@ -16,7 +28,9 @@ try:
 except:
     _spider_reproject=None
     tracing.log_import_error('Failed to load _spider_reproject.so module', _logger)
-    
+
+_sphere_cache = {}
+
 def project_polar(img, inner_radius=None, outer_radius=None, out=None):
     ''' Project an image into polar space
     
@@ -46,17 +60,38 @@ def project_polar(img, inner_radius=None, outer_radius=None, out=None):
 
 def _tofortran(out): return out.T if not out.flags.f_contiguous else out
 
-def reproject_3q_mp(vol, rad, ang, out=None, thread_count=0):
+def reproject_3q_mp(vol, rad, ang, out=None, thread_count=0, reproject_engine=0):
     '''
     '''
     
-    return reproject_mp(_spider_reproject.reproject_3q_omp, vol, rad, ang, out, thread_count)
+    return reproject_mp(_reproject_3q_func(reproject_engine), vol, rad, ang, out, thread_count)
 
 def reproject_3q(vol, rad, ang, out=None, **extra):
     '''
     '''
     
-    return reproject_mp_mpi(_spider_reproject.reproject_3q_omp, vol, rad, ang, out, **extra)
+    return reproject_mp_mpi(_reproject_3q_func(**extra), vol, rad, ang, out, **extra)
+
+def _reproject_3q_func(reproject_engine=0, **extra):
+    ''' Get the 3Q projector
+    
+    :Parameters:
+    
+    reproject_engine : int
+                       Projector: (0) NumPy batch engine (1) compiled SPIDER
+    extra : dict
+            Unused keyword arguments
+    
+    :Returns:
+    
+    func : function
+           Compiled 3Q projector, None for the NumPy batch engine
+    '''
+    
+    if reproject_engine == 1:
+        if _spider_reproject is None: raise ImportError, "Failed to load _spider_reproject.so module"
+        return _spider_reproject.reproject_3q_omp
+    return None
 
 def reproject_3q_single(vol, rad, ang, out=None, **extra):
     '''
@@ -84,11 +119,198 @@ def reproject_mp(reproject_func, vol, rad, ang, out=None, thread_count=0):
     '''
     '''
     
+    if reproject_func is None: return reproject_3q_batch(vol, rad, ang, out, thread_count)
     if out is None:
         out = numpy.zeros((len(ang), vol.shape[0], vol.shape[1]), dtype=vol.dtype)
     reproject_func(vol.T, out.T, ang.T, rad)
     return out
 
+def reproject_3q_batch(vol, rad, ang, out=None, thread_count=1, fourier=False, npad=2, **extra):
+    ''' Project a volume for each set of Euler angles
+    
+    Each projection is the sum along z of the volume rotated by the Euler 
+    angles, sampled with trilinear interpolation within a sphere of the 
+    given radius, as with the SPIDER 3Q projector.
+    
+    If `fourier` is True, then each projection is the inverse transform of a
+    central slice taken with trilinear interpolation from the transform of 
+    the padded volume, masked by the sphere. This costs much less for each
+    projection, but requires the transform of the padded volume and gives 
+    a close approximation.
+    
+    :Parameters:
+    
+    vol : array
+          Volume (z, y, x)
+    rad : float
+          Radius of the sphere in the volume to project
+    ang : array
+          Euler angles (psi, theta, phi) in degrees for each projection
+    out : array, optional
+          Output stack of projections (N, y, x), may be a memory map
+    thread_count : int
+                   Number of worker processes sharing the volume
+    fourier : bool
+              Project by extracting central slices in Fourier space
+    npad : int
+           Number of times to pad the volume for Fourier projection
+    extra : dict
+            Unused keyword arguments
+    
+    :Returns:
+    
+    out : array
+          Stack of projections (N, y, x)
+    '''
+    
+    ang = numpy.asarray(ang)
+    if out is None:
+        out = numpy.zeros((len(ang), vol.shape[1], vol.shape[2]), dtype=vol.dtype)
+    if len(ang) == 0: return out
+    rot = spider_transforms.rotation_matrix(ang[:, 0], ang[:, 1], ang[:, 2]).transpose(2, 1, 0)
+    if fourier:
+        vol = _fourier_volume(vol, rad, npad)
+        project = lambda i, proj: _project_fourier(vol, rot[i], out.shape[1:], proj)
+    else:
+        coords, index = sphere_coords(vol.shape, rad)
+        project = lambda i, proj: _project_real(vol, rot[i], coords, index, proj)
+    if thread_count < 2:
+        for i in xrange(len(ang)): project(i, out[i])
+        return out
+    _project_shared(project, out, min(thread_count, len(ang)))
+    return out
+
+def _project_shared(project, out, worker_count):
+    ''' Project in forked worker processes
+    
+    The workers inherit the volume from the parent without copying it and
+    each one writes every `worker_count`-th projection. A writable memory map
+    is shared with the workers directly, otherwise the projections are 
+    written to shared memory and copied to the output stack.
+    
+    :Parameters:
+    
+    project : function
+              Write the projection for an index, called as `project(i, proj)`
+    out : array
+          Output stack of projections (N, y, x)
+    worker_count : int
+                   Number of worker processes
+    '''
+    
+    if isinstance(out, numpy.memmap) and out.mode in ('r+', 'w+'):
+        shared = out
+    else:
+        base = multiprocessing.sharedctypes.RawArray('b', out.nbytes)
+        shared = numpy.ctypeslib.as_array(base).view(out.dtype).reshape(out.shape)
+    def worker(start):
+        for i in xrange(start, len(out), worker_count): project(i, shared[i])
+    workers = [multiprocessing.Process(target=worker, args=(i, )) for i in xrange(worker_count)]
+    for p in workers: p.start()
+    for p in workers: p.join()
+    failed = len([p for p in workers if p.exitcode != 0])
+    if failed > 0: raise ValueError, "Projection failed in %d of %d worker processes"%(failed, worker_count)
+    if shared is not out: out[:] = shared
+
+def sphere_coords(shape, rad):
+    ''' Get the voxels within a sphere centered on the volume
+    
+    :Parameters:
+    
+    shape : tuple
+            Shape of the volume (z, y, x)
+    rad : float
+          Radius of the sphere
+    
+    :Returns:
+    
+    coords : array
+             Offset of each voxel from the center (3xN) (x, y, z)
+    index : array
+            Flat index of each voxel in a projection (y, x)
+    '''
+    
+    key = (tuple(shape), float(rad))
+    if key not in _sphere_cache:
+        c = numpy.asarray(shape)/2
+        z, y, x = numpy.ogrid[:shape[0], :shape[1], :shape[2]]
+        z, y, x = numpy.nonzero((z-c[0])**2+(y-c[1])**2+(x-c[2])**2 <= rad*rad)
+        _sphere_cache[key] = (numpy.vstack((x-c[2], y-c[1], z-c[0])).astype(numpy.float64), y*shape[2]+x)
+    return _sphere_cache[key]
+
+def _project_real(vol, rot, coords, index, out):
+    ''' Project the voxels within a sphere of a rotated volume
+    
+    :Parameters:
+    
+    vol : array
+          Volume (z, y, x)
+    rot : array
+          Rotation matrix
+    coords : array
+             Offset of each voxel within the sphere from the center (3xN)
+    index : array
+            Flat index of each voxel in the projection
+    out : array
+          Output projection (y, x)
+    '''
+    
+    pos = numpy.dot(rot, coords)[::-1] + (numpy.asarray(vol.shape)/2)[:, numpy.newaxis]
+    sel = numpy.all(numpy.logical_and(pos >= 0, pos < (numpy.asarray(vol.shape)-1)[:, numpy.newaxis]), axis=0)
+    val = scipy.ndimage.map_coordinates(vol, pos[:, sel], order=1, prefilter=False)
+    out[:] = numpy.bincount(index[sel], val, minlength=out.size).reshape(out.shape)
+
+def _fourier_volume(vol, rad, npad):
+    ''' Transform a volume masked by a sphere for Fourier projection
+    
+    :Parameters:
+    
+    vol : array
+          Volume (z, y, x)
+    rad : float
+          Radius of the sphere
+    npad : int
+           Number of times to pad the volume
+    
+    :Returns:
+    
+    fvol : tuple
+           Real and imaginary part of the centered transform of the padded volume
+    '''
+    
+    n = max(vol.shape)*npad
+    coords, index = sphere_coords(vol.shape, rad)
+    c = numpy.asarray(vol.shape)/2
+    pad = numpy.zeros((n, n, n), dtype=numpy.float32)
+    pad[(coords[2]+n/2).astype(numpy.int), (coords[1]+n/2).astype(numpy.int), (coords[0]+n/2).astype(numpy.int)] = \
+        vol[(coords[2]+c[0]).astype(numpy.int), (coords[1]+c[1]).astype(numpy.int), (coords[0]+c[2]).astype(numpy.int)]
+    fvol = numpy.fft.fftshift(numpy.fft.fftn(numpy.fft.ifftshift(pad)))
+    return (fvol.real.copy(), fvol.imag.copy())
+
+def _project_fourier(fvol, rot, shape, out):
+    ''' Project a volume by extracting a central slice from its transform
+    
+    :Parameters:
+    
+    fvol : tuple
+           Real and imaginary part of the centered transform of the padded volume
+    rot : array
+          Rotation matrix
+    shape : tuple
+            Shape of the projection (y, x)
+    out : array
+          Output projection (y, x)
+    '''
+    
+    n = fvol[0].shape[0]
+    ky, kx = numpy.mgrid[-n/2:n-n/2, -n/2:n-n/2]
+    pos = numpy.dot(rot[:, :2], numpy.vstack((kx.ravel(), ky.ravel())))[::-1] + n/2
+    fslice = scipy.ndimage.map_coordinates(fvol[0], pos, order=1, prefilter=False) + \
+             1j*scipy.ndimage.map_coordinates(fvol[1], pos, order=1, prefilter=False)
+    proj = numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(fslice.reshape((n, n))))).real
+    by, bx = n/2-shape[0]/2, n/2-shape[1]/2
+    out[:] = proj[by:by+shape[0], bx:bx+shape[1]]
+
 """
 def reproject_mp(reproject_func, vol, rad, ang, out=None, thread_count=0):
     '''
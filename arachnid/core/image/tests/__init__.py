@@ -7,7 +7,10 @@
     :toctree: api_generated/
     :template: api_module.rst
     
+    test_alignment
     test_ndimage_utility
+    test_reconstruct
+    test_reproject
 
 '''
 
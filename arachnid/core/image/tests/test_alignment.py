@@ -0,0 +1,18 @@
+''' Unit tests for the alignment module
+'''
+from .. import alignment
+import numpy, numpy.testing, scipy.fftpack
+
+def test_xcorr_dft_peak_batch():
+    '''
+    '''
+    
+    rng = numpy.random.RandomState(0)
+    img = rng.randn(64, 64)
+    frames = [scipy.fftpack.fft2(numpy.roll(numpy.roll(img, i, 0), -i, 1)+rng.randn(64, 64)*0.1) for i in xrange(5)]
+    kernel = rng.rand(64, 64)
+    pairs = numpy.column_stack(numpy.triu_indices(len(frames), 1))
+    for usfac in (1, 2, 10):
+        peaks = numpy.asarray([alignment.xcorr_dft_peak(frames[i]*kernel, frames[j], usfac, 10) for i, j in pairs])
+        numpy.testing.assert_allclose(alignment.xcorr_dft_peak_batch(frames, frames, pairs, usfac, 10, kernel, batch_mem=0.2), peaks)
+        numpy.testing.assert_allclose(alignment.xcorr_dft_peak_batch(frames, frames, pairs, usfac, 10, kernel, thread_count=2, batch_mem=0), peaks)
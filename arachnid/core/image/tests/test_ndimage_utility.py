@@ -145,6 +145,49 @@ def test_powerspec_avg():
     avg = ndimage_utility.powerspec_avg(orig, 6)
     avg;
 
+def test_powerspec_sum_batch():
+    '''
+    '''
+    
+    orig = numpy.random.rand(5,11,11).astype(numpy.float32)
+    for pad in (1, 2):
+        avg, total = ndimage_utility.powerspec_sum(orig, pad)
+        bavg, btotal = ndimage_utility.powerspec_sum_batch(orig, pad, batch_size=2)
+        numpy.testing.assert_allclose(btotal, total)
+        numpy.testing.assert_allclose(ndimage_utility.powerspec_full(bavg), avg.real, rtol=1e-5, atol=1e-6)
+
+def test_crop_window_batch():
+    '''
+    '''
+    
+    img = numpy.random.rand(64,64)
+    coords = [(0, 20, 30), (0, 32, 32), (0, 40, 25)]
+    wins = ndimage_utility.crop_window_batch(img, coords, 16)
+    for i, (id, x, y) in enumerate(coords):
+        numpy.testing.assert_allclose(wins[i], img[y-8:y+8, x-8:x+8])
+    dog = ndimage_utility.dog_batch(wins, 4)
+    for i in xrange(len(wins)):
+        numpy.testing.assert_allclose(dog[i], ndimage_utility.dog(wins[i], 4))
+
+def test_replace_outlier_batch():
+    '''
+    '''
+    
+    rng = numpy.random.RandomState(0)
+    imgs = rng.rand(4, 32, 32).astype(numpy.float32)
+    imgs[:, 5, 7] = -20
+    imgs[1, 20, 3] = 30
+    imgs[2, 11, 12] = 25
+    imgs[3] = 1
+    ref = numpy.asarray([ndimage_utility.replace_outlier(img, 4.0, 4.0) for img in imgs])
+    out = ndimage_utility.replace_outlier_batch(imgs, 4.0, 4.0)
+    for i in xrange(3):
+        assert(out[i, 5, 7] == imgs[i][imgs[i] > -20].min())
+    numpy.testing.assert_allclose(out[1, 20, 3], ref[1, 20, 3])
+    numpy.testing.assert_allclose(out[2, 11, 12], ref[2, 11, 12])
+    numpy.testing.assert_allclose(out, ref)
+    numpy.testing.assert_allclose(ndimage_utility.replace_outlier_batch(imgs, 4.0, 4.0, imgs), ref)
+
 def test_biggest_object():
     '''
     '''
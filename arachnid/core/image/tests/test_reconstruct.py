@@ -0,0 +1,69 @@
+''' Unit tests for the reconstruct module
+'''
+from .. import reconstruct, reproject
+import numpy, scipy.ndimage
+
+def _volume(n=24):
+    '''
+    '''
+    
+    rng = numpy.random.RandomState(0)
+    vol = scipy.ndimage.gaussian_filter(rng.rand(n, n, n), 2).astype(numpy.float32)
+    z, y, x = numpy.ogrid[:n, :n, :n]
+    vol[(z-8)**2+(y-12)**2+(x-15)**2 < 9] += 1
+    vol[(z-n/2)**2+(y-n/2)**2+(x-n/2)**2 > (n/2-3)**2] = 0
+    return vol
+
+def _angles(step=8):
+    '''
+    '''
+    
+    rng = numpy.random.RandomState(1)
+    ang = []
+    for theta in numpy.arange(0, 180, step):
+        for phi in numpy.arange(0, 360, step/max(numpy.sin(numpy.deg2rad(theta)), step/360.0)):
+            ang.append((rng.rand()*360, theta, phi))
+    return numpy.asarray(ang, dtype=numpy.float32)
+
+def _cc(vol1, vol2):
+    '''
+    '''
+    
+    vol1 = vol1-vol1.mean()
+    vol2 = vol2-vol2.mean()
+    return numpy.sum(vol1*vol2)/numpy.sqrt(numpy.sum(vol1*vol1)*numpy.sum(vol2*vol2))
+
+def _round_trip(reconstruct_mp, backproject_engine):
+    '''
+    '''
+    
+    vol = _volume()
+    ang = _angles()
+    proj = reproject.reproject_3q_batch(vol, vol.shape[0]/2-1, ang)
+    for thread_count in (1, 3):
+        rec = reconstruct_mp(iter(proj), vol.shape[0], ang, backproject_engine=backproject_engine, thread_count=thread_count)
+        assert(rec.shape == vol.shape)
+        # The volume is indexed (x, y, z)
+        assert(_cc(rec.T, vol) > 0.95)
+        assert(_cc(rec.T, vol) > _cc(rec, vol))
+    return rec
+
+def test_grid_bp3f():
+    '''
+    '''
+    
+    _round_trip(reconstruct.reconstruct_bp3f_mp, 2)
+
+def test_grid_bp3n():
+    '''
+    '''
+    
+    _round_trip(reconstruct.reconstruct_bp3n_mp, 2)
+
+def test_grid_spider():
+    '''
+    '''
+    
+    if reconstruct._spider_reconstruct is None: return
+    for reconstruct_mp in (reconstruct.reconstruct_bp3f_mp, reconstruct.reconstruct_bp3n_mp):
+        assert(_cc(_round_trip(reconstruct_mp, 2), _round_trip(reconstruct_mp, 1)) > 0.99)
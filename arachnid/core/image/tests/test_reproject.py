@@ -0,0 +1,94 @@
+''' Unit tests for the reproject module
+'''
+from .. import reproject
+import numpy, numpy.testing, scipy.ndimage
+import tempfile
+import shutil
+import os
+
+def _volume(n=24):
+    '''
+    '''
+    
+    rng = numpy.random.RandomState(0)
+    vol = scipy.ndimage.gaussian_filter(rng.rand(n, n, n), 2).astype(numpy.float32)
+    z, y, x = numpy.ogrid[:n, :n, :n]
+    vol[(z-8)**2+(y-12)**2+(x-15)**2 < 9] += 1
+    return vol
+
+def _angles(count=20):
+    '''
+    '''
+    
+    rng = numpy.random.RandomState(1)
+    return rng.rand(count, 3)*[360, 180, 360]
+
+def test_reproject_fourier():
+    '''
+    '''
+    
+    vol = _volume()
+    ang = _angles()
+    rad = vol.shape[0]/2-2
+    real = reproject.reproject_3q_batch(vol, rad, ang)
+    fourier = reproject.reproject_3q_batch(vol, rad, ang, fourier=True, thread_count=2)
+    assert(fourier.shape == real.shape)
+    for i in xrange(len(ang)):
+        cc = numpy.corrcoef(real[i].ravel(), fourier[i].ravel())[0, 1]
+        assert(cc > 0.98)
+
+def test_reproject_memmap():
+    '''
+    '''
+    
+    vol = _volume()
+    ang = _angles()
+    rad = vol.shape[0]/2-2
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'proj.dat')
+        out = numpy.memmap(filename, dtype=vol.dtype, mode='w+', shape=(len(ang), vol.shape[1], vol.shape[2]))
+        res = reproject.reproject_3q_batch(vol, rad, ang, out=out, thread_count=2)
+        assert(res is out)
+        out.flush()
+        del out, res
+        proj = numpy.fromfile(filename, dtype=vol.dtype).reshape((len(ang), vol.shape[1], vol.shape[2]))
+        numpy.testing.assert_allclose(proj, reproject.reproject_3q_batch(vol, rad, ang))
+    finally:
+        shutil.rmtree(path)
+
+def test_reproject_identity():
+    '''
+    '''
+    
+    vol = _volume()
+    rad = vol.shape[0]/2-2
+    n = vol.shape[0]
+    z, y, x = numpy.ogrid[:n, :n, :n]
+    mask = (z-n/2)**2+(y-n/2)**2+(x-n/2)**2 <= rad*rad
+    proj = reproject.reproject_3q_batch(vol, rad, [(0, 0, 0)])
+    assert(proj.shape == (1, n, n))
+    numpy.testing.assert_allclose(proj[0], (vol*mask).sum(axis=0), rtol=1e-5, atol=1e-4)
+
+def test_reproject_single_angle():
+    '''
+    '''
+    
+    vol = _volume()
+    ang = _angles()
+    rad = vol.shape[0]/2-2
+    proj = reproject.reproject_3q_batch(vol, rad, ang)
+    numpy.testing.assert_allclose(reproject.reproject_3q_batch(vol, rad, ang[3:4]), proj[3:4])
+    numpy.testing.assert_allclose(reproject.reproject_3q_batch(vol, rad, ang[3:4], fourier=True)[0], 
+                                  reproject.reproject_3q_batch(vol, rad, ang, fourier=True)[3])
+
+def test_reproject_3q_mp():
+    '''
+    '''
+    
+    vol = _volume()
+    ang = _angles()
+    rad = vol.shape[0]/2-2
+    proj = reproject.reproject_3q_batch(vol, rad, ang)
+    numpy.testing.assert_allclose(reproject.reproject_3q_mp(vol, rad, ang, thread_count=3), proj)
+    numpy.testing.assert_allclose(reproject.reproject_3q_mp(vol, rad, ang, thread_count=0), proj)
@@ -256,6 +256,66 @@ def otsu(data, bins=0):
     else: index_high = index+1
     return (thresholds[index_low]+thresholds[index_high]) / 2
 
+def otsu_batch(data, bins=0):
+    ''' Otsu's threshold selection algorithm applied to each row of the data
+    
+    This gives the same thresholds as calling :py:func:`otsu` on each row.
+    
+    :Parameters:
+        
+        data : numpy.ndarray
+               Data to find threshold, one set per row (or per leading index)
+        bins : int
+               Number of bins [if 0, use sqrt(len(data))]
+    
+    :Returns:
+        
+        th : numpy.ndarray
+             Optimal threshold to divide classes for each row
+    '''
+    
+    data = numpy.sort(numpy.asarray(data).reshape((len(data), -1)), axis=1)
+    n = data.shape[1]
+    if bins <= 0: bins = int(numpy.sqrt(n))
+    if bins > n: bins = n
+    var = _running_variance_rows(data)
+    rvar = _running_variance_rows(data[:, ::-1])[:, ::-1]
+    
+    rng = n/bins
+    thresholds = data[:, 1:n:rng]
+    idx = numpy.arange(0,n-1,rng, dtype=numpy.int)
+    score_low = (var[:, idx] * idx)
+    idx = numpy.arange(1,n,rng, dtype=numpy.int)
+    score_high = (rvar[:, idx] * (n - idx))
+    scores = score_low + score_high
+    if scores.shape[1] == 0: return thresholds[:, 0]
+    index = numpy.argmin(scores, axis=1)
+    rows = numpy.arange(len(data))
+    index_low = numpy.maximum(index-1, 0)
+    index_high = numpy.minimum(index+1, thresholds.shape[1]-1)
+    return (thresholds[rows, index_low]+thresholds[rows, index_high]) / 2
+
+def _running_variance_rows(x):
+    '''Compute the running variance of :py:func:`running_variance` for each row
+    
+    :Parameters:
+        
+        x : numpy.ndarray
+            Sorted data, one set per row
+    
+    :Returns:
+            
+        var : numpy.ndarray
+              Running variance of each row
+    '''
+    n = x.shape[1]
+    m = x.cumsum(axis=1) / numpy.arange(1,n+1)
+    x_minus_mprev = x[:, 1:]-m[:, :-1]
+    x_minus_m = x[:, 1:]-m[:, 1:]
+    s = (x_minus_mprev*x_minus_m).cumsum(axis=1)
+    var = s / numpy.arange(2,n+1)
+    return numpy.hstack((numpy.zeros((len(x), 1)),var))
+
 def running_variance(x, axis=None):
     '''Given a vector x, compute the variance for x[0:i]
     
@@ -23,6 +23,7 @@
     format_utility
     namedtuple_utility
     format_alignment
+    format_cache
 
 .. filename_utility
 .. emimage
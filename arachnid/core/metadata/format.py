@@ -77,8 +77,8 @@ If the data is in a NumPy array, then the header must be added as an additional
 from formats import csv, prediction, spiderdoc, spidersel, star #, frealign, mrccoord
 #from format_utility import ParseFormatError, WriteFormatError
 from factories import namedtuple_factory
-import format_utility, namedtuple_utility,spider_utility
-import os, numpy, logging
+import format_utility, namedtuple_utility,spider_utility, format_cache
+import os, numpy, logging, functools
 
 #__formats = [star, spiderdoc, spidersel, frealign, mrccoord, csv, prediction]
 __formats = [star, spiderdoc, spidersel, csv, prediction]
@@ -164,6 +164,58 @@ def replace_extension(filename, filter, formats=None):
     filename = os.path.splitext(str(filename))[0]
     return filename + "." + extension(filter, formats)
 
+def source_filename(filename, header=None, spiderid=None, id_len=0, prefix=None, replace_ext=False, nospiderid=False, **extra):
+    '''Get the path of a document and its header from a filename template
+    
+    >>> from arachnid.core.metadata.format import *
+    >>> source_filename("doc001.spi=id;x;y", spiderid=2)
+    ('doc002.spi', ['id', 'x', 'y'])
+    
+    :Parameters:
+    
+        filename : str
+                 Filename template used to create new filename
+        header : list
+                 List of string values
+        spiderid : id-like object
+                  Filename, string or integer to use as an ID
+        id_len : integer
+                 Maximum ID length
+        prefix : str, optional
+                 Prefix to add to start of the filename
+        replace_ext : bool
+                      If True and spiderid is a filename with an extension, replace current filename
+                      with this extension.
+        nospiderid : bool
+                    If true remove the numeric suffix from the filename
+        extra : dict
+                Unused extra keyword arguments
+    
+    :Returns:
+        
+        filename : str
+                 New filename stripped of header and with new ID
+        header : list
+                 List of strings describing the header
+    '''
+    
+    filename, header = format_utility.parse_header(filename, header)
+    if spiderid is not None: 
+        filename = spider_utility.spider_filename(filename, spiderid, id_len)
+    elif nospiderid:
+        filename = spider_utility.spider_filepath(filename)
+        basename, ext = os.path.splitext(filename)
+        if basename[-1] == '_' or basename[-1] == '-':
+            filename = basename[:len(basename)-1]+ext
+    filename = format_utility.add_prefix(filename, prefix)
+    if replace_ext and isinstance(spiderid, str):
+        ext = os.path.splitext(spiderid)[1]
+        if ext != "":
+            base = os.path.splitext(filename)[0]
+            filename = base+ext
+    filename = os.path.expanduser(filename)
+    return filename, header
+
 def open_file(filename, mode='r', header=None, spiderid=None, id_len=0, prefix=None, replace_ext=False, nospiderid=False, **extra):
     '''Get the extension associated with the given file filter
     
@@ -228,22 +280,8 @@ def open_file(filename, mode='r', header=None, spiderid=None, id_len=0, prefix=N
     
     _logger.debug("open_file: "+str(filename)+" - mode: %s"%(mode))
     if header is not None: _logger.debug("Using initial header: %s"%str(header))
-    filename, header = format_utility.parse_header(filename, header)
+    filename, header = source_filename(filename, header, spiderid, id_len, prefix, replace_ext, nospiderid)
     _logger.debug("Using header: %s"%str(header))
-    if spiderid is not None: 
-        filename = spider_utility.spider_filename(filename, spiderid, id_len)
-    elif nospiderid:
-        filename = spider_utility.spider_filepath(filename)
-        basename, ext = os.path.splitext(filename)
-        if basename[-1] == '_' or basename[-1] == '-':
-            filename = basename[:len(basename)-1]+ext
-    filename = format_utility.add_prefix(filename, prefix)
-    if replace_ext and isinstance(spiderid, str):
-        ext = os.path.splitext(spiderid)[1]
-        if ext != "":
-            base = os.path.splitext(filename)[0]
-            filename = base+ext
-    filename = os.path.expanduser(filename)
     try:
         fin = open(filename, mode)
     except:
@@ -390,7 +428,7 @@ def is_readable(filename, **extra):
     except: return False
     return True
     
-def read(filename, columns=None, header=None, ndarray=False, map_ids=None, factory=namedtuple_factory, **extra):
+def read(filename, columns=None, header=None, ndarray=False, map_ids=None, factory=namedtuple_factory, cache=False, **extra):
     '''Read a document from the specified file
     
     This function calls open_file to create the filename, then calls get_formats to
@@ -433,11 +471,16 @@ def read(filename, columns=None, header=None, ndarray=False, map_ids=None, facto
                  Header to use for read-in list
         ndarray : bool
                   If True, return tuple (array, header) where header is a list of strings
-                  describing each column
+                  describing each column. A document whose first row is numeric is parsed
+                  in bulk with :py:func:`read_columns`.
         map_ids : str
                   If not empty, return a dictionary mapping given id to full list of values
         factory : Factory
                   Class or module that creates the container for the values returned by the parser
+        cache : bool
+                If True, load the document from its binary sidecar when it is current, otherwise
+                parse it and save a sidecar, see :py:mod:`~arachnid.core.metadata.format_cache`.
+                Only numeric reads are cached.
         extra : dict
                 Unused extra keyword arguments
     
@@ -447,27 +490,38 @@ def read(filename, columns=None, header=None, ndarray=False, map_ids=None, facto
                List of namedtuples or other container created by the factory
     '''
     
-    if ndarray:extra['numeric']=True
+    if cache and (ndarray or extra.get('numeric')):
+        source, key = source_filename(filename, _copy_header(header), **extra)
+        data = format_cache.load(source, key)
+        if data is not None: return _read_sidecar(data, columns, ndarray, map_ids, factory, **extra)
+    else: cache = False
+    
+    bulk = ndarray and columns is None and map_ids is None and factory is namedtuple_factory and not extra.get('numeric')
+    if ndarray: extra['numeric']=True
     
     _logger.debug("read: "+str(filename))
     origheader = [] if header is None else list(header)
+    bulkheader = _copy_header(header)
     tablename=[]
     fin, format, header, first_vals = get_format(filename, getformat=False, header=header, tablename=tablename, **extra)
-    # TODO: columns not finished
-    if columns is not None:
-        cols = []
-        for c in columns:
-            try:
-                cols.append(int(c))
-            except:
-                try:
-                    cols.append(header.index(c))
-                except:
-                    raise ValueError, "Cannot find column "+str(c)+" in header: "+",".join(header)
-    factory_bldr = factory.create(header, first_vals, **extra)
+    if bulk and len(first_vals) > 0 and all([not isinstance(format_utility.convert(v), str) for v in first_vals]):
+        fin.close()
+        try:
+            names, data = _read_columns(filename, header=_copy_header(bulkheader), **extra)
+        except format_utility.ParseFormatError:
+            _logger.debug("Cannot parse document in bulk, falling back on tuples: %s"%filename)
+        else:
+            if all([d.dtype != numpy.object for d in data]):
+                if cache: format_cache.save(source, key, names, data)
+                return numpy.column_stack(data).astype(numpy.float), names
+            _logger.debug("Document has string columns after the first row, falling back on tuples: %s"%filename)
+        header = _copy_header(bulkheader)
+        fin, format, header, first_vals = get_format(filename, getformat=False, header=header, tablename=tablename, **extra)
+    cols, names, first_vals = _project(columns, header, first_vals)
+    factory_bldr = factory.create(names, first_vals, **extra)
     try:
         vals = [factory_bldr(first_vals)] if len(first_vals) > 0 else []
-        vals.extend(map(factory_bldr, format.reader(fin, header, **extra)))
+        vals.extend(map(factory_bldr, format.reader(fin, header, columns=cols, **extra)))
     except format_utility.MultipleEntryException, exp:
         firstvals = vals
         vals = {tablename[0]: firstvals}
@@ -477,9 +531,10 @@ def read(filename, columns=None, header=None, ndarray=False, map_ids=None, facto
             try:
                 header = [] if len(origheader) == 0 else list(origheader)
                 header, first_vals = format.read_header(fin, header=header, data_found=True, **extra)
-                factory_bldr = factory.create(header, first_vals, **extra)
+                cols, names, first_vals = _project(columns, header, first_vals)
+                factory_bldr = factory.create(names, first_vals, **extra)
                 if len(first_vals) > 0: currvals.append(factory_bldr(first_vals))
-                currvals.extend(map(factory_bldr, format.reader(fin, header, **extra)))
+                currvals.extend(map(factory_bldr, format.reader(fin, header, columns=cols, **extra)))
             except format_utility.MultipleEntryException, exp:
                 tablename[0] = exp.args[0]
             else: 
@@ -491,10 +546,254 @@ def read(filename, columns=None, header=None, ndarray=False, map_ids=None, facto
         _logger.debug("first_vals: %s"%str(first_vals))
         _logger.debug("format: %s"%str(format))
         raise
+    if cache and columns is None and isinstance(vals, list) and len(vals) > 0:
+        format_cache.save(source, key, names, zip(*vals))
     if ndarray: return namedtuple_utility.tuple2numpy(vals)
     elif map_ids: return format_utility.map_object_list(vals, map_ids)
     return vals
 
+def read_columns(filename, columns=None, header=None, as_dict=False, lazy_strings=False, cache=False, **extra):
+    '''Read a document in bulk, column by column, into NumPy arrays
+    
+    Unlike :py:func:`read`, this function does not create a tuple for each row. Each 
+    column is split in a single pass and converted at once into an integer, 
+    floating point or string array; the values of a string column are interned, 
+    so repeated values, e.g. a micrograph filename, share memory.
+    
+    >>> from arachnid.core.metadata.format import *
+    >>> data = read_columns("data.star", columns=['rlnImageName', 'rlnDefocusU'])
+    >>> data.dtype.names
+    ('rlnImageName', 'rlnDefocusU')
+    >>> data['rlnDefocusU']
+    array([13538, 13293])
+    
+    .. note::
+        
+        Only the first table of a Star file is read.
+    
+    :Parameters:
+    
+        filename : str
+                  Path of a file
+        columns : list, optional
+                  List of column names or indices to read, default all
+        header : str, optional
+                 Header to use for read-in list
+        as_dict : bool
+                  If True, return a dictionary mapping each column name to an array
+                  rather than a structured array
+        lazy_strings : bool
+                       If True and `as_dict` is True, the string columns are
+                       :py:class:`~arachnid.core.metadata.format_utility.LazyColumn`
+                       objects that read their values on first use
+        cache : bool
+                If True, load the document from its binary sidecar when it is current, otherwise
+                parse it and save a sidecar, see :py:mod:`~arachnid.core.metadata.format_cache`.
+                The arrays are then memory mapped and strings have a fixed width.
+        extra : dict
+                Unused extra keyword arguments
+    
+    :Returns:
+        
+        data : array or dict
+               Structured array or dictionary mapping each column name to an array
+    '''
+    
+    if cache:
+        source, key = source_filename(filename, _copy_header(header), **extra)
+        out = format_cache.load(source, key)
+        if out is None:
+            names, data = _read_columns(filename, None, _copy_header(header), **extra)
+            out = format_cache.save(source, key, names, data)
+        if out is not None:
+            cols, names, _ = _project(columns, list(out.dtype.names), [])
+            if as_dict: return dict([(n, out[n]) for n in names])
+            return out[names] if cols is not None else out
+    
+    names, data = _read_columns(filename, columns, header, lazy_strings and as_dict, **extra)
+    if as_dict: return dict(zip(names, data))
+    out = numpy.empty(len(data[0]) if len(data) > 0 else 0, dtype=[(str(n), d.dtype) for n, d in zip(names, data)])
+    for n, d in zip(names, data): out[str(n)] = d
+    return out
+
+def _read_columns(filename, columns=None, header=None, lazy_strings=False, **extra):
+    '''Read a document in bulk, column by column, into NumPy arrays
+    
+    :Parameters:
+    
+        filename : str
+                  Path of a file
+        columns : list, optional
+                  List of column names or indices to read, default all
+        header : str, optional
+                 Header to use for read-in list
+        lazy_strings : bool
+                       If True, string columns are read on first use
+        extra : dict
+                Unused extra keyword arguments
+    
+    :Returns:
+        
+        names : list
+                List of strings describing each column
+        data : list
+               List of arrays (or lazy columns) for each column
+    '''
+    
+    extra.pop('numeric', None)
+    origheader = _copy_header(header)
+    fin, format, header, first_vals = get_format(filename, getformat=False, header=header, **extra)
+    cols = _column_index(columns, header)
+    if lazy_strings:
+        strings = set([c for c in cols if isinstance(format_utility.convert(first_vals[c]), str)])
+        if len(strings) == len(cols) and len(cols) > 0: strings.discard(cols[0])
+    else: strings = set()
+    
+    read = [c for c in cols if c not in strings]
+    if len(read) == 0: fin.close()
+    elif hasattr(format, 'column_reader'):
+        vals = format.column_reader(fin, header, first_vals, read, **extra)
+    else:
+        rows = [first_vals]
+        try: rows.extend(format.reader(fin, header, **extra))
+        except format_utility.MultipleEntryException: pass
+        vals = [[row[c] for row in rows] for c in read]
+    
+    data = dict(zip(read, [format_utility.convert_column(v) for v in vals])) if len(read) > 0 else {}
+    length = len(data.values()[0]) if len(data) > 0 else 0
+    for c in strings:
+        data[c] = format_utility.LazyColumn(functools.partial(_read_lazy_column, filename, c, origheader, extra), length)
+    return [header[c] for c in cols], [data[c] for c in cols]
+
+def _read_sidecar(data, columns, ndarray, map_ids, factory, **extra):
+    '''Create the values returned by :py:func:`read` from a sidecar
+    
+    :Parameters:
+    
+        data : array
+               Structured array loaded from the sidecar
+        columns : list
+                  List of columns to use
+        ndarray : bool
+                  If True, return tuple (array, header)
+        map_ids : str
+                  If not empty, return a dictionary mapping given id to full list of values
+        factory : Factory
+                  Class or module that creates the container for the values
+        extra : dict
+                Unused extra keyword arguments
+    
+    :Returns:
+        
+        val1 : list or tuple (array,list) or dict
+               List of namedtuples or other container created by the factory
+    '''
+    
+    cols, names, _ = _project(columns, list(data.dtype.names), [])
+    if cols is not None: data = data[names]
+    if ndarray and all([data.dtype[n].kind in 'biuf' for n in names]):
+        return numpy.column_stack([data[n] for n in names]).astype(numpy.float), names
+    rows = zip(*format_cache.columns(data))
+    factory_bldr = factory.create(names, rows[0] if len(rows) > 0 else [], **extra)
+    vals = map(factory_bldr, rows)
+    if ndarray: return namedtuple_utility.tuple2numpy(vals)
+    elif map_ids: return format_utility.map_object_list(vals, map_ids)
+    return vals
+
+def _read_lazy_column(filename, column, header, extra):
+    '''Read a single column of a document
+    
+    :Parameters:
+    
+        filename : str
+                  Path of a file
+        column : int
+                 Index of the column
+        header : str
+                 Header to use for read-in list
+        extra : dict
+                Unused extra keyword arguments
+    
+    :Returns:
+        
+        data : array
+               Values of the column
+    '''
+    
+    return _read_columns(filename, [column], _copy_header(header), **extra)[1][0]
+
+def _copy_header(header):
+    '''Copy a header, which is updated in place when a document is read
+    
+    :Parameters:
+    
+        header : list or dict or str
+                 Header to copy
+    
+    :Returns:
+        
+        header : list or dict or str
+                 Copy of the header
+    '''
+    
+    if isinstance(header, dict): return dict(header)
+    if header is None or isinstance(header, str): return header
+    return list(header)
+
+def _column_index(columns, header):
+    '''Find the index of each column in the header
+    
+    :Parameters:
+    
+        columns : list
+                  List of column names or indices, None for all
+        header : list
+                 List of strings describing each column
+    
+    :Returns:
+        
+        index : list
+                Index of each column
+    '''
+    
+    if columns is None: return range(len(header))
+    cols = []
+    for c in columns:
+        try:
+            cols.append(int(c))
+        except:
+            try:
+                cols.append(header.index(c))
+            except:
+                raise ValueError, "Cannot find column "+str(c)+" in header: "+",".join(header)
+    return cols
+
+def _project(columns, header, first_vals):
+    '''Select the requested columns from the header and first row
+    
+    :Parameters:
+    
+        columns : list
+                  List of column names or indices, None for all
+        header : list
+                 List of strings describing each column
+        first_vals : list
+                     List of values from the first data line
+    
+    :Returns:
+        
+        cols : list
+               Index of each column, None for all
+        header : list
+                 Header of the selected columns
+        first_vals : list
+                     Selected values from the first data line
+    '''
+    
+    if columns is None: return None, header, first_vals
+    cols = _column_index(columns, header)
+    return cols, [header[c] for c in cols], [first_vals[c] for c in cols] if len(first_vals) > 0 else first_vals
+
 def write(filename, values, mode='w', factory=namedtuple_factory, **extra):
     ''' Write a document to some format either specified or determined from extension
 
@@ -555,18 +854,149 @@ def write(filename, values, mode='w', factory=namedtuple_factory, **extra):
         #raise ValueError, "Nothing to write - array has length 0"
         return filename
     
-    format = get_format_by_ext(filename, **extra)
-    if format !=  spiderdoc and os.path.splitext(filename)[1][1:] != format.extension():
-        filename = os.path.splitext(filename)[0] + "." + format.extension()
-    filename, fout = open_file(filename, mode=mode, **extra)
-    values = factory.ensure_container(values, **extra)
-    extra['header'] = factory.get_header(values, **extra)
-    extra['header'] = format.write_header(fout, values, mode, **extra)
-    if hasattr(format, 'float_format'): extra['float_format']=format.float_format()
-    if hasattr(format, 'valid_entry'): extra['valid_entry']=format.valid_entry
-    format.write_values(fout, factory.format_iter(values, **extra), **extra)
-    fout.close()
-    return filename
+    writer = DocumentWriter(filename, mode, factory, **extra)
+    try: writer.write(values)
+    finally: writer.close()
+    return writer.filename
+
+class DocumentWriter(object):
+    ''' Write a document in batches of rows
+    
+    The file is opened and the header written, unless the mode is 'a', when the first
+    batch arrives. Each batch, a list of namedtuples or an array, is then formatted as
+    a single block of text and appended to the file, so a document can grow as results
+    come in without being rewritten.
+    
+    >>> from arachnid.core.metadata.format import *
+    >>> with DocumentWriter("sel_0001.dat", header=['id', 'micrograph', 'stack_id']) as writer:
+    ...     writer.write(numpy.asarray([[1, 1, 1], [2, 1, 2]]))
+    ...     writer.write(numpy.asarray([[3, 2, 1]]))
+    
+    :Parameters:
+    
+        filename : str
+                  Output filename
+        mode : str
+               Open file mode, default write over existing
+        factory : Factory
+                  Class or module that creates takes a row of values
+                  and converts them to a string
+        extra : dict
+                Keyword arguments for :py:func:`write`, e.g. header, format, prefix or spiderid
+    '''
+    
+    def __init__(self, filename, mode='w', factory=namedtuple_factory, **extra):
+        '''Create a writer for the given document
+        '''
+        
+        self.header = extra.pop('header', None)
+        if isinstance(self.header, str): self.header = self.header.split(',')
+        self.format = get_format_by_ext(filename, **extra)
+        if self.format !=  spiderdoc and os.path.splitext(filename)[1][1:] != self.format.extension():
+            filename = os.path.splitext(filename)[0] + "." + self.format.extension()
+        self.filename = source_filename(filename, **extra)[0]
+        self.mode = mode
+        self.factory = factory
+        self.write_offset = extra.pop('write_offset', 1)
+        if hasattr(self.format, 'float_format'): extra['float_format']=self.format.float_format()
+        self.extra = extra
+        self.fout = None
+        self.count = 0
+    
+    def __enter__(self):
+        '''Support the context manager protocol
+        '''
+        
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        '''Close the document
+        '''
+        
+        self.close()
+    
+    def write(self, values):
+        '''Append a batch of rows to the document
+        
+        :Parameters:
+        
+            values : list or array
+                     List of namedtuples or array of values
+        '''
+        
+        if len(values) == 0: return
+        extra = self.extra
+        if hasattr(values, 'shape') and values.ndim == 2 and values.dtype.kind in 'biuf' and self.header is not None:
+            if values.shape[1] != len(self.header):
+                raise ValueError, "Number of columns does not match header: %d != %d"%(values.shape[1], len(self.header))
+        else:
+            values = self.factory.ensure_container(values, header=self.header, **extra)
+            if len(values) == 0: return
+            if self.header is None: self.header = list(self.factory.get_header(values, **extra))
+        if self.fout is None:
+            self.filename, self.fout = open_file(self.filename, mode=self.mode)
+            self.header = list(self.format.write_header(self.fout, values, self.mode, header=self.header, **extra))
+        if hasattr(self.format, 'valid_entry'):
+            if hasattr(values, 'shape'): values = self.factory.ensure_container(values, header=self.header, **extra)
+            values = [v for v in values if self.format.valid_entry(v)]
+            if len(values) == 0: return
+        write_offset = self.write_offset+self.count
+        if not self._write_block(values, write_offset):
+            self.format.write_values(self.fout, self.factory.format_iter(values, header=self.header, **extra), header=self.header, write_offset=write_offset, **extra)
+        self.count += len(values)
+    
+    def _write_block(self, values, write_offset):
+        '''Write a batch of rows as a single block, when the format and values support it
+        
+        :Parameters:
+        
+            values : list or array
+                     List of namedtuples or array of values
+            write_offset : int
+                           ID of the first row in the batch
+        
+        :Returns:
+        
+            written : bool
+                      False if the rows must be written one at a time
+        '''
+        
+        if not hasattr(self.format, 'write_block'): return False
+        float_format = self.extra.get('float_format', "%.8g")
+        if hasattr(values, 'shape'):
+            if len(self.header) != values.shape[1]: return False
+            rows, formats = values, [float_format]*values.shape[1]
+        else:
+            if self.factory is not namedtuple_factory or not hasattr(values[0], '_fields'): return False
+            if tuple(self.header) != tuple(values[0]._fields):
+                try: rows = [tuple([getattr(v, h) for h in self.header]) for v in values]
+                except AttributeError: return False
+            else: rows = values
+            formats = []
+            for c, v in enumerate(rows[0]):
+                if isinstance(v, basestring):
+                    if not all([isinstance(r[c], basestring) for r in rows]): return False
+                    formats.append("%s")
+                else: formats.append(float_format)
+        try:
+            self.format.write_block(self.fout, rows, formats, header=self.header, write_offset=write_offset, **self.extra)
+        except (TypeError, ValueError):
+            return False
+        return True
+    
+    def flush(self):
+        '''Flush the rows written so far to disk
+        '''
+        
+        if self.fout is not None: self.fout.flush()
+    
+    def close(self):
+        '''Close the document
+        '''
+        
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
 
 def write_dataset(output, feat, id=None, label=None, good=None, header=None, sort=False, id_len=0, prefix=None, **extra):
     '''Write a set of non-tuple arrays representing a dataset to a file
@@ -0,0 +1,189 @@
+''' Binary sidecar cache for parsed metadata documents
+
+A document read with `cache=True` is saved, once parsed, as a structured
+array in a hidden NumPy file beside it, `.<filename>.<header>.<version>.npy`.
+The header key is a digest of the header used to read the document and the
+version key a digest of its size and modification time, so a sidecar no
+longer matches once the document changes. Saving a new sidecar removes the
+stale versions read with the same header; those read with other headers are
+kept.
+
+A sidecar is loaded with a memory map rather than parsed, and string columns
+are stored as fixed width strings. If the directory of the document is not
+writable, the document is simply parsed every time.
+'''
+import os
+import hashlib
+import numpy
+import logging
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.INFO)
+
+_key_len = 8
+
+def sidecar(filename, header=None):
+    ''' Get the name of the sidecar for the current version of a document
+
+    :Parameters:
+
+    filename : str
+               Path of the document
+    header : list or dict, optional
+             Header used to read the document
+
+    :Returns:
+
+    sidecar : str
+              Path of the sidecar, None if the document does not exist
+    '''
+
+    try: st = os.stat(filename)
+    except OSError: return None
+    if isinstance(header, dict): header = sorted(header.items())
+    hkey = hashlib.md5(repr(header)).hexdigest()[:_key_len]
+    vkey = hashlib.md5(repr((st.st_size, st.st_mtime))).hexdigest()[:_key_len]
+    path, base = os.path.split(filename)
+    return os.path.join(path, '.%s.%s.%s.npy'%(base, hkey, vkey))
+
+def load(filename, header=None):
+    ''' Load the sidecar of a document with a memory map
+
+    :Parameters:
+
+    filename : str
+               Path of the document
+    header : list or dict, optional
+             Header used to read the document
+
+    :Returns:
+
+    data : array
+           Structured array, None if there is no current sidecar
+    '''
+
+    cache = sidecar(filename, header)
+    if cache is None or not os.path.exists(cache): return None
+    try: data = numpy.load(cache, mmap_mode='r')
+    except (IOError, ValueError):
+        _logger.debug("Cannot load sidecar: %s"%cache)
+        return None
+    _logger.debug("Loaded sidecar: %s"%cache)
+    return data
+
+def save(filename, header, names, columns):
+    ''' Save the values of a document to a sidecar
+
+    :Parameters:
+
+    filename : str
+               Path of the document
+    header : list or dict
+             Header used to read the document
+    names : list
+            Name of each column
+    columns : list
+              Values of each column
+
+    :Returns:
+
+    data : array
+           Structured array saved to the sidecar, None if the values
+           cannot be stored or the sidecar cannot be written
+    '''
+
+    cache = sidecar(filename, header)
+    if cache is None: return None
+    try:
+        columns = [_column_array(c) for c in columns]
+        data = numpy.empty(len(columns[0]) if len(columns) > 0 else 0, dtype=[(str(n), c.dtype) for n, c in zip(names, columns)])
+    except ValueError, e:
+        _logger.debug("Cannot cache %s: %s"%(filename, str(e)))
+        return None
+    for n, c in zip(names, columns): data[str(n)] = c
+    tmp = "%s.%d.tmp"%(cache, os.getpid())
+    try:
+        fout = open(tmp, 'wb')
+        try: numpy.save(fout, data)
+        finally: fout.close()
+        os.rename(tmp, cache)
+    except (IOError, OSError), e:
+        _logger.debug("Cannot write sidecar %s: %s"%(cache, str(e)))
+        if os.path.exists(tmp): os.unlink(tmp)
+        return None
+    remove_stale(filename, cache)
+    return data
+
+def remove_stale(filename, current=None):
+    ''' Remove the sidecars of a document read with the same header
+    as the current one, except the current one
+
+    :Parameters:
+
+    filename : str
+               Path of the document
+    current : str, optional
+              Path of the sidecar to keep, if None remove every
+              sidecar of the document
+    '''
+
+    path, base = os.path.split(filename)
+    prefix = '.%s.'%base
+    length = len(prefix)+2*_key_len+5
+    if current is not None:
+        current = os.path.basename(current)
+        prefix = current[:len(prefix)+_key_len+1]
+    try: listing = os.listdir(path if path != "" else ".")
+    except OSError: return
+    for f in listing:
+        if f.startswith(prefix) and f.endswith('.npy') and f != current and len(f) == length:
+            try: os.unlink(os.path.join(path, f))
+            except OSError: pass
+
+def columns(data):
+    ''' Convert each column of a sidecar to a list of Python values
+
+    Whole numbers in a floating point column are converted to integers,
+    value by value, as :py:func:`~arachnid.core.metadata.format_utility.convert`
+    does when the document is parsed.
+
+    :Parameters:
+
+    data : array
+           Structured array
+
+    :Returns:
+
+    columns : list
+              List of values for each column
+    '''
+
+    vals = []
+    for n in data.dtype.names:
+        c = data[n]
+        if c.dtype.kind == 'f':
+            whole = numpy.isfinite(c)
+            whole[whole] = c[whole] == numpy.floor(c[whole])
+            vals.append([int(v) if w else v for v, w in zip(c.tolist(), whole.tolist())])
+        else: vals.append(c.tolist())
+    return vals
+
+def _column_array(column):
+    ''' Convert the values of a column to an array that can be saved
+
+    :Parameters:
+
+    column : list or array
+             Values of a column
+
+    :Returns:
+
+    column : array
+             Numeric or fixed width string array
+    '''
+
+    if isinstance(column, numpy.ndarray) and column.dtype != numpy.object: return column
+    kinds = set([type(v) for v in column])
+    if kinds.issubset((int, long, float, bool, numpy.int64, numpy.float64)): return numpy.asarray(column)
+    if kinds.issubset((str, numpy.string_)): return numpy.asarray(column, dtype=numpy.string_)
+    raise ValueError, "Column has values of mixed or unsupported types: %s"%",".join([k.__name__ for k in kinds])
@@ -10,6 +10,7 @@ from type_utility import is_float_int
 import collections
 import operator
 import functools
+import numpy
 import os
 import logging
 
@@ -252,6 +253,189 @@ def convert(val):
         except: pass
     return val
 
+def split_columns(tokens, ncol, columns=None):
+    '''Split a flat list of tokens into columns
+    
+    >>> from arachnid.core.metadata.format_utility import *
+    >>> split_columns(['1', '572', '228', '2', '738', '144'], 3, [0, 2])
+    [['1', '2'], ['228', '144']]
+    
+    Args:
+    
+        tokens : list
+                 Flat list of values, row after row
+        ncol : int
+               Number of values in each row
+        columns : list, optional
+                  Position of each column to extract in a row, default all
+    
+    Returns:
+
+        val : list
+              List of values for each column
+    '''
+    
+    if len(tokens) % ncol != 0:
+        raise ParseFormatError, "Number of values is not a multiple of the row length: %d %% %d != 0"%(len(tokens), ncol)
+    if columns is None: columns = xrange(ncol)
+    return [tokens[c::ncol] for c in columns]
+
+def convert_column(vals, numeric=True):
+    '''Convert a column of string values to an array
+    
+    The column is converted in bulk to an integer or floating point
+    array, if every value supports the conversion, otherwise to an object
+    array of interned strings.
+    
+    >>> from arachnid.core.metadata.format_utility import *
+    >>> convert_column(['1', '2'])
+    array([1, 2])
+    >>> convert_column(['1', '2.5'])
+    array([ 1. ,  2.5])
+    
+    Args:
+    
+        vals : list
+               List of string values
+        numeric : bool
+                  If False, always return a string array
+    
+    Returns:
+
+        val : array
+              Array of converted values
+    '''
+    
+    if numeric:
+        for dtype in (numpy.int, numpy.float):
+            try: return numpy.array(vals, dtype=dtype)
+            except (ValueError, OverflowError): pass
+    return numpy.array([intern(v) for v in vals], dtype=numpy.object)
+
+class LazyColumn(object):
+    '''Column of values loaded on first use
+    
+    Args:
+    
+        load : functor
+               Function that returns the array of values
+        length : int
+                 Number of values in the column
+    '''
+    
+    def __init__(self, load, length):
+        '''Create a column that calls `load` on first use
+        '''
+        
+        self.load = load
+        self.length = length
+        self.values = None
+    
+    def __len__(self):
+        '''Get the number of values in the column
+        
+        Returns:
+        
+            val : int
+                  Number of values
+        '''
+        
+        return self.length
+    
+    def __getitem__(self, index):
+        '''Get values from the column
+        
+        Args:
+        
+            index : int or slice or array
+                    Index of the values
+        
+        Returns:
+        
+            val : object
+                  Selected values
+        '''
+        
+        return self.materialize()[index]
+    
+    def __iter__(self):
+        '''Iterate over the values in the column
+        
+        Returns:
+        
+            val : iterator
+                  Iterator over the values
+        '''
+        
+        return iter(self.materialize())
+    
+    def __array__(self, dtype=None):
+        '''Convert the column to an array
+        
+        Args:
+        
+            dtype : dtype, optional
+                    Type of the array
+        
+        Returns:
+        
+            val : array
+                  Values of the column
+        '''
+        
+        vals = self.materialize()
+        return vals if dtype is None else vals.astype(dtype)
+    
+    def materialize(self):
+        '''Load the values of the column, if not already loaded
+        
+        Returns:
+        
+            val : array
+                  Values of the column
+        '''
+        
+        if self.values is None:
+            self.values = self.load()
+            self.load = None
+        return self.values
+
+def format_block(rows, formats, separator=' ', index=None, index_format="%d "):
+    '''Format a block of rows with a single string formatting operation
+    
+    >>> from arachnid.core.metadata.format_utility import *
+    >>> format_block([(1, 0.5), (2, 0.25)], ['%d', '%g'], ',')
+    '1,0.5\n2,0.25\n'
+    
+    Args:
+    
+        rows : list or array
+               List of tuples or 2D array of values
+        formats : list
+                  String format for each column
+        separator : str
+                    Separator between columns
+        index : list, optional
+                Value that starts each row
+        index_format : str
+                       String format for the value that starts each row
+    
+    Returns:
+
+        val : str
+              Formatted rows, each terminated by a newline
+    '''
+    
+    if len(rows) == 0: return ""
+    fmt = (index_format if index is not None else "")+separator.join(formats)+"\n"
+    if hasattr(rows, 'ravel'):
+        if index is not None: rows = numpy.column_stack((index, rows))
+        flat = rows.ravel().tolist()
+    elif index is not None:
+        flat = [v for i, row in zip(index, rows) for v in ((i,)+tuple(row))]
+    else: flat = [v for row in rows for v in row]
+    return (fmt*len(rows)) % tuple(flat)
+
 def parse_header(filename, header=None):
     ''' Parse a header specified at the end of the given filename
     
@@ -138,6 +138,44 @@ def reader(filename, header=[], numeric=False, columns=None, **extra):
     finally:
         fin.close()
 
+def column_reader(filename, header=[], first_vals=[], columns=None, **extra):
+    '''Read the remaining values of a CSV file in bulk, column by column
+    
+    .. sourcecode:: py
+        
+        >>> header = []
+        >>> fin = open("data.csv", 'r')
+        >>> header, first_vals = read_header(fin, header)
+        >>> column_reader(fin, header, first_vals, [0, 2])
+        [['1/1', '1/2'], ['0.00025182', '0.00023578']]
+    
+    :Parameters:
+    
+    filename : str or stream
+               Input filename or input stream
+    header : list
+             List of strings describing each column
+    first_vals : list
+                 List of string values from the first data line
+    columns : list
+              List of columns to read otherwise None (all columns)
+    extra : dict
+            Unused keyword arguments
+    
+    :Returns:
+    
+    val : list
+          List of string values for each column
+    '''
+    
+    fin = open(filename, 'r') if isinstance(filename, str) else filename
+    try: text = fin.read()
+    finally: fin.close()
+    text = ",".join([line.strip() for line in text.split('\n') if line.strip() != ""])
+    if columns is None: columns = range(len(header))
+    vals = format_utility.split_columns(text.split(',') if text != "" else [], len(header), columns)
+    return [[first_vals[c]]+v for c, v in zip(columns, vals)]
+
 def parse_line(line, numeric=False, columns=None, hlen=None):
     ''' Parse a line of values in the CSV format
     
@@ -164,7 +202,7 @@ def parse_line(line, numeric=False, columns=None, hlen=None):
     vals = line.split(",")
     if hlen is not None and hlen != len(vals): 
         raise format_utility.ParseFormatError, "Header length does not match values: "+str(hlen)+" != "+str(len(vals))+" --> "+str(vals)
-    if columns is not None: vals = vals[columns]
+    if columns is not None: vals = [vals[c] for c in columns]
     if numeric: return [format_utility.convert(v) for v in vals]
     return vals
 
@@ -238,6 +276,34 @@ def write_values(filename, values, csv_separtor=',', **extra):
         fout.write(csv_separtor.join(v)+"\n")
     if isinstance(filename, str): fout.close()
         
+def write_block(filename, rows, formats, csv_separtor=',', **extra):
+    '''Write a block of comma separated values (CSV) with a single formatting
+    operation
+    
+    .. sourcecode:: py
+        
+        >>> write_block("data.csv", [("1/1", 1, 0.00025182)], ["%s", "%.8g", "%.8g"])
+        >>> os.system("more data.csv")
+        1/1,1,0.00025182
+    
+    :Parameters:
+    
+    filename : str or stream
+               Output filename or stream
+    rows : list or array
+           List of tuples or 2D array of values
+    formats : list
+              String format for each column
+    csv_separtor : str
+                   Seperator for values
+    extra : dict
+            Unused keyword arguments
+    '''
+    
+    fout = open(filename, 'w') if isinstance(filename, str) else filename
+    fout.write(format_utility.format_block(rows, formats, csv_separtor))
+    if isinstance(filename, str): fout.close()
+
 ############################################################################################################
 # Extension and Filters                                                                                    #
 ############################################################################################################
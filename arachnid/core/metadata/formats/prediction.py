@@ -200,7 +200,7 @@ def parse_line(line, numeric=False, columns=None, hlen=None):
     vals = line.split('\t')[1:]
     if hlen is not None and hlen != len(vals): 
         raise format_utility.ParseFormatError, "Header length does not match values: "+str(hlen)+" != "+str(len(vals))+" --> "+str(vals)
-    if columns is not None: vals = vals[columns]
+    if columns is not None: vals = [vals[c] for c in columns]
     if numeric: return [format_utility.convert(v) for v in vals]
     return vals
 
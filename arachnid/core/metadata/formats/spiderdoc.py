@@ -198,6 +198,51 @@ def reader(filename, header=[], numeric=False, columns=None, **extra):
     finally:
         fin.close()
 
+def column_reader(filename, header=[], first_vals=[], columns=None, **extra):
+    '''Read the remaining values of a spider document in bulk, column by column
+    
+    .. sourcecode:: py
+        
+        >>> header = ["id", "x", "y"]
+        >>> fin = open("data001.spi", 'r')
+        >>> header, first_vals = read_header(fin, header)
+        >>> column_reader(fin, header, first_vals, [0, 2])
+        [['1', '2', '3'], ['228.00', '144.00', '298.00']]
+    
+    :Parameters:
+    
+    filename : str or stream
+               Input filename or input stream
+    header : list
+             List of strings describing each column
+    first_vals : list
+                 List of string values from the first data line
+    columns : list
+              List of columns to read otherwise None (all columns)
+    extra : dict
+            Unused keyword arguments
+    
+    :Returns:
+    
+    val : list
+          List of string values for each column
+    '''
+    
+    fin = open(filename, 'r') if isinstance(filename, str) else filename
+    try: text = fin.read()
+    finally: fin.close()
+    if ';' in text:
+        text = "\n".join([line for line in text.split('\n') if line.lstrip()[:1] != ';'])
+    if columns is None: columns = range(len(header))
+    text = text.lstrip()
+    tot = len(text.split('\n', 1)[0].split())
+    if tot == 0: return [[first_vals[c]] for c in columns]
+    if tot == len(header)+2: index = [c+2 for c in columns]
+    elif tot == len(header)+1: index = [c+1 if c > 0 else 0 for c in columns]
+    else: raise format_utility.ParseFormatError, "Header length does not match values: "+str(len(header))+" != "+str(tot)
+    vals = format_utility.split_columns(text.split(), tot, index)
+    return [[first_vals[c]]+v for c, v in zip(columns, vals)]
+
 def parse_line(line, numeric=False, columns=None, hlen=None):
     ''' Parse a line of values in the CSV format
     
@@ -223,12 +268,11 @@ def parse_line(line, numeric=False, columns=None, hlen=None):
     
     vals = line.split()
     if hlen is not None and hlen+2 == len(vals):
-        if numeric: return [format_utility.convert(v) for v in vals[2:]]
-        return vals[2:]
+        del vals[:2]
     elif hlen is not None and hlen+1 != len(vals): 
         raise format_utility.ParseFormatError, "Header length does not match values: "+str(hlen)+" != "+str(len(vals))+" --> "+str(vals)
-    del vals[1]
-    if columns is not None: vals = vals[columns]
+    else: del vals[1]
+    if columns is not None: vals = [vals[c] for c in columns]
     if numeric: return [format_utility.convert(v) for v in vals]
     return vals
 
@@ -311,6 +355,36 @@ def write_values(fout, values, header, write_offset=1, **extra):
         fout.write("\n")
         index += 1
             
+def write_block(fout, rows, formats, header, write_offset=1, **extra):
+    '''Write a block of values in the spider document format with a single
+    formatting operation
+    
+    .. sourcecode:: py
+        
+        >>> write_block(fout, numpy.asarray([[572.0, 228.0], [738.0, 144.0]]), ["%11g", "%11g"], ["x", "y"])
+        >>> os.system("more data.spi")
+        1  2         572         228
+        2  2         738         144
+    
+    :Parameters:
+    
+    fout : stream
+           Output stream
+    rows : list or array
+           List of tuples or 2D array of values
+    formats : list
+              String format for each column
+    header : list
+             List of string describing the header
+    write_offset : int, optional
+                   ID of the first row in SPIDER document
+    extra : dict
+            Unused keyword arguments
+    '''
+    
+    index = range(write_offset, write_offset+len(rows))
+    fout.write(format_utility.format_block(rows, formats, ' ', index, "%%d %2d "%len(header)))
+            
 def float_format():
     ''' Format for a floating point number
     
@@ -20,8 +20,8 @@ It supports the following attributes:
 .. Created on Apr 9, 2010
 .. codeauthor:: Robert Langlois <rl2528@columbia.edu>
 '''
-from spiderdoc import parse_line, read_header, reader, logging, write_header as write_spider_header, write_values
-if parse_line or read_header or reader or write_values: pass # Hack for pyflakes
+from spiderdoc import parse_line, read_header, reader, column_reader, logging, write_header as write_spider_header, write_values, write_block
+if parse_line or read_header or reader or column_reader or write_values or write_block: pass # Hack for pyflakes
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.INFO)
@@ -30,10 +30,13 @@ It supports the following attributes:
 '''
 from .. import format_utility
 import logging
+import re
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.INFO)
 
+_table_start = re.compile(r'^[ \t]*data_', re.M)
+
 def read_header(filename, header=[], data_found=False, tablename=None, **extra):
     '''Parses the header on the first line of the Star file
     
@@ -199,6 +202,50 @@ def reader(filename, header=[], numeric=False, columns=None, **extra):
     else:
         fin.close()
         
+def column_reader(filename, header=[], first_vals=[], columns=None, **extra):
+    '''Read the remaining values of a Star table in bulk, column by column
+    
+    The table is split in a single pass, rather than line by line, and
+    reading stops at the start of the next table.
+    
+    .. sourcecode:: py
+        
+        >>> header = []
+        >>> fin = open("data.star", 'r')
+        >>> header, first_vals = read_header(fin, header)
+        >>> column_reader(fin, header, first_vals, [0, 1])
+        [['000001@/lmb/home/scheres/data/VP7/all_images.mrcs', '000002@/lmb/home/scheres/data/VP7/all_images.mrcs'], ['13538', '13293']]
+    
+    :Parameters:
+    
+        filename : str or stream
+                   Input filename or input stream
+        header : list
+                 List of strings describing each column
+        first_vals : list
+                     List of string values from the first data line
+        columns : list
+                  List of columns to read otherwise None (all columns)
+        extra : dict
+                Unused keyword arguments
+    
+    :Returns:
+    
+        val : list
+              List of string values for each column
+    '''
+    
+    fin = open(filename, 'r') if isinstance(filename, str) else filename
+    try: text = fin.read()
+    finally: fin.close()
+    m = _table_start.search(text)
+    if m is not None: text = text[:m.start()]
+    if '#' in text or ';' in text:
+        text = "\n".join([line for line in text.split('\n') if line.lstrip()[:1] not in ('#', ';')])
+    if columns is None: columns = range(len(header))
+    vals = format_utility.split_columns(text.split(), len(header), columns)
+    return [[first_vals[c]]+v for c, v in zip(columns, vals)]
+
 def parse_line(line, numeric=False, columns=None, hlen=None):
     ''' Parse a line of values in the CSV format
     
@@ -225,7 +272,7 @@ def parse_line(line, numeric=False, columns=None, hlen=None):
     vals = line.split()
     if hlen is not None and hlen != len(vals): 
         raise format_utility.ParseFormatError, "Header length does not match values: "+str(hlen)+" != "+str(len(vals))+" --> "+str(vals)
-    if columns is not None: vals = vals[columns]
+    if columns is not None: vals = [vals[c] for c in columns]
     if numeric: return [format_utility.convert(v) for v in vals]
     return vals
 
@@ -316,6 +363,32 @@ def write_values(filename, values, star_separtor=' ', **extra):
         fout.write(star_separtor.join(v)+"\n")
     if isinstance(filename, str): fout.close()
     
+def write_block(filename, rows, formats, star_separtor=' ', **extra):
+    '''Write a block of values in the Star format with a single formatting
+    operation
+    
+    .. sourcecode:: py
+        
+        >>> write_block("data.star", [("000001@/lmb/home/scheres/data/VP7/all_images.mrcs", 13538)], ["%s", "%11g"])
+        >>> os.system("more data.star")
+        000001@/lmb/home/scheres/data/VP7/all_images.mrcs       13538
+    
+    :Parameters:
+    
+        filename : str or stream
+                   Output filename or stream
+        rows : list or array
+               List of tuples or 2D array of values
+        formats : list
+                  String format for each column
+        extra : dict
+                Unused keyword arguments
+    '''
+    
+    fout = open(filename, 'w') if isinstance(filename, str) else filename
+    fout.write(format_utility.format_block(rows, formats, star_separtor))
+    if isinstance(filename, str): fout.close()
+    
 def float_format():
     ''' Format for a floating point number
     
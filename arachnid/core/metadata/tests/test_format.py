@@ -0,0 +1,83 @@
+''' Unit tests for the format module
+'''
+from .. import format, namedtuple_utility
+import collections
+import numpy, numpy.testing
+import tempfile
+import shutil
+import os
+
+def _documents(path):
+    '''
+    '''
+    
+    rng = numpy.random.RandomState(0)
+    Coord = collections.namedtuple("Coord", "id,x,y,peak")
+    coords = [Coord(i+1, float(rng.randint(0, 4096)), float(rng.randint(0, 4096)), round(rng.rand(), 4)) for i in xrange(20)]
+    Particle = collections.namedtuple("Particle", "rlnImageName,rlnDefocusU,rlnDefocusV,rlnMicrographName")
+    particles = [Particle("%06d@stack_01.spi"%(i+1), 13000.0+i*10, 13500.0+i*10, "mic_%02d.spi"%(i%3)) for i in xrange(20)]
+    Ctf = collections.namedtuple("Ctf", "rlnDefocusU,rlnDefocusV,rlnDefocusAngle")
+    ctfs = [Ctf(13000.0+i*10, 13500.0+i*10, round(rng.rand()*180, 2)) for i in xrange(20)]
+    filenames = []
+    for filename, values in (('coords.dat', coords), ('coords.csv', coords), ('ctf.star', ctfs), ('particles.star', particles)):
+        filename = os.path.join(path, filename)
+        format.write(filename, values)
+        filenames.append(filename)
+    return filenames
+
+def test_read_columns():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        for filename in _documents(path):
+            vals = format.read(filename, numeric=True)
+            data = format.read_columns(filename)
+            assert(len(data) == len(vals))
+            assert(list(data.dtype.names) == list(vals[0]._fields))
+            for name in vals[0]._fields:
+                expected = [getattr(v, name) for v in vals]
+                if data[name].dtype.kind in 'biuf': numpy.testing.assert_allclose(data[name], expected)
+                else: assert(list(data[name]) == expected)
+    finally:
+        shutil.rmtree(path)
+
+def test_read_ndarray():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        for filename in _documents(path)[:3]:
+            expected, header = namedtuple_utility.tuple2numpy(format.read(filename, numeric=True))
+            data, names = format.read(filename, ndarray=True)
+            assert(list(names) == list(header))
+            numpy.testing.assert_allclose(data, expected)
+    finally:
+        shutil.rmtree(path)
+
+def test_document_writer():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        rng = numpy.random.RandomState(0)
+        Coord = collections.namedtuple("Coord", "id,x,y,peak")
+        coords = [Coord(i+1, float(rng.randint(0, 4096)), float(rng.randint(0, 4096)), round(rng.rand(), 4)) for i in xrange(20)]
+        for ext in ('dat', 'csv', 'star'):
+            expected = os.path.join(path, 'expected.'+ext)
+            format.write(expected, coords)
+            for batch in (lambda v: v, lambda v: numpy.asarray(v)):
+                output = os.path.join(path, 'output.'+ext)
+                with format.DocumentWriter(output, header=list(Coord._fields)) as writer:
+                    for i in xrange(0, len(coords), 7): writer.write(batch(coords[i:i+7]))
+                assert(open(output).read() == open(expected).read())
+            format.write(output, coords[:10])
+            with format.DocumentWriter(output, mode='a', header=list(Coord._fields), write_offset=11) as writer:
+                writer.write(coords[10:15])
+                writer.write(numpy.asarray(coords[15:]))
+            assert(open(output).read() == open(expected).read())
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,81 @@
+''' Unit tests for the format_cache module
+'''
+from .. import format, format_cache
+import numpy, numpy.testing
+import tempfile
+import shutil
+import os
+
+def _document(filename, count=10):
+    '''
+    '''
+    
+    fout = open(filename, 'w')
+    fout.write("id,x,y\n")
+    for i in xrange(count): fout.write("%d,%.1f,%d\n"%(i+1, i*1.5, i*2))
+    fout.close()
+
+def _sidecars(path):
+    '''
+    '''
+    
+    return sorted([f for f in os.listdir(path) if f.endswith('.npy')])
+
+def test_cache_hit():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'data.csv')
+        _document(filename)
+        assert(format_cache.load(filename, []) is None)
+        data = format.read_columns(filename, cache=True)
+        assert(len(_sidecars(path)) == 1)
+        cached = format_cache.load(filename, [])
+        assert(isinstance(cached, numpy.memmap))
+        for n in data.dtype.names: numpy.testing.assert_allclose(cached[n], data[n])
+        numpy.testing.assert_allclose(format.read(filename, ndarray=True, cache=True)[0], format.read(filename, ndarray=True)[0])
+        assert(len(_sidecars(path)) == 1)
+    finally:
+        shutil.rmtree(path)
+
+def test_cache_invalidate():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'data.csv')
+        _document(filename)
+        format.read_columns(filename, cache=True)
+        stale = _sidecars(path)
+        _document(filename, 12)
+        assert(format_cache.load(filename, []) is None)
+        data = format.read_columns(filename, cache=True)
+        assert(len(data) == 12)
+        assert(len(_sidecars(path)) == 1 and _sidecars(path) != stale)
+        st = os.stat(filename)
+        os.utime(filename, (st.st_atime, st.st_mtime+10))
+        assert(format_cache.load(filename, []) is None)
+    finally:
+        shutil.rmtree(path)
+
+def test_cache_corrupt():
+    '''
+    '''
+    
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'data.csv')
+        _document(filename)
+        expected = format.read_columns(filename)
+        fout = open(format_cache.sidecar(filename, []), 'wb')
+        fout.write("not a numpy file")
+        fout.close()
+        assert(format_cache.load(filename, []) is None)
+        data = format.read_columns(filename, cache=True)
+        for n in expected.dtype.names: numpy.testing.assert_allclose(data[n], expected[n])
+        assert(format_cache.load(filename, []) is not None)
+    finally:
+        shutil.rmtree(path)
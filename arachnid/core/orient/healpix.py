@@ -330,19 +330,29 @@ def healpix_euler_rad(ang):
     :Parameters:
     
         ang : tuple
-              Theta, PI in radians
+              Theta, PI in radians, either floats or arrays
     
     :Returns:
     
-        theta : float
+        theta : float or array
                 Theta between 0 and PI in radians
-        phi : float
+        phi : float or array
                 PHI between 0 and 2PI in radians
     '''
     
     if len(ang) == 2:
         theta, phi = ang
         twopi = numpy.pi*2
+        if hasattr(theta, 'ndim') and theta.ndim > 0:
+            theta = numpy.array(theta, dtype=numpy.float)
+            phi = numpy.array(phi, dtype=numpy.float)
+            assert(numpy.all(theta>=0))
+            phi[phi < 0] += twopi
+            sel = theta > numpy.pi
+            theta[sel] -= numpy.pi/2
+            phi[sel] += numpy.pi
+            phi[numpy.logical_and(sel, phi > twopi)] -= twopi
+            return theta, phi
         assert(theta>=0)
         if phi < 0: phi += twopi
         if theta > numpy.pi:
@@ -395,13 +405,13 @@ def healpix_half_sphere_euler_rad(ang):
     :Parameters:
     
         ang : tuple
-              Theta, PI in radians
+              Theta, PI in radians, either floats or arrays
     
     :Returns:
     
-        theta : float
+        theta : float or array
                 Theta between 0 and 90 in radians
-        phi : float
+        phi : float or array
                 PHI between 0 and 360 in radians
     '''
     
@@ -409,6 +419,17 @@ def healpix_half_sphere_euler_rad(ang):
         halfpi = numpy.pi/2
         twopi = numpy.pi*2
         theta, phi = ang
+        if hasattr(theta, 'ndim') and theta.ndim > 0:
+            theta = numpy.array(theta, dtype=numpy.float)
+            phi = numpy.array(phi, dtype=numpy.float)
+            assert(numpy.all(theta>=0))
+            phi[phi < 0] += twopi
+            sel = numpy.logical_and(theta <= numpy.pi, theta > halfpi)
+            theta[sel] = twopi-theta[sel]
+            phi[sel] += numpy.pi
+            phi[numpy.logical_and(sel, phi > twopi)] -= twopi
+            theta[theta > numpy.pi] -= numpy.pi
+            return theta, phi
         assert(theta>=0)
         if phi < 0: phi += twopi
         if theta <= numpy.pi and theta > halfpi:
@@ -452,22 +473,29 @@ def ang2pix(resolution, theta, phi=None, scheme='ring', half=False, deg=False, o
     if hasattr(theta, '__iter__'):
         if phi is not None and not hasattr(phi, '__iter__'): 
             raise ValueError, "phi must be None or array when theta is an array"
-        if hasattr(phi, '__iter__'): theta = zip(theta, phi)
-        _ang2pix = getattr(_healpix, 'ang2pix_%s'%scheme)
+        if hasattr(phi, '__iter__'):
+            n = min(len(theta), len(phi))
+            theta = numpy.asarray(theta, dtype=numpy.float)[:n]
+            phi = numpy.asarray(phi, dtype=numpy.float)[:n]
+        else:
+            theta = numpy.asarray(theta, dtype=numpy.float).reshape((-1, 2))
+            theta, phi = theta[:, 0], theta[:, 1]
+        if deg: theta, phi = numpy.deg2rad(theta), numpy.deg2rad(phi)
+        if half:
+            theta, phi = healpix_half_sphere_euler_rad((theta, phi))
+        else:
+            theta, phi = healpix_euler_rad((theta, phi))
+        if numpy.any(theta > numpy.pi): raise ValueError, "Invalid theta: %f, must be less than PI"%theta[theta > numpy.pi][0]
+        if numpy.any(theta < 0): raise ValueError, "Invalid theta: %f, must be greater than 0"%theta[theta < 0][0]
+        if numpy.any(phi > twopi): raise ValueError, "Invalid phi: %f, must be less than PI"%phi[phi > twopi][0]
+        if numpy.any(phi < 0): raise ValueError, "Invalid phi: %f, must be greater than 0"%phi[phi < 0][0]
         if out is None: out = numpy.zeros(len(theta), dtype=numpy.long)
-        i = 0
-        for t, p in theta:
-            if deg: t, p = numpy.deg2rad((t, p))
-            if half:
-                t, p = healpix_half_sphere_euler_rad((t, p))
-            else:
-                t, p = healpix_euler_rad((t, p))
-            if t > numpy.pi: raise ValueError, "Invalid theta: %f, must be less than PI"%t
-            if t < 0: raise ValueError, "Invalid theta: %f, must be greater than 0"%t
-            if p > twopi: raise ValueError, "Invalid phi: %f, must be less than PI"%p
-            if p < 0: raise ValueError, "Invalid phi: %f, must be greater than 0"%p
-            out[i] = _ang2pix(int(resolution), float(t), float(p))
-            i += 1
+        if scheme == 'ring':
+            out[:] = ang2pix_ring(int(resolution), theta, phi)
+        else:
+            _ang2pix = getattr(_healpix, 'ang2pix_%s'%scheme)
+            for i in xrange(len(theta)):
+                out[i] = _ang2pix(int(resolution), float(theta[i]), float(phi[i]))
         return out
     else:
         _ang2pix = getattr(_healpix, 'ang2pix_%s'%scheme)
@@ -486,3 +514,60 @@ def ang2pix(resolution, theta, phi=None, scheme='ring', half=False, deg=False, o
 
 
 
+
+
+def ang2pix_ring(nside, theta, phi):
+    ''' Convert arrays of Euler angles to pixels in the ring scheme
+    
+    This is a port of `ang2pix_ring` from the HEALPix C library that works
+    over whole arrays and gives the same pixels.
+    
+    :Parameters:
+    
+        nside : int
+                Number of pixels along the side of a base pixel
+        theta : array
+                Euler angle theta between 0 and PI in radians (colatitude)
+        phi : array
+              Euler angle phi between 0 and 2PI in radians (longitude)
+    
+    :Returns:
+        
+        ipix : array
+               Pixel for each pair of Euler angles
+    '''
+    
+    twopi = 2.0*numpy.pi
+    theta = numpy.asarray(theta, dtype=numpy.float)
+    phi = numpy.array(phi, dtype=numpy.float)
+    phi[phi >= twopi] -= twopi
+    phi[phi < 0] += twopi
+    z = numpy.cos(theta)
+    za = numpy.abs(z)
+    tt = phi / (0.5*numpy.pi)
+    nl4 = 4*nside
+    ncap = 2*nside*(nside-1)
+    npix = 12*nside*nside
+    
+    # Equatorial region
+    jp = numpy.floor(nside*(0.5 + tt - z*0.75)).astype(numpy.long)
+    jm = numpy.floor(nside*(0.5 + tt + z*0.75)).astype(numpy.long)
+    ir = nside + 1 + jp - jm
+    tmp = jp+jm - nside + (ir % 2 == 0) + 1
+    ip = numpy.sign(tmp)*(numpy.abs(tmp) // 2) + 1 # C integer division truncates
+    ip[ip > nl4] -= nl4
+    ipix = ncap + nl4*(ir-1) + ip
+    
+    # Polar caps
+    sel = za > 2.0/3.0
+    if numpy.any(sel):
+        tt = tt[sel]
+        tp = tt - numpy.floor(tt)
+        tmp = numpy.sqrt(3.0*(1.0 - za[sel]))
+        jp = numpy.floor(nside*tp*tmp).astype(numpy.long)
+        jm = numpy.floor(nside*(1.0 - tp)*tmp).astype(numpy.long)
+        ir = jp + jm + 1
+        ip = numpy.floor(tt*ir).astype(numpy.long) + 1
+        ip = numpy.where(ip > 4*ir, ip - 4*ir, ip)
+        ipix[sel] = numpy.where(z[sel] <= 0, npix - 2*ir*(ir+1) + ip, 2*ir*(ir-1) + ip)
+    return ipix - 1
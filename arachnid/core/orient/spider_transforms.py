@@ -19,6 +19,8 @@ import logging
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 
+_spider_pi = float(numpy.float32(numpy.pi)) # SPIDER declares PI with a single precision literal
+
 def mirror_x(ang):
     ''' Mirror Euler angles in ZYZ over the x-axis
     
@@ -105,17 +107,32 @@ def spider_euler(ang):
     
     :Parameters:
     
-    ang : tuple
-          Theta, PHI in degrees
+    ang : tuple or array
+          PSI, Theta, PHI in degrees or 2D array where rows are
+          PSI, Theta, PHI in degrees
     
     :Returns:
         
-        theta : float
+        psi : float or array
+              PSI unchanged
+        theta : float or array
                 0 <= theta < 90.0 or 180 <= theta < 270
-        phi : float
+        phi : float or array
               0 <= phi < 360.0
     '''
     
+    if hasattr(ang, 'ndim') and ang.ndim == 2:
+        if ang.shape[1] != 3: raise ValueError, "Not implemented for other than 3 angles"
+        psi = numpy.array(ang[:, 0], dtype=numpy.float)
+        theta = numpy.array(ang[:, 1], dtype=numpy.float)
+        phi = numpy.array(ang[:, 2], dtype=numpy.float)
+        assert(numpy.all(theta >=0))
+        phi[phi < 0] += 360.0
+        sel = numpy.logical_and(theta < 180.0, theta > 90.0)
+        theta[sel] = 360.0 - theta[sel]
+        phi[sel] += 180.0
+        phi[numpy.logical_and(sel, phi > 360.0)] -= 360.0
+        return psi, theta, phi
     if len(ang) == 3:
         psi, theta, phi = ang
         assert(theta >=0)
@@ -160,15 +177,15 @@ def coarse_angles_3D(resolution, align, half=False, out=None):
     #resolution = pow(2, resolution)
     if out is None: out=numpy.zeros((len(align), len(align[0])))
     cols = out.shape[1]
-    for i in xrange(len(align)):
-        #theta, phi = healpix.ensure_valid_deg(align[i,1], align[i,2], half)
-        sp_i, sp_t, sp_p = spider_euler(align[i, :3])
-        ipix = healpix.ang2pix(resolution, align[i,1], align[i,2], deg=True)
-        rot = rotate_into_frame(ang[ipix], (sp_i, sp_t, sp_p))
-        if half: ipix = healpix.ang2pix(resolution, align[i,1], align[i,2], deg=True, half=True)
-        out[i, :3]=(rot, sp_t, sp_p)
-        #out[i, :3]=(rot, align[i,2], sp_p)
-        if cols>6: out[i, 6] = ipix
+    align = numpy.asarray(align)
+    sp_i, sp_t, sp_p = spider_euler(align[:, :3])
+    ipix = healpix.ang2pix(resolution, align[:,1], align[:,2], deg=True)
+    rot = rotate_into_frame(ang[ipix], (sp_i, sp_t, sp_p))
+    if half: ipix = healpix.ang2pix(resolution, align[:,1], align[:,2], deg=True, half=True)
+    out[:, 0]=rot
+    out[:, 1]=sp_t
+    out[:, 2]=sp_p
+    if cols>6: out[:, 6] = ipix
     return out
 
 def coarse_angles(resolution, align, half=False, out=None): # The bitterness of men who fear the way of human progress
@@ -202,33 +219,172 @@ def coarse_angles(resolution, align, half=False, out=None): # The bitterness of
     #resolution = pow(2, resolution)
     if out is None: out=numpy.zeros((len(align), len(align[0])))
     cols = out.shape[1]
-    for i in xrange(len(align)):
-        sp_i, sp_t, sp_p = spider_euler(align[i, :3])
-        ipix = healpix.ang2pix(resolution, align[i,1], align[i,2], deg=True)
-        rot, tx, ty = rotate_into_frame_2d(ang[ipix], sp_t, sp_p, align[i, 3], align[i,4], align[i,5])
-        if half: ipix = healpix.ang2pix(resolution, align[i,1], align[i,2], deg=True, half=True)
-        out[i, 1:6]=( sp_t, sp_p, rot, tx, ty)
-        if cols>6: out[i, 6] = ipix
+    align = numpy.asarray(align)
+    sp_i, sp_t, sp_p = spider_euler(align[:, :3])
+    ipix = healpix.ang2pix(resolution, align[:,1], align[:,2], deg=True)
+    rot, tx, ty = rotate_into_frame_2d(ang[ipix], sp_t, sp_p, align[:, 3], align[:,4], align[:,5])
+    if half: ipix = healpix.ang2pix(resolution, align[:,1], align[:,2], deg=True, half=True)
+    out[:, 1]=sp_t
+    out[:, 2]=sp_p
+    out[:, 3]=rot
+    out[:, 4]=tx
+    out[:, 5]=ty
+    if cols>6: out[:, 6] = ipix
     return out
 
 def rotate_into_frame_2d(frame, theta, phi, inplane, dx, dy):
-    ''' Fix!
+    ''' Rotate 2D alignment parameters into the frame of a reference
+    
+    :Parameters:
+    
+        frame : array
+                PSI,THETA,PHI of the reference or 2D array where rows
+                are the reference for each image
+        theta : float or array
+                THETA of the image
+        phi : float or array
+              PHI of the image
+        inplane : float or array
+                  In-plane rotation of the image
+        dx : float or array
+             Translation in the x-direction
+        dy : float or array
+             Translation in the y-direction
+    
+    :Returns:
+        
+        rot : float or array
+              In-plane rotation in the reference frame
+        tx : float or array
+             Translation in the x-direction
+        ty : float or array
+             Translation in the y-direction
     '''
     
-    from ..image import rotate
-    rang = rotate.rotate_euler(frame, (-inplane, theta, phi))
+    frame = numpy.asarray(frame)
+    rang = rotate_euler(frame.T, (-inplane, theta, phi))
     rot = (rang[0]+rang[2])
     rt3d = align_param_2D_to_3D(inplane, dx, dy)
     #return align_param_2D_to_3D(rot, rt3d[1], rt3d[2])
     return align_param_3D_to_2D(rot, rt3d[1], rt3d[2])
 
 def rotate_into_frame(frame, curr):
-    '''
+    ''' Rotate Euler angles into the frame of a reference
+    
+    :Parameters:
+    
+        frame : array
+                PSI,THETA,PHI of the reference or 2D array where rows
+                are the reference for each image
+        curr : tuple
+               PSI,THETA,PHI of the image, either floats or arrays
+    
+    :Returns:
+        
+        rot : float or array
+              In-plane rotation in the reference frame
     '''
     
-    from ..image import rotate
-    rang = rotate.rotate_euler(frame, curr)
+    frame = numpy.asarray(frame)
+    rang = rotate_euler(frame.T, curr)
     return (rang[0]+rang[2])
+
+def rotate_euler(frame, ang):
+    ''' Rotate Euler angles into the frame of a reference
+    
+    This is a port of CALD from SPIDER, which is also used by 
+    :py:func:`arachnid.core.image.rotate.rotate_euler`, that works over 
+    whole arrays. Like SPIDER, the angles are single precision.
+    
+    :Parameters:
+    
+        frame : tuple
+                PSI,THETA,PHI of the reference, either floats or arrays
+        ang : tuple
+              PSI,THETA,PHI to rotate, either floats or arrays
+    
+    :Returns:
+        
+        psi : float or array
+              PSI between 0 and 360
+        theta : float or array
+                THETA between 0 and 180
+        phi : float or array
+              PHI between 0 and 360
+    '''
+    
+    fpsi, ftheta, fphi = [numpy.asarray(a, dtype=numpy.float32) for a in frame]
+    psi, theta, phi = [numpy.asarray(a, dtype=numpy.float32) for a in ang]
+    r2 = rotation_matrix(psi, theta, phi)
+    r1 = rotation_matrix(-fphi, -ftheta, -fpsi)
+    r3 = [[r2[i][0]*r1[0][j] + r2[i][1]*r1[1][j] + r2[i][2]*r1[2][j] for j in xrange(3)] for i in xrange(3)]
+    scalar = numpy.ndim(r3[2][2]) == 0
+    deps = 1.0e-7
+    for i in xrange(3):
+        for j in xrange(3):
+            r = numpy.array(r3[i][j], dtype=numpy.float, ndmin=1)
+            r[numpy.abs(r) < deps] = 0.0
+            r[r-1.0 > -deps] = 1.0
+            r[r+1.0 < deps] = -1.0
+            r3[i][j] = r
+    rad2deg = 180.0/_spider_pi
+    psi = numpy.zeros(r3[2][2].shape)
+    theta = numpy.zeros(r3[2][2].shape)
+    phi = numpy.zeros(r3[2][2].shape)
+    
+    sel = r3[2][2] == 1.0
+    phi[sel] = rad2deg*numpy.where(r3[0][0][sel] == 0.0, numpy.arcsin(r3[0][1][sel]), numpy.arctan2(r3[0][1][sel], r3[0][0][sel]))
+    sel = r3[2][2] == -1.0
+    theta[sel] = 180.0
+    phi[sel] = rad2deg*numpy.where(r3[0][0][sel] == 0.0, numpy.arcsin(-r3[0][1][sel]), numpy.arctan2(-r3[0][1][sel], -r3[0][0][sel]))
+    sel = numpy.abs(r3[2][2]) != 1.0
+    theta[sel] = rad2deg*numpy.arccos(r3[2][2][sel])
+    r31, r32, r13, r23 = r3[2][0][sel], r3[2][1][sel], r3[0][2][sel], r3[1][2][sel]
+    phi[sel] = numpy.where(r31 == 0.0, numpy.where(numpy.signbit(r32), 270.0, 90.0), rad2deg*numpy.arctan2(r32, r31))
+    psi[sel] = numpy.where(r13 == 0.0, numpy.where(numpy.signbit(r23), 270.0, 90.0), rad2deg*numpy.arctan2(r23, -r13))
+    
+    psi[psi < 0] += 360.0
+    theta[theta < 0] += 360.0
+    phi[phi < 0] += 360.0
+    psi, theta, phi = psi.astype(numpy.float32), theta.astype(numpy.float32), phi.astype(numpy.float32)
+    if scalar: return psi[0], theta[0], phi[0]
+    return psi, theta, phi
+
+def rotation_matrix(psi, theta, phi):
+    ''' Build the rotation matrix for SPIDER Euler angles, a port of BLDR
+    
+    The matrix maps a point in the volume (x, y, z) to a point in the 
+    projection, its transpose maps a point in the projection to the volume.
+    
+    >>> from arachnid.core.orient.spider_transforms import *
+    >>> rotation_matrix([0, 10], [90, 20], [0, 30]).shape
+    (3, 3, 2)
+    
+    :Parameters:
+    
+        psi : float or array
+              PSI in degrees
+        theta : float or array
+                THETA in degrees
+        phi : float or array
+              PHI in degrees
+    
+    :Returns:
+        
+        r : array
+            Rotation matrix (3, 3) followed by the shape of the angles
+    '''
+    
+    deg2rad = _spider_pi/180
+    cphi = numpy.cos(numpy.asarray(phi, dtype=numpy.float64)*deg2rad)
+    sphi = numpy.sin(numpy.asarray(phi, dtype=numpy.float64)*deg2rad)
+    ctheta = numpy.cos(numpy.asarray(theta, dtype=numpy.float64)*deg2rad)
+    stheta = numpy.sin(numpy.asarray(theta, dtype=numpy.float64)*deg2rad)
+    cpsi = numpy.cos(numpy.asarray(psi, dtype=numpy.float64)*deg2rad)
+    spsi = numpy.sin(numpy.asarray(psi, dtype=numpy.float64)*deg2rad)
+    return numpy.asarray([[cphi*ctheta*cpsi-sphi*spsi, sphi*ctheta*cpsi+cphi*spsi, -stheta*cpsi],
+                          [-cphi*ctheta*spsi-sphi*cpsi, -sphi*ctheta*spsi+cphi*cpsi, stheta*spsi],
+                          [cphi*stheta, sphi*stheta, ctheta]])
     
 def euler_geodesic_distance(euler1, euler2):
     ''' Calculate the geodesic distance between two unit quaternions
@@ -250,8 +406,14 @@ def euler_geodesic_distance(euler1, euler2):
     euler2 = euler2.squeeze()
     if euler1.ndim == 2 and euler2.ndim==2:
         if euler1.shape[0] != euler2.shape[0]: raise ValueError, "Requires to arrays of the same length"
+        euler1 = numpy.deg2rad(euler1)
+        euler2 = numpy.deg2rad(euler2)
+        q1 = transforms.quaternion_from_euler_batch(euler1, 'rzyz')
+        q2 = transforms.quaternion_from_euler_batch(euler2, 'rzyz')
+        v = (q1[:, 0]*q2[:, 0] + q1[:, 2]*q2[:, 2]) + (q1[:, 1]*q2[:, 1] + q1[:, 3]*q2[:, 3]) # Same order as numpy.dot
         dist = numpy.zeros(euler1.shape[0])
-        for i in xrange(euler1.shape[0]): dist[i] = euler_geodesic_distance(euler1[i], euler2[i])
+        sel = numpy.logical_not(numpy.isclose(v, 1.0))
+        dist[sel] = numpy.rad2deg(2*numpy.arccos(v[sel]))
         return dist
     euler1 = numpy.deg2rad(euler1)
     euler2 = numpy.deg2rad(euler2)
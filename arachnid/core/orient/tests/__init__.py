@@ -0,0 +1,12 @@
+''' Unit testing for each module in :mod:`arachnid.core.orient`
+
+.. currentmodule:: arachnid.core.orient.tests
+
+.. autosummary::
+    :nosignatures:
+    :toctree: api_generated/
+    :template: api_module.rst
+    
+    test_transforms
+
+'''
@@ -0,0 +1,88 @@
+''' Unit tests for the transforms module
+'''
+from .. import transforms
+import numpy.testing
+
+_axes = ('sxyz', 'szyz', 'rzyz', 'rxyx')
+
+def _angles(n):
+    '''
+    '''
+    
+    return (4*numpy.pi) * (numpy.random.random((n, 3)) - 0.5)
+
+def _quaternions(n):
+    '''
+    '''
+    
+    return numpy.asarray([transforms.random_quaternion() for i in xrange(n)]).reshape((n, 4))
+
+def test_euler_matrix_batch():
+    '''
+    '''
+    
+    for n in (5, 1, 0):
+        angles = _angles(n)
+        for axes in _axes:
+            R = transforms.euler_matrix_batch(angles, axes)
+            assert(R.shape == (n, 4, 4))
+            numpy.testing.assert_allclose(R, numpy.asarray([transforms.euler_matrix(axes=axes, *a) for a in angles]).reshape((n, 4, 4)))
+            out = numpy.empty((n, 4, 4))
+            assert(transforms.euler_matrix_batch(angles, axes, out=out) is out)
+            numpy.testing.assert_allclose(out, R)
+
+def test_euler_from_matrix_batch():
+    '''
+    '''
+    
+    for n in (5, 1, 0):
+        for axes in _axes:
+            R = transforms.euler_matrix_batch(_angles(n), axes)
+            angles = transforms.euler_from_matrix_batch(R, axes)
+            assert(angles.shape == (n, 3))
+            numpy.testing.assert_allclose(angles, numpy.asarray([transforms.euler_from_matrix(r, axes) for r in R]).reshape((n, 3)))
+            out = numpy.empty((n, 3))
+            assert(transforms.euler_from_matrix_batch(R[:, :3, :3], axes, out=out) is out)
+            numpy.testing.assert_allclose(out, angles)
+
+def test_quaternion_from_euler_batch():
+    '''
+    '''
+    
+    for n in (5, 1, 0):
+        angles = _angles(n)
+        for axes in _axes:
+            q = transforms.quaternion_from_euler_batch(angles, axes)
+            assert(q.shape == (n, 4))
+            numpy.testing.assert_allclose(q, numpy.asarray([transforms.quaternion_from_euler(axes=axes, *a) for a in angles]).reshape((n, 4)))
+            out = numpy.empty((n, 4))
+            assert(transforms.quaternion_from_euler_batch(angles, axes, out=out) is out)
+            numpy.testing.assert_allclose(out, q)
+
+def test_quaternion_multiply_batch():
+    '''
+    '''
+    
+    for n in (5, 1, 0):
+        q0, q1 = _quaternions(n), _quaternions(n)
+        q = transforms.quaternion_multiply_batch(q1, q0)
+        assert(q.shape == (n, 4))
+        numpy.testing.assert_allclose(q, numpy.asarray([transforms.quaternion_multiply(a, b) for a, b in zip(q1, q0)]).reshape((n, 4)))
+        q = transforms.quaternion_multiply_batch(q1[:1], q0) if n > 0 else q
+        numpy.testing.assert_allclose(q, numpy.asarray([transforms.quaternion_multiply(q1[0], b) for b in q0]).reshape((n, 4)))
+        out = numpy.empty((n, 4))
+        assert(transforms.quaternion_multiply_batch(q1, q0, out=out) is out)
+
+def test_quaternion_slerp_batch():
+    '''
+    '''
+    
+    for n in (5, 1, 0):
+        q0, q1 = _quaternions(n), _quaternions(n)
+        fraction = numpy.random.random(n)
+        q = transforms.quaternion_slerp_batch(q0, q1, fraction)
+        assert(q.shape == (n, 4))
+        numpy.testing.assert_allclose(q, numpy.asarray([transforms.quaternion_slerp(a, b, f) for a, b, f in zip(q0, q1, fraction)]).reshape((n, 4)), atol=1e-12)
+        out = numpy.empty((n, 4))
+        assert(transforms.quaternion_slerp_batch(q0, q1, 0.5, out=out) is out)
+        numpy.testing.assert_allclose(out, numpy.asarray([transforms.quaternion_slerp(a, b, 0.5) for a, b in zip(q0, q1)]).reshape((n, 4)), atol=1e-12)
@@ -80,6 +80,10 @@ Vector, point, quaternion, and matrix function arguments are expected to be
 
 Return types are numpy arrays unless specified otherwise.
 
+Functions ending in _batch work on N rows at once, i.e. (N, 3) arrays of Euler
+angles, (N, 4) arrays of quaternions, or (N, 4, 4) arrays of matrices, and
+accept an optional output array.
+
 Angles are in radians unless specified otherwise.
 
 Quaternions w+ix+jy+kz are represented as [w, x, y, z].
@@ -1451,6 +1455,276 @@ def quaternion_slerp(quat0, quat1, fraction, spin=0, shortestpath=True):
     return q0
 
 
+def euler_matrix_batch(angles, axes='sxyz', out=None):
+    """Return homogeneous rotation matrices from rows of Euler angles.
+
+    angles : (N, 3) array of Euler's roll, pitch and yaw angles
+    axes : One of 24 axis sequences as string or encoded tuple
+    out : Optional (N, 4, 4) array for the matrices
+
+    >>> angles = (4*math.pi) * (numpy.random.random((5, 3)) - 0.5)
+    >>> for axes in _AXES2TUPLE.keys():
+    ...    R = euler_matrix_batch(angles, axes)
+    ...    for a, r in zip(angles, R):
+    ...        if not numpy.allclose(r, euler_matrix(axes=axes, *a)):
+    ...            print(axes, "failed")
+    >>> R = numpy.empty((5, 4, 4))
+    >>> R is euler_matrix_batch(angles, 'rzyz', out=R)
+    True
+
+    """
+    try:
+        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes]
+    except (AttributeError, KeyError):
+        _TUPLE2AXES[axes]  # validation
+        firstaxis, parity, repetition, frame = axes
+
+    i = firstaxis
+    j = _NEXT_AXIS[i+parity]
+    k = _NEXT_AXIS[i-parity+1]
+
+    angles = numpy.array(angles, dtype=numpy.float64, copy=False, ndmin=2)
+    ai, aj, ak = angles[:, 0], angles[:, 1], angles[:, 2]
+    if frame:
+        ai, ak = ak, ai
+    if parity:
+        ai, aj, ak = -ai, -aj, -ak
+
+    si, sj, sk = numpy.sin(ai), numpy.sin(aj), numpy.sin(ak)
+    ci, cj, ck = numpy.cos(ai), numpy.cos(aj), numpy.cos(ak)
+    cc, cs = ci*ck, ci*sk
+    sc, ss = si*ck, si*sk
+
+    if out is None:
+        out = numpy.empty((len(angles), 4, 4))
+    M = out
+    M[:] = numpy.identity(4)
+    if repetition:
+        M[:, i, i] = cj
+        M[:, i, j] = sj*si
+        M[:, i, k] = sj*ci
+        M[:, j, i] = sj*sk
+        M[:, j, j] = -cj*ss+cc
+        M[:, j, k] = -cj*cs-sc
+        M[:, k, i] = -sj*ck
+        M[:, k, j] = cj*sc+cs
+        M[:, k, k] = cj*cc-ss
+    else:
+        M[:, i, i] = cj*ck
+        M[:, i, j] = sj*sc-cs
+        M[:, i, k] = sj*cc+ss
+        M[:, j, i] = cj*sk
+        M[:, j, j] = sj*ss+cc
+        M[:, j, k] = sj*cs-sc
+        M[:, k, i] = -sj
+        M[:, k, j] = cj*si
+        M[:, k, k] = cj*ci
+    return M
+
+
+def euler_from_matrix_batch(matrix, axes='sxyz', out=None):
+    """Return rows of Euler angles from rotation matrices.
+
+    matrix : (N, 3, 3) or (N, 4, 4) array of rotation matrices
+    axes : One of 24 axis sequences as string or encoded tuple
+    out : Optional (N, 3) array for the Euler angles
+
+    >>> angles = (4*math.pi) * (numpy.random.random((5, 3)) - 0.5)
+    >>> for axes in _AXES2TUPLE.keys():
+    ...    R0 = euler_matrix_batch(angles, axes)
+    ...    R1 = euler_matrix_batch(euler_from_matrix_batch(R0, axes), axes)
+    ...    if not numpy.allclose(R0, R1): print(axes, "failed")
+    >>> R = euler_matrix_batch([[0, 0, 0], [1, 0, 0]], 'szyz')
+    >>> numpy.allclose(euler_from_matrix_batch(R, 'szyz'),
+    ...                [euler_from_matrix(r, 'szyz') for r in R])
+    True
+
+    """
+    try:
+        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes.lower()]
+    except (AttributeError, KeyError):
+        _TUPLE2AXES[axes]  # validation
+        firstaxis, parity, repetition, frame = axes
+
+    i = firstaxis
+    j = _NEXT_AXIS[i+parity]
+    k = _NEXT_AXIS[i-parity+1]
+
+    M = numpy.array(matrix, dtype=numpy.float64, copy=False, ndmin=3)[:, :3, :3]
+    if repetition:
+        sy = numpy.sqrt(M[:, i, j]*M[:, i, j] + M[:, i, k]*M[:, i, k])
+        sel = sy > _EPS
+        ax = numpy.where(sel, numpy.arctan2( M[:, i, j],  M[:, i, k]),
+                              numpy.arctan2(-M[:, j, k],  M[:, j, j]))
+        ay = numpy.arctan2( sy,          M[:, i, i])
+        az = numpy.where(sel, numpy.arctan2( M[:, j, i], -M[:, k, i]), 0.0)
+    else:
+        cy = numpy.sqrt(M[:, i, i]*M[:, i, i] + M[:, j, i]*M[:, j, i])
+        sel = cy > _EPS
+        ax = numpy.where(sel, numpy.arctan2( M[:, k, j],  M[:, k, k]),
+                              numpy.arctan2(-M[:, j, k],  M[:, j, j]))
+        ay = numpy.arctan2(-M[:, k, i],  cy)
+        az = numpy.where(sel, numpy.arctan2( M[:, j, i],  M[:, i, i]), 0.0)
+
+    if parity:
+        ax, ay, az = -ax, -ay, -az
+    if frame:
+        ax, az = az, ax
+    if out is None:
+        out = numpy.empty((len(M), 3))
+    out[:, 0] = ax
+    out[:, 1] = ay
+    out[:, 2] = az
+    return out
+
+
+def quaternion_from_euler_batch(angles, axes='sxyz', out=None):
+    """Return quaternions from rows of Euler angles.
+
+    angles : (N, 3) array of Euler's roll, pitch and yaw angles
+    axes : One of 24 axis sequences as string or encoded tuple
+    out : Optional (N, 4) array for the quaternions
+
+    >>> q = quaternion_from_euler_batch([[1, 2, 3]], 'ryxz')
+    >>> numpy.allclose(q, [[0.435953, 0.310622, -0.718287, 0.444435]])
+    True
+    >>> angles = (4*math.pi) * (numpy.random.random((5, 3)) - 0.5)
+    >>> for axes in _AXES2TUPLE.keys():
+    ...    q = quaternion_from_euler_batch(angles, axes)
+    ...    for a, qa in zip(angles, q):
+    ...        if not numpy.allclose(qa, quaternion_from_euler(axes=axes, *a)):
+    ...            print(axes, "failed")
+
+    """
+    try:
+        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes.lower()]
+    except (AttributeError, KeyError):
+        _TUPLE2AXES[axes]  # validation
+        firstaxis, parity, repetition, frame = axes
+
+    i = firstaxis + 1
+    j = _NEXT_AXIS[i+parity-1] + 1
+    k = _NEXT_AXIS[i-parity] + 1
+
+    angles = numpy.array(angles, dtype=numpy.float64, copy=False, ndmin=2)
+    ai, aj, ak = angles[:, 0], angles[:, 1], angles[:, 2]
+    if frame:
+        ai, ak = ak, ai
+    if parity:
+        aj = -aj
+
+    ai = ai / 2.0
+    aj = aj / 2.0
+    ak = ak / 2.0
+    ci = numpy.cos(ai)
+    si = numpy.sin(ai)
+    cj = numpy.cos(aj)
+    sj = numpy.sin(aj)
+    ck = numpy.cos(ak)
+    sk = numpy.sin(ak)
+    cc = ci*ck
+    cs = ci*sk
+    sc = si*ck
+    ss = si*sk
+
+    if out is None:
+        out = numpy.empty((len(angles), 4))
+    q = out
+    if repetition:
+        q[:, 0] = cj*(cc - ss)
+        q[:, i] = cj*(cs + sc)
+        q[:, j] = sj*(cc + ss)
+        q[:, k] = sj*(cs - sc)
+    else:
+        q[:, 0] = cj*cc + sj*ss
+        q[:, i] = cj*sc - sj*cs
+        q[:, j] = cj*ss + sj*cc
+        q[:, k] = cj*cs - sj*sc
+    if parity:
+        q[:, j] *= -1.0
+
+    return q
+
+
+def quaternion_multiply_batch(quaternion1, quaternion0, out=None):
+    """Return multiplication of rows of quaternions.
+
+    Either argument may also be a single quaternion, which multiplies
+    every row of the other.
+
+    >>> q = quaternion_multiply_batch([[4, 1, -2, 3]], [[8, -5, 6, 7]])
+    >>> numpy.allclose(q, [[28, -44, -14, 48]])
+    True
+    >>> q0, q1 = numpy.random.random((5, 4)), numpy.random.random(4)
+    >>> q = [quaternion_multiply(q1, qa) for qa in q0]
+    >>> numpy.allclose(quaternion_multiply_batch(q1, q0, out=q0), q)
+    True
+
+    """
+    q0 = numpy.array(quaternion0, dtype=numpy.float64, copy=False)
+    q1 = numpy.array(quaternion1, dtype=numpy.float64, copy=False)
+    w0, x0, y0, z0 = q0[..., 0], q0[..., 1], q0[..., 2], q0[..., 3]
+    w1, x1, y1, z1 = q1[..., 0], q1[..., 1], q1[..., 2], q1[..., 3]
+    q = [-x1*x0 - y1*y0 - z1*z0 + w1*w0,
+          x1*w0 + y1*z0 - z1*y0 + w1*x0,
+         -x1*z0 + y1*w0 + z1*x0 + w1*y0,
+          x1*y0 - y1*x0 + z1*w0 + w1*z0]
+    if out is None:
+        out = numpy.empty(numpy.atleast_1d(q[0]).shape + (4, ))
+    for i in range(4):
+        out[..., i] = q[i]
+    return out
+
+
+def quaternion_slerp_batch(quat0, quat1, fraction, spin=0, shortestpath=True,
+                           out=None):
+    """Return spherical linear interpolation between rows of quaternions.
+
+    quat0, quat1 : (N, 4) arrays of quaternions, or a single quaternion
+    fraction : Single fraction or one fraction for each row
+    out : Optional (N, 4) array for the quaternions
+
+    >>> q0 = numpy.array([random_quaternion() for i in range(5)])
+    >>> q1 = numpy.array([random_quaternion() for i in range(5)])
+    >>> fraction = numpy.array([0, 1, 0.5, 0.25, 0.75])
+    >>> q = quaternion_slerp_batch(q0, q1, fraction)
+    >>> numpy.allclose(q, [quaternion_slerp(a, b, f)
+    ...                    for a, b, f in zip(q0, q1, fraction)])
+    True
+    >>> numpy.allclose(quaternion_slerp_batch(q0, q1, 1, 1), q1)
+    True
+
+    """
+    q0 = unit_vector(numpy.array(quat0, copy=False, ndmin=2)[:, :4], axis=1)
+    q1 = unit_vector(numpy.array(quat1, copy=False, ndmin=2)[:, :4], axis=1)
+    q0, q1 = [numpy.array(q) for q in numpy.broadcast_arrays(q0, q1)]
+    f = numpy.empty(len(q0))
+    f[:] = fraction
+    d = numpy.einsum('ij,ij->i', q0, q1)
+    sel = numpy.abs(numpy.abs(d) - 1.0) < _EPS
+    qs = q1
+    if shortestpath:
+        # invert rotation
+        inv = d < 0.0
+        qs = q1.copy()
+        d[inv] = -d[inv]
+        qs[inv] = -qs[inv]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        angle = numpy.arccos(d) + spin * math.pi
+        sel = numpy.logical_or(sel, numpy.abs(angle) < _EPS)
+        isin = 1.0 / numpy.sin(angle)
+        w0 = numpy.sin((1.0 - f) * angle) * isin
+        w1 = numpy.sin(f * angle) * isin
+    if out is None:
+        out = numpy.empty(q0.shape)
+    numpy.multiply(q0, w0[:, numpy.newaxis], out)
+    out += qs * w1[:, numpy.newaxis]
+    out[sel] = q0[sel]
+    out[f == 1.0] = q1[f == 1.0]
+    out[f == 0.0] = q0[f == 0.0]
+    return out
+
+
 def random_quaternion(rand=None):
     """Return uniform random unit quaternion.
 
@@ -1880,11 +2154,9 @@ def _import_module(module_name, warn=True, prefix='_py_', ignore='_'):
         try:
             module = __import__(module_name)
         except ImportError:
-            sys.path.pop()
             if warn:
                 warnings.warn("failed to import module " + module_name)
     else:
-        sys.path.pop()
         for attr in dir(module):
             if ignore and attr.startswith(ignore):
                 continue
@@ -6,7 +6,11 @@
 import numpy, logging
 import parallel_utility
 import process_tasks
+import process_queue
 import socket, os
+import collections
+import Queue
+import errno
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 try:
@@ -271,6 +275,63 @@ def block_reduce(data, comm=None, batch_size=100000, **extra):
         '''
     return data
 
+def pipeline_reduce(data, root=0, comm=None, batch_size=100000, pipeline_depth=4, **extra):
+    ''' Sum a contiguous data array from every node onto the root node
+    
+    The array is reduced in place, slab by slab, over a flat view of its
+    memory, so no second buffer is allocated. Up to `pipeline_depth`
+    non-blocking reductions are in flight with no barrier between slabs,
+    which bounds the memory MPI holds for the reduction to
+    `pipeline_depth*batch_size` elements. If the MPI library does not support
+    non-blocking collectives, then each slab is reduced with a blocking
+    reduction. Only the root receives the sum, the data on the other nodes is
+    left unchanged.
+    
+    :Parameters:
+    
+    data : array
+           Contiguous array of data to send to the root (or if root, receive)
+    root : int
+           Rank of the root node
+    comm : mpi4py.MPI.Intracomm
+           MPI communications object
+    batch_size : int
+                 Total data to reduce at one time
+    pipeline_depth : int
+                     Maximum number of batches reduced at one time
+    extra : dict
+            Unused keyword arguments
+    
+    :Returns:
+    
+    data : array
+           Sum of the data over all nodes on the root, otherwise the input
+    '''
+    
+    if comm is None: return data
+    if not data.flags.c_contiguous and not data.flags.f_contiguous:
+        raise ValueError, "Reduction requires a contiguous array"
+    flat = data.ravel(order='K')
+    mpi_type = MPI.__TypeDict__[data.dtype.char]
+    is_root = comm.Get_rank() == root
+    nonblocking = True
+    pending = collections.deque()
+    for block_beg in xrange(0, flat.shape[0], batch_size):
+        block = [flat[block_beg:block_beg+batch_size], mpi_type]
+        if nonblocking:
+            if len(pending) >= pipeline_depth: pending.popleft().Wait()
+            try:
+                if is_root: pending.append(comm.Ireduce(MPI.IN_PLACE, block, op=MPI.SUM, root=root))
+                else: pending.append(comm.Ireduce(block, None, op=MPI.SUM, root=root))
+                continue
+            except NotImplementedError:
+                _logger.debug("Non-blocking reduction not supported, falling back on blocking reduction")
+                nonblocking = False
+        if is_root: comm.Reduce(MPI.IN_PLACE, block, op=MPI.SUM, root=root)
+        else: comm.Reduce(block, None, op=MPI.SUM, root=root)
+    while len(pending) > 0: pending.popleft().Wait()
+    return data
+
 def block_reduce_root(data, batch_size=100000, root=0, comm=None, **extra):
     ''' Reduce data array to the root node
     
@@ -342,10 +403,14 @@ def supports_MPI():
     
     return MPI is not None
 
-def mpi_reduce(process, vals, comm=None, rank=None, **extra):
+def mpi_reduce(process, vals, comm=None, rank=None, mpi_chunk=0, **extra):
     ''' Map a set of values to client nodes and process them in parallel with `process`. If MPI
     is not enabled, it will use multi-process or serial code depending on the parameters.
     
+    If `mpi_chunk` is greater than zero, then the root hands out small chunks of values
+    to each client on request rather than partitioning the list up front. This balances
+    the load when the processing time varies between values.
+    
     .. todo:: figure out what is wrong here!
     
     :Parameters:
@@ -358,8 +423,11 @@ def mpi_reduce(process, vals, comm=None, rank=None, **extra):
            MPI communications object
     rank : int
            Rank of current node
+    mpi_chunk : int
+                Number of values per worker handed to a client on each request, 
+                0 means partition the list evenly over the clients
     extra : dict
-            Unused keyword arguments
+            Keyword arguments passed to :py:func:`process_tasks.process_mp`
     
     :Returns:
     
@@ -371,6 +439,12 @@ def mpi_reduce(process, vals, comm=None, rank=None, **extra):
     
     if rank is None: rank = get_rank(comm)
     size = get_size(comm)
+    if mpi_chunk > 0 and size > 1:
+        chunk = mpi_chunk*max(1, extra.get('worker_count', 1))
+        if rank > 0: reduce_all = _mpi_dispatch_client(process, comm, mpi_chunk, **extra)
+        else: reduce_all = _mpi_dispatch_root(vals, chunk, comm)
+        for index, res in reduce_all: yield index, res
+        return
     lenbuf = numpy.zeros((size, 1), dtype=numpy.int32)
     _logger.debug("processing - started: %d - %d"%(len(vals), size))
     mpi_type = MPI.__TypeDict__[lenbuf.dtype.char] if MPI is not None else None
@@ -446,6 +520,181 @@ def mpi_reduce(process, vals, comm=None, rank=None, **extra):
         if status < 0: raise ValueError, "Exceptoin raised"
         _logger.debug("Root progress monitor - finished")
 
+def _mpi_dispatch_root(vals, chunk, comm):
+    ''' Hand out chunks of values to clients on request and collect the results
+    in the order they arrive
+    
+    Each client sends its requests, results and final status to the root with
+    tag 7. The root replies to each request with a list of (index, value) pairs
+    with tag 8, an empty list tells the client to stop. Once all clients have
+    stopped, the root sends the overall status to each client that finished, so
+    no client starts the next call while the root is still in this one.
+    
+    A client that fails sends 'error' and the root replies with None, after which
+    no further message is sent to that client. The values the client was sent but
+    did not return are handed out to the other clients. A request is not answered
+    with an empty list while another client still holds values, so those values
+    can be handed out again if that client fails.
+    
+    :Parameters:
+    
+    vals : list
+           List of input values
+    chunk : int
+            Number of values handed out on each request
+    comm : mpi4py.MPI.Intracomm
+           MPI communications object
+    
+    :Returns:
+    
+    index : int
+            Index of the input value in the original list
+    res : object
+          Result from `process`
+    '''
+    
+    _logger.debug("Root dispatch - started: %d"%(len(vals)))
+    pending = collections.deque(enumerate(vals))
+    active = comm.Get_size()-1
+    in_flight = {}
+    waiting = []
+    finished = []
+    sends = []
+    mpi_status = MPI.Status()
+    while active > 0:
+        kind, payload = comm.recv(source=MPI.ANY_SOURCE, tag=7, status=mpi_status)
+        node = mpi_status.Get_source()
+        if kind == 'result':
+            del in_flight[node][payload[0]]
+            yield payload
+        elif kind == 'request':
+            waiting.append(node)
+        else:
+            if kind == 'error':
+                lost = sorted(in_flight.get(node, {}).items())
+                _logger.error("Client %d failed with %d values in flight - handing them to other clients"%(node, len(lost)))
+                pending.extendleft(reversed(lost))
+                if node in waiting: waiting.remove(node)
+                sends.append(comm.isend(None, dest=node, tag=8))
+            else: finished.append(node)
+            in_flight.pop(node, None)
+            active -= 1
+        held = sum([len(v) for v in in_flight.itervalues()])
+        while len(waiting) > 0 and (len(pending) > 0 or held == 0):
+            node = waiting.pop(0)
+            work = []
+            while len(pending) > 0 and len(work) < chunk: work.append(pending.popleft())
+            in_flight.setdefault(node, {}).update(work)
+            held += len(work)
+            sends.append(comm.isend(work, dest=node, tag=8))
+        sends = [s for s in sends if not s.Test()]
+    status = 0 if len(pending) == 0 else -1
+    for node in finished: sends.append(comm.isend(status, dest=node, tag=8))
+    MPI.Request.Waitall(sends)
+    if status < 0: raise ValueError, "Exception raised on client node: %d values were not processed"%len(pending)
+    _logger.debug("Root dispatch - finished")
+
+def _mpi_dispatch_client(process, comm, mpi_chunk, worker_count=1, poll_interval=0.05, **extra):
+    ''' Request chunks of values from the root, process them with `process` and
+    send back each result without waiting for the root
+    
+    The request for the next chunk is sent as soon as a chunk is received, so 
+    the client does not wait on the root between chunks. The worker processes
+    are started once and fed each chunk as it arrives, a worker taking 
+    `mpi_chunk` values at a time. The client only blocks waiting for the root
+    when it holds no values, as the root may hold back its reply until the 
+    results of those values are returned.
+    
+    :Parameters:
+    
+    process : function
+              Function for processing each input value
+    comm : mpi4py.MPI.Intracomm
+           MPI communications object
+    mpi_chunk : int
+                Number of values handed to a worker at a time
+    worker_count : int
+                   Number of worker processes on the client
+    poll_interval : float
+                    Seconds to wait for a result before checking for the
+                    next chunk while a worker is idle
+    extra : dict
+            Keyword arguments passed to :py:func:`process_tasks.process_mp`
+    
+    :Returns:
+    
+    index : int
+            Index of the input value in the original list
+    res : object
+          Result from `process`
+    '''
+    
+    sends = []
+    qin = None
+    kwargs = dict(extra)
+    for key in ('init_process', 'ignored_errors', 'prefetch', 'prefetch_mem', 'prefetch_load', 'prefetch_release', 'task_cost', 'costs', 'chunk_size'):
+        kwargs.pop(key, None)
+    try:
+        comm.send(('request', None), dest=0, tag=7)
+        if worker_count < 2:
+            while True:
+                work = comm.recv(source=0, tag=8)
+                if len(work) == 0: break
+                sends.append(comm.isend(('request', None), dest=0, tag=7))
+                index, vals = zip(*work)
+                for i, res in process_tasks.process_mp(process, list(vals), worker_count, **extra):
+                    sends.append(comm.isend(('result', (index[i], res)), dest=0, tag=7))
+                    yield index[i], res
+                    sends = [s for s in sends if not s.Test()]
+        else:
+            prefetch_param = None
+            if extra.get('prefetch', 0) > 0 and extra.get('prefetch_load') is not None:
+                prefetch_param = (extra['prefetch_load'], extra.get('prefetch_release'), extra['prefetch'], int(extra.get('prefetch_mem', 0)*1048576))
+            qin, qout = process_tasks.start_chunk_workers(process, worker_count, extra.get('init_process'), extra.get('ignored_errors'), prefetch_param, **kwargs)
+            requested = True
+            held = 0
+            while requested or held > 0:
+                if requested and (held == 0 or comm.Iprobe(source=0, tag=8)):
+                    work = comm.recv(source=0, tag=8)
+                    if len(work) == 0:
+                        requested = False
+                        continue
+                    sends.append(comm.isend(('request', None), dest=0, tag=7))
+                    for beg in xrange(0, len(work), mpi_chunk):
+                        qin.put((beg, work[beg:beg+mpi_chunk]))
+                        held += 1
+                    continue
+                if requested and held < worker_count:
+                    # A worker is idle, so check for the next chunk while waiting
+                    try: val = qout.get(True, poll_interval)
+                    except Queue.Empty: continue
+                    except IOError, e:
+                        if e.errno == errno.EINTR: continue
+                        raise
+                else: val = process_queue.safe_get(qout.get)
+                if isinstance(val, process_queue.ProcessException): raise val
+                if val is None: raise ValueError, "Worker process stopped unexpectedly"
+                i, res = val[1]
+                if i is None:
+                    held -= 1
+                    continue
+                sends.append(comm.isend(('result', (i, res)), dest=0, tag=7))
+                yield i, res
+                sends = [s for s in sends if not s.Test()]
+    except:
+        _logger.exception("client-processing - error")
+        comm.send(('error', None), dest=0, tag=7)
+        while comm.recv(source=0, tag=8) is not None: pass
+        raise
+    else:
+        MPI.Request.Waitall(sends)
+        comm.send(('finished', None), dest=0, tag=7)
+        status = comm.recv(source=0, tag=8)
+        if status < 0: raise StandardError, "Some MPI process crashed"
+        _logger.debug("client-processing - finished")
+    finally:
+        if qin is not None: process_queue.stop_workers(worker_count, qin)
+
 def is_root(comm=None, **extra):
     ''' Test if node is root
     
@@ -10,6 +10,7 @@ import multiprocessing
 import logging, sys, traceback, numpy
 import functools
 import errno
+import types
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
@@ -458,6 +459,9 @@ def worker_all(qin, qout, worker_callback, init_process=None, **extra):
     an exception is thrown, then all the processes are stopped
     and the exception is placed in the output queue.
     
+    If the worker callback returns a generator, then each value it
+    yields is placed in the output queue as it is generated.
+    
     :Parameters:
 
         qin : Queue
@@ -485,7 +489,9 @@ def worker_all(qin, qout, worker_callback, init_process=None, **extra):
                 break
             index, val = val
             outval = worker_callback(val, **extra)
-            qout.put((index, outval))
+            if isinstance(outval, types.GeneratorType):
+                for out in outval: qout.put((index, out))
+            else: qout.put((index, outval))
             if hasattr(qin, "task_done"): qin.task_done()
     except:
         _logger.exception("Error processing worker")
@@ -8,16 +8,37 @@ This module defines a set of common tasks that can be performed in parallel or s
 
 import process_queue
 import logging
+import itertools
+import time
+import os
+import threading
+import collections
 import numpy.ctypeslib
+import multiprocessing
 import multiprocessing.sharedctypes
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 
-def process_mp(process, vals, worker_count, init_process=None, ignored_errors=None, **extra):
+def process_mp(process, vals, worker_count, init_process=None, ignored_errors=None, task_cost=None, costs=None, chunk_size=0, prefetch=0, prefetch_mem=0, prefetch_load=None, prefetch_release=None, **extra):
     ''' Generator that runs a process functor in parallel (or serial if worker_count 
         is less than 2) over a list of given data values and returns the result
-        
+    
+    In parallel, the values are sent to the workers in chunks, largest cost first (see
+    :py:func:`schedule_chunks`). The cost of a value is given by `costs`, when the 
+    caller has already computed them, otherwise by `task_cost` or, if every value is a 
+    filename, the size of the file. The busy time of each worker is logged when all 
+    values are processed.
+    
+    The result of each value is returned as soon as it is processed rather than
+    when its chunk is finished.
+    
+    If `prefetch` is greater than zero and `prefetch_load` is given, then the
+    inputs of the next values in a chunk are loaded in a background thread while 
+    the current value is processed (see :py:class:`Prefetcher`). A worker does
+    not take its next chunk early, so prefetching leaves the balance of the 
+    final chunks unchanged.
+
     :Parameters:
     
         process : function
@@ -30,6 +51,23 @@ def process_mp(process, vals, worker_count, init_process=None, ignored_errors=No
                        Initalize the parameters for the child process
         ignored_errors : list
                          Single element list with counter for ignored errors
+        task_cost : function, optional
+                    Estimate the relative cost of processing a value
+        costs : array, optional
+                Cost of each value computed by :py:func:`task_costs`
+        chunk_size : int
+                     Number of values sent to a worker at a time, 0 means 
+                     choose from the cost of the values
+        prefetch : int
+                   Number of values to load ahead of the one being processed
+        prefetch_mem : float
+                       Maximum memory in MB held by values loaded ahead, 0 means no limit
+        prefetch_load : function, optional
+                        Load the input of a value, called as `prefetch_load(val, **extra)`,
+                        returns the number of bytes held in memory
+        prefetch_release : function, optional
+                           Release the memory held for a value, called as 
+                           `prefetch_release(val, **extra)`
         extra : dict
                 Unused keyword arguments
     
@@ -39,24 +77,23 @@ def process_mp(process, vals, worker_count, init_process=None, ignored_errors=No
               Return value of process functor
     '''
     
+    prefetch_param = (prefetch_load, prefetch_release, prefetch, int(prefetch_mem*1048576)) if prefetch > 0 and prefetch_load is not None else None
+    
     #_logger.error("worker_count1=%d"%worker_count)
     if len(vals) < worker_count: worker_count = len(vals)
     #_logger.error("worker_count2=%d"%worker_count)
     
     if worker_count > 1:
-        def process_helper(val, **extra):
-            try:
-                return process(val, **extra)
-            except:
-                if ignored_errors is not None and len(ignored_errors) > 0:ignored_errors[0]+=1
-                if _logger.getEffectiveLevel()==logging.DEBUG or 1 == 1:
-                    _logger.exception("Unexpected error in process - report this problem to the developer")
-                else:
-                    _logger.warn("nexpected error in process - report this problem to the developer")
-                return extra.get('process_number', 0), val
-        qout = process_queue.start_workers_with_output(vals, process_helper, worker_count, init_process, ignore_error=True, **extra)
+        chunks = [[(i, vals[i]) for i in chunk] for chunk in schedule_chunks(vals, worker_count, task_cost, chunk_size, costs)]
+        if len(chunks) < worker_count: worker_count = len(chunks)
+        qin, qout = start_chunk_workers(process, worker_count, init_process, ignored_errors, prefetch_param, **extra)
+        for chunk in enumerate(chunks): qin.put(chunk)
+        process_queue.stop_workers(worker_count, qin)
+        qin.close()
+        busy = numpy.zeros(worker_count)
+        start = time.time()
         index = 0
-        while index < len(vals):
+        while index < len(chunks):
             val = process_queue.safe_get(qout.get)    
             if isinstance(val, process_queue.ProcessException):
                 index = 0
@@ -65,12 +102,23 @@ def process_mp(process, vals, worker_count, init_process=None, ignored_errors=No
                         index += 1;
                 raise val
             if val is None: continue
-            index += 1
-            yield val
+            i, res = val[1]
+            if i is None:
+                index += 1
+                busy[res[0]] += res[1]
+                continue
+            yield i, res
+        elapsed = time.time()-start
+        if elapsed > 0:
+            _logger.info("Worker utilization for %d values in %d chunks: %s"%(len(vals), len(chunks), ", ".join(["%.0f%%"%(b*100.0/elapsed) for b in busy])))
     else:
         #_logger.error("worker_count3=%d"%worker_count)
         logging.debug("Running with single process: %d"%len(vals))
+        fetch = Prefetcher(*prefetch_param) if prefetch_param is not None else None
+        if fetch is not None:
+            for i, val in enumerate(vals): fetch.submit(i, val, **extra)
         for i, val in enumerate(vals):
+            if fetch is not None: fetch.acquire(i)
             try:
                 f = process(val, **extra)
             except:
@@ -80,10 +128,309 @@ def process_mp(process, vals, worker_count, init_process=None, ignored_errors=No
                 else:
                     _logger.warn("nexpected error in process - report this problem to the developer")
                 yield i, val
+            if fetch is not None: fetch.release(i)
             yield i, f
+        if fetch is not None: fetch.close()
+
+def start_chunk_workers(process, worker_count, init_process=None, ignored_errors=None, prefetch_param=None, **extra):
+    ''' Start worker processes that process chunks of values until stopped
+    
+    Each item put in the input queue is a pair (key, chunk), where chunk is 
+    a list of (index, value) pairs. For each value, the pair (key, (index, result))
+    is placed in the output queue as soon as the value is processed. Once the 
+    chunk is finished, (key, (None, (process_number, elapsed))) is placed in the 
+    output queue. If `process` raises an exception, then the result is the pair 
+    (process_number, value).
+    
+    The workers run until stopped with :py:func:`process_queue.stop_workers`, so
+    chunks may be added to the queue while results are being received.
+    
+    :Parameters:
+        
+        process : function
+                  Functor called as `process(val, **extra)`
+        worker_count : int
+                       Number of processes
+        init_process : function
+                       Initalize the parameters for the child process
+        ignored_errors : list
+                         Single element list with counter for ignored errors
+        prefetch_param : tuple, optional
+                         Arguments of the :py:class:`Prefetcher` that loads
+                         the values of a chunk ahead of processing
+        extra : dict
+                Keyword arguments for `process`
+    
+    :Returns:
+        
+        qin : Queue
+              Input queue of chunks
+        qout : Queue
+               Output queue of results
+    '''
+    
+    fetch = Prefetcher(*prefetch_param) if prefetch_param is not None else None
+    def process_helper(val, **extra):
+        try:
+            return process(val, **extra)
+        except:
+            if ignored_errors is not None and len(ignored_errors) > 0:ignored_errors[0]+=1
+            _logger.exception("Unexpected error in process - report this problem to the developer")
+            return extra.get('process_number', 0), val
+    def chunk_helper(chunk, **extra):
+        start = time.time()
+        if fetch is not None:
+            for index, val in chunk: fetch.submit(index, val, **extra)
+        for index, val in chunk:
+            if fetch is not None: fetch.acquire(index)
+            res = process_helper(val, **extra)
+            if fetch is not None: fetch.release(index)
+            yield index, res
+        yield None, (extra.get('process_number', 0), time.time()-start)
+    return process_queue.start_workers(chunk_helper, worker_count, init_process, ignore_error=True, **extra)
+
+class Prefetcher(object):
+    ''' Load the inputs of values in a background thread ahead of processing
+    
+    Values are loaded in the order they are submitted. The thread stops loading
+    when `depth` values are held ahead of the one being processed or when the
+    memory held would exceed `max_bytes`. A value that is acquired before its
+    load has started is not loaded at all.
+    
+    .. sourcecode:: py
+    
+        >>> fetch = Prefetcher(ndimage_file.prefetch, ndimage_file.release_prefetch, 2)
+        >>> for i, filename in enumerate(files): fetch.submit(i, filename)
+        >>> for i, filename in enumerate(files):
+        ...     fetch.acquire(i)
+        ...     process(filename)
+        ...     fetch.release(i)
+        >>> fetch.close()
+    
+    The thread is started on the first submission, so an instance created before 
+    worker processes are forked runs a separate thread in each worker.
+    
+    :Parameters:
+        
+        load : function
+               Load the input of a value, called as `load(val, **extra)`,
+               returns the number of bytes held in memory
+        release : function, optional
+                  Release the memory held for a value, called as `release(val, **extra)`
+        depth : int
+                Number of values to load ahead of the one being processed
+        max_bytes : int
+                    Maximum number of bytes held by loaded values, 0 means no limit
+    '''
+    
+    def __init__(self, load, release=None, depth=2, max_bytes=0):
+        ''' Create a prefetcher
+        '''
+        
+        self.load = load
+        self.release_value = release
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.state = {}
+        self.held = 0
+        self.nbytes = 0
+        self.last = 0
+        self.thread = None
+        self.stopped = False
+    
+    def submit(self, key, val, **extra):
+        ''' Add a value to the end of the load queue
+        
+        :Parameters:
+            
+            key : object
+                  Unique key for the value
+            val : object
+                  Value passed to `load`
+            extra : dict
+                    Keyword arguments passed to `load` and `release`
+        '''
+        
+        with self.cond:
+            self.state[key] = ['queued', 0, val, extra]
+            self.queue.append(key)
+            if self.thread is None or not self.thread.is_alive():
+                self.stopped = False
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify_all()
+    
+    def acquire(self, key):
+        ''' Wait for a value being loaded to finish, or remove
+        it from the queue if its load has not started
+        
+        :Parameters:
+            
+            key : object
+                  Key of the value
+        '''
+        
+        with self.cond:
+            state = self.state.get(key)
+            if state is None: return
+            if state[0] == 'queued':
+                self.queue.remove(key)
+                del self.state[key]
+                return
+            while state[0] == 'loading': self.cond.wait()
+    
+    def release(self, key):
+        ''' Release the memory held for a value after it has been processed
+        
+        :Parameters:
+            
+            key : object
+                  Key of the value
+        '''
+        
+        with self.cond:
+            state = self.state.pop(key, None)
+            if state is None or state[0] != 'loaded': return
+            self.held -= 1
+            self.nbytes -= state[1]
+            self.cond.notify_all()
+        if self.release_value is not None: self.release_value(state[2], **state[3])
+    
+    def close(self):
+        ''' Stop the thread and release all loaded values
+        '''
+        
+        with self.cond:
+            self.stopped = True
+            self.queue.clear()
+            self.cond.notify_all()
+        if self.thread is not None: self.thread.join()
+        for key in self.state.keys(): self.release(key)
+    
+    def _full(self):
+        ''' Test if no more values should be loaded
+        
+        :Returns:
+            
+            full : bool
+                   True if the depth or memory limit is reached
+        '''
+        
+        if self.held > self.depth: return True
+        return self.max_bytes > 0 and self.held > 0 and self.nbytes+self.last > self.max_bytes
+    
+    def _run(self):
+        ''' Load values in the order they were submitted
+        '''
+        
+        while True:
+            with self.cond:
+                while not self.stopped and (len(self.queue) == 0 or self._full()): self.cond.wait()
+                if self.stopped: break
+                key = self.queue.popleft()
+                state = self.state[key]
+                state[0] = 'loading'
+                self.held += 1
+            try: nbytes = self.load(state[2], **state[3]) or 0
+            except:
+                _logger.exception("Failed to load value ahead of processing")
+                nbytes = 0
+            with self.cond:
+                state[0] = 'loaded'
+                state[1] = nbytes
+                self.nbytes += nbytes
+                self.last = nbytes
+                self.cond.notify_all()
+
+def schedule_chunks(vals, worker_count, task_cost=None, chunk_size=0, costs=None):
+    ''' Group the values into chunks, ordered from largest to smallest cost
+    
+    If `chunk_size` is 0, the chunk size is chosen by guided self-scheduling: each 
+    chunk holds about 1/(2*worker_count) of the remaining cost. Many cheap values
+    are then sent as a few large chunks, an expensive value is sent on its own
+    and the chunks shrink toward the end so the workers finish together.
+    
+    :Parameters:
+        
+        vals : list
+               List of items to process
+        worker_count : int
+                       Number of processes
+        task_cost : function, optional
+                    Estimate the relative cost of processing a value, if None
+                    use the file size when every value is a filename
+        chunk_size : int
+                     Fixed number of values per chunk, 0 means adaptive
+        costs : array, optional
+                Cost of each value computed by :py:func:`task_costs`, if None
+                estimate the costs with `task_cost`
+    
+    :Returns:
+        
+        chunks : list
+                 List of index arrays, one for each chunk
+    '''
+    
+    if costs is None: costs = task_costs(vals, task_cost)
+    if costs is not None:
+        order = numpy.argsort(-costs, kind='mergesort')
+    else:
+        order = numpy.arange(len(vals))
+        costs = numpy.ones(len(vals))
+    if chunk_size > 0: return [order[i:i+chunk_size] for i in xrange(0, len(order), chunk_size)]
+    costs = costs[order]
+    remaining = costs.sum()
+    chunks = []
+    beg = 0
+    while beg < len(order):
+        target = remaining / (2*worker_count)
+        end = beg + max(1, numpy.searchsorted(numpy.cumsum(costs[beg:]), target, 'right'))
+        chunks.append(order[beg:end])
+        remaining -= costs[beg:end].sum()
+        beg = end
+    return chunks
+
+def task_costs(vals, task_cost=None, stamps=None):
+    ''' Estimate the relative cost of processing each value
+    
+    :Parameters:
+        
+        vals : list
+               List of items to process
+        task_cost : function, optional
+                    Estimate the relative cost of processing a value, if None
+                    use the file size when every value is a filename
+        stamps : dict, optional
+                 Stamps of input files already read from the file system, 
+                 see :py:func:`arachnid.core.app.journal.stamp_input`, so the
+                 size of these files is not read again
+    
+    :Returns:
+        
+        costs : array
+                Positive cost of each value, None if unknown
+    '''
+    
+    if task_cost is None:
+        if len(vals) == 0 or not all([isinstance(val, str) for val in vals]): return None
+        if stamps is None: stamps = {}
+        def task_cost(filename):
+            if filename in stamps: return stamps[filename][1]
+            try: return os.path.getsize(filename)
+            except OSError: return 0
+    costs = numpy.asarray([task_cost(val) for val in vals], dtype=numpy.float)
+    return numpy.maximum(costs, 1.0)
 
-def iterate_map(for_func, worker, thread_count, queue_limit=None, **extra):
+def iterate_map(for_func, worker, thread_count, queue_limit=None, shmem_transport=False, **extra):
     ''' Iterate over the input value and reduce after finished processing
+    
+    If `shmem_transport` is True, then arrays generated by `for_func` are
+    copied into a ring buffer of shared memory slots and only the slot index
+    is sent to the worker. The array yielded to the worker is only valid until
+    the worker requests the next value.
     '''
     
     if thread_count < 2:
@@ -101,15 +448,17 @@ def iterate_map(for_func, worker, thread_count, queue_limit=None, **extra):
         finally: pass
         #_logger.error("queue-done")
     
-    def iterate_map_worker(qin, qout, process_number, process_limit, extra):
+    def iterate_map_worker(qin, qout, process_number, process_limit, extra, ring=None):
         val = None
         try:
-            val = worker(queue_iterator(qin, process_number), process_number=process_number, **extra)
+            values = queue_iterator(qin, process_number) if ring is None else ring.iterate(qin)
+            val = worker(values, process_number=process_number, **extra)
         except:
             _logger.exception("Error in child process")
             while True:
                 val = process_queue.safe_get(qin.get)
                 if val is None: break
+                if ring is not None: ring.qfree.put(val[1])
         finally:
             qout.put(val)
             #process_queue.safe_get(qin.get)
@@ -117,9 +466,17 @@ def iterate_map(for_func, worker, thread_count, queue_limit=None, **extra):
     if queue_limit is None: queue_limit = thread_count*8
     else: queue_limit *= thread_count
     
-    qin, qout = process_queue.start_raw_enum_workers(iterate_map_worker, thread_count, queue_limit, 1, extra)
+    for_func = iter(for_func)
+    ring = None
+    if shmem_transport:
+        first = next(for_func, None)
+        if first is not None:
+            ring = SharedRingBuffer(queue_limit+thread_count, getattr(first, 'nbytes', 0), True)
+            for_func = itertools.chain([first], for_func)
+    qin, qout = process_queue.start_raw_enum_workers(iterate_map_worker, thread_count, queue_limit, 1, extra, ring)
     try:
         for val in enumerate(for_func):
+            if ring is not None: val = ring.put(val[1], val[0])
             qin.put(val)
     except:
         _logger.error("for_func=%s"%str(for_func))
@@ -133,8 +490,13 @@ def iterate_map(for_func, worker, thread_count, queue_limit=None, **extra):
         if val is None: raise ValueError, "Exception in child process"
         yield val
 
-def iterate_reduce(for_func, worker, thread_count, queue_limit=None, shmem_array_info=None, **extra):
+def iterate_reduce(for_func, worker, thread_count, queue_limit=None, shmem_array_info=None, shmem_reduce=False, **extra):
     ''' Iterate over the input value and reduce after finished processing
+    
+    If `shmem_reduce` is True, then once every worker has finished, the
+    workers sum the shared arrays of all workers into the arrays of the
+    first worker, each summing a disjoint set of slabs, and only the summed
+    arrays are yielded.
     '''
     
     if thread_count < 2:
@@ -158,6 +520,8 @@ def iterate_reduce(for_func, worker, thread_count, queue_limit=None, shmem_array
                     typecode="d"
                 elif ar.dtype == numpy.dtype(numpy.float32):
                     typecode="f"
+                elif ar.dtype == numpy.dtype(numpy.int32):
+                    typecode="i"
                 else: raise ValueError, "dtype not supported: %s"%str(ar.dtype)
                 
                 base[key] = multiprocessing.sharedctypes.RawArray(typecode, ar.ravel().shape[0])
@@ -175,7 +539,7 @@ def iterate_reduce(for_func, worker, thread_count, queue_limit=None, shmem_array
                 yield val
         finally: pass
     
-    def iterate_reduce_worker(qin, qout, process_number, process_limit, extra, shmem_map_base=None):#=shmem_map):
+    def iterate_reduce_worker(qin, qout, process_number, process_limit, extra, shmem_map_base=None, qslab=None):#=shmem_map):
         val = None
         try:
             if shmem_map_base is not None:
@@ -196,11 +560,22 @@ def iterate_reduce(for_func, worker, thread_count, queue_limit=None, shmem_array
                 qout.put(process_number)
             else:
                 qout.put(val)
+        if qslab is not None:
+            try:
+                shmem_reduce_slabs(qslab, shmem_map_base)
+            except:
+                _logger.exception("Error in child process")
+                while True:
+                    val = process_queue.safe_get(qslab.get)
+                    if val is None: break
+                qout.put(None)
+            else: qout.put(-1)
     
     if queue_limit is None: queue_limit = thread_count*8
     else: queue_limit *= thread_count
     
-    qin, qout = process_queue.start_raw_enum_workers(iterate_reduce_worker, thread_count, queue_limit, 1, extra, shmem_map_base)
+    qslab = multiprocessing.Queue() if shmem_reduce and shmem_map_base is not None else None
+    qin, qout = process_queue.start_raw_enum_workers(iterate_reduce_worker, thread_count, queue_limit, 1, extra, shmem_map_base, qslab)
     try:
         for val in enumerate(for_func):
             qin.put(val)
@@ -210,6 +585,19 @@ def iterate_reduce(for_func, worker, thread_count, queue_limit=None, shmem_array
     for i in xrange(thread_count): qin.put(None)
     #qin.join()
     
+    if qslab is not None:
+        for i in xrange(thread_count):
+            val = process_queue.safe_get(qout.get)
+        size = [numpy.ctypeslib.as_array(ar).shape[0] for ar in shmem_map_base[0].itervalues()]
+        for key, beg, end in shmem_slabs(shmem_map_base[0].keys(), size, thread_count*4):
+            qslab.put((key, beg, end))
+        for i in xrange(thread_count): qslab.put(None)
+        for i in xrange(thread_count):
+            val = process_queue.safe_get(qout.get)
+            if val is None: raise ValueError, "Exception in child process"
+        yield shmem_map[0]
+        return
+    
     for i in xrange(thread_count):
         val = process_queue.safe_get(qout.get)
         if shmem_map is not None:
@@ -217,8 +605,53 @@ def iterate_reduce(for_func, worker, thread_count, queue_limit=None, shmem_array
         #qin.put(None)
         if val is None: raise ValueError, "Exception in child process"
         yield val
+
+def shmem_slabs(keys, size, slab_count):
+    ''' Split a set of flat arrays into contiguous slabs
+    
+    :Parameters:
+    
+    keys : list
+           Name of each array
+    size : list
+           Number of elements in each array
+    slab_count : int
+                 Number of slabs for each array
+    
+    :Returns:
+    
+    slabs : list
+            List of (key, begin, end) tuples
+    '''
+    
+    slabs = []
+    for key, n in zip(keys, size):
+        step = max(1, (n-1)/slab_count+1)
+        for beg in xrange(0, n, step):
+            slabs.append((key, beg, min(beg+step, n)))
+    return slabs
+
+def shmem_reduce_slabs(qslab, shmem_map_base):
+    ''' Sum the slabs taken from a queue of every shared array into the
+    array of the first worker
+    
+    :Parameters:
+    
+    qslab : multiprocessing.Queue
+            Queue of (key, begin, end) tuples, terminated by None
+    shmem_map_base : list
+                     Shared arrays of each worker
+    '''
+    
+    while True:
+        val = process_queue.safe_get(qslab.get)
+        if val is None: break
+        key, beg, end = val
+        out = numpy.ctypeslib.as_array(shmem_map_base[0][key])[beg:end]
+        for base in shmem_map_base[1:]:
+            out += numpy.ctypeslib.as_array(base[key])[beg:end]
         
-def for_process_mp(for_func, worker, shape, thread_count=0, queue_limit=None, **extra):
+def for_process_mp(for_func, worker, shape, thread_count=0, queue_limit=None, shmem_transport=False, **extra):
     ''' Generator to process collection of arrays in parallel
     
     :Parameters:
@@ -231,6 +664,10 @@ def for_process_mp(for_func, worker, shape, thread_count=0, queue_limit=None, **
                    Number of threads
     shape : int
             Shape of worker result array
+    shmem_transport : bool
+                      Pass arrays to and from the workers through a ring buffer
+                      of shared memory slots rather than the queue. The yielded
+                      array is only valid until the next iteration.
     extra : dict
             Unused keyword arguments
     
@@ -246,6 +683,9 @@ def for_process_mp(for_func, worker, shape, thread_count=0, queue_limit=None, **
         for i, val in enumerate(for_func):
             res = worker(val, i, **extra)
             yield i, res
+    elif shmem_transport:
+        for val in _for_process_shmem(for_func, worker, shape, thread_count, queue_limit, **extra):
+            yield val
     else:
         if queue_limit is None: queue_limit = thread_count*8
         else: queue_limit *= thread_count
@@ -278,6 +718,78 @@ def for_process_mp(for_func, worker, shape, thread_count=0, queue_limit=None, **
                 assert(pos==-1)
     raise StopIteration
 
+def _for_process_shmem(for_func, worker, shape, thread_count, queue_limit=None, **extra):
+    ''' Generator to process collection of arrays in parallel where
+    the arrays are passed through shared memory
+    
+    Each array is copied into a free slot of a shared ring buffer and only
+    the slot index is sent to a worker. The worker writes its result back
+    into the same slot when it fits, otherwise the result is sent through
+    the queue. A slot is returned to the free list when the generator is
+    resumed after yielding its result.
+    
+    :Parameters:
+    
+    for_func : func
+               Generate a list of data
+    work : function
+           Function to preprocess the images
+    shape : int
+            Shape of worker result array
+    thread_count : int
+                   Number of threads
+    extra : dict
+            Unused keyword arguments
+    
+    :Returns:
+    
+    index : int
+            Yields index of output array
+    out : array
+          Yields output array of worker
+    '''
+    
+    if queue_limit is None: queue_limit = thread_count*8
+    else: queue_limit *= thread_count
+    for_func = iter(for_func)
+    first = next(for_func, None)
+    if first is None: return
+    nbytes = max(getattr(first, 'nbytes', 0), int(numpy.prod(shape))*numpy.dtype(numpy.float64).itemsize)
+    ring = SharedRingBuffer(queue_limit+thread_count, nbytes)
+    free = range(ring.count)
+    qin, qout = process_queue.start_raw_enum_workers(process_worker_shmem, thread_count, -1, -1, worker, ring, extra)
+    
+    stopped = [0]
+    def get_result():
+        pos = process_queue.safe_get(qout.get)
+        if pos is None or pos == -1:
+            stopped[0] += 1
+            raise ValueError, "Error occured in process: %s"%str(pos)
+        idx, slot, res = pos
+        return idx, slot, ring.load(slot, res)
+    
+    try:
+        pending = 0
+        for i, val in enumerate(itertools.chain([first], for_func)):
+            if len(free) == 0:
+                idx, slot, res = get_result()
+                pending -= 1
+                yield idx, res
+                free.append(slot)
+            qin.put(ring.put(val, i, free.pop()))
+            pending += 1
+        while pending > 0:
+            idx, slot, res = get_result()
+            pending -= 1
+            yield idx, res
+            free.append(slot)
+    finally:
+        for i in xrange(thread_count): qin.put(None)
+        for i in xrange(thread_count-stopped[0]): 
+            pos = process_queue.safe_get(qout.get)
+            while pos != -1 and pos is not None:
+                pos = process_queue.safe_get(qout.get)
+
 def process_worker2(qin, qout, process_number, process_limit, worker, extra):
     ''' Worker in each process that preprocesses the images
     
@@ -317,3 +829,219 @@ def process_worker2(qin, qout, process_number, process_limit, worker, extra):
     else:
         _logger.debug("Worker %d of %d - finished"%(process_number, process_limit))
 
+def process_worker_shmem(qin, qout, process_number, process_limit, worker, ring, extra):
+    ''' Worker in each process that processes the images in a shared
+    memory ring buffer
+    
+    :Parameters:
+    
+    qin : multiprocessing.Queue
+          Queue with index and slot of the input images in the ring buffer
+    qout : multiprocessing.Queue
+           Queue with index and slot of the output images in the ring buffer
+    process_number : int
+                     Process number
+    process_limit : int
+                    Number of processes
+    worker : function
+             Function to preprocess the images
+    ring : SharedRingBuffer
+           Shared memory ring buffer
+    extra : dict
+            Keyword arguments
+    '''
+    
+    _logger.debug("Worker %d of %d - started"%(process_number, process_limit))
+    try:
+        while True:
+            pos = process_queue.safe_get(qin.get)
+            if pos is None: break
+            idx, img = ring.get(pos)
+            val = worker(img, idx, **extra)
+            qout.put((idx, pos[1])+(ring.store(pos[1], val), ))
+        _logger.debug("Worker %d of %d - ending ..."%(process_number, process_limit))
+        qout.put(-1)
+    except:
+        _logger.exception("Finished with error")
+        qout.put(None)
+    else:
+        _logger.debug("Worker %d of %d - finished"%(process_number, process_limit))
+
+class SlotArray(object):
+    ''' Description of an array stored in a slot of a shared ring buffer,
+    sent in place of the array
+    
+    :Parameters:
+    
+    shape : tuple
+            Shape of the array
+    dtype : str
+            Data type of the array
+    '''
+    
+    def __init__(self, shape, dtype):
+        ''' Create a description
+        '''
+        
+        self.shape = shape
+        self.dtype = dtype
+
+class SharedRingBuffer(object):
+    ''' Fixed number of equally sized slots in shared memory used to
+    pass arrays between processes
+    
+    The buffer is allocated with `multiprocessing.sharedctypes.RawArray` before
+    the workers are started, so only the index of a slot needs to be sent
+    through a queue. An array that does not fit in a slot is sent through the
+    queue instead.
+    
+    :Parameters:
+    
+    count : int
+            Number of slots
+    nbytes : int
+             Size of each slot in bytes
+    free_queue : bool
+                 Track free slots with a queue shared with the workers,
+                 which must be created before the workers are started
+    '''
+    
+    def __init__(self, count, nbytes, free_queue=False):
+        ''' Allocate the shared memory
+        '''
+        
+        self.count = count
+        self.nbytes = ((int(nbytes)+15)//16)*16
+        self.base = multiprocessing.sharedctypes.RawArray('b', self.count*self.nbytes)
+        self.buffer = numpy.ctypeslib.as_array(self.base).view(numpy.uint8).reshape(self.count, self.nbytes)
+        self.qfree = None
+        if free_queue:
+            self.qfree = multiprocessing.Queue()
+            for i in xrange(self.count): self.qfree.put(i)
+    
+    def view(self, slot, shape, dtype):
+        ''' Get an array view of a slot
+        
+        :Parameters:
+        
+        slot : int
+               Index of the slot
+        shape : tuple
+                Shape of the array
+        dtype : str
+                Data type of the array
+        
+        :Returns:
+        
+        out : array
+              View of the shared memory
+        '''
+        
+        dtype = numpy.dtype(dtype)
+        nbytes = int(numpy.prod(shape))*dtype.itemsize
+        return self.buffer[slot, :nbytes].view(dtype).reshape(shape)
+    
+    def store(self, slot, val):
+        ''' Copy an array into a slot if it fits
+        
+        :Parameters:
+        
+        slot : int
+               Index of the slot
+        val : array
+              Array to copy
+        
+        :Returns:
+        
+        desc : SlotArray or object
+               Shape and data type of the array in the slot or the
+               original value if it does not fit
+        '''
+        
+        if not hasattr(val, 'ndim') or val.nbytes > self.nbytes or val.dtype.hasobject: return val
+        desc = SlotArray(val.shape, val.dtype.str)
+        self.view(slot, desc.shape, desc.dtype)[...] = val
+        return desc
+    
+    def load(self, slot, desc):
+        ''' Get the value stored by `store`
+        
+        :Parameters:
+        
+        slot : int
+               Index of the slot
+        desc : SlotArray or object
+               Value returned by `store`
+        
+        :Returns:
+        
+        val : array or object
+              View of the slot or the original value
+        '''
+        
+        if isinstance(desc, SlotArray): return self.view(slot, desc.shape, desc.dtype)
+        return desc
+    
+    def put(self, val, index, slot=None):
+        ''' Store an array and create the message sent to the worker
+        
+        :Parameters:
+        
+        val : array
+              Array to send
+        index : int
+                Index of the value
+        slot : int, optional
+               Free slot, if None, wait for a slot freed by a worker
+        
+        :Returns:
+        
+        msg : tuple
+              Message of (index, slot, description)
+        '''
+        
+        if slot is None: slot = process_queue.safe_get(self.qfree.get)
+        return (index, slot, self.store(slot, val))
+    
+    def get(self, msg):
+        ''' Get the array described by a message
+        
+        :Parameters:
+        
+        msg : tuple
+              Message of (index, slot, description)
+        
+        :Returns:
+        
+        index : int
+                Index of the value
+        val : array
+              Array in shared memory or original value
+        '''
+        
+        index, slot, desc = msg
+        return index, self.load(slot, desc)
+    
+    def iterate(self, qin):
+        ''' Iterate over the messages in the queue, freeing the slot of
+        each array when the next value is requested
+        
+        :Parameters:
+        
+        qin : multiprocessing.Queue
+              Queue of messages, terminated by None
+        
+        :Returns:
+        
+        index : int
+                Index of the value
+        val : array
+              Array in shared memory or original value
+        '''
+        
+        while True:
+            msg = process_queue.safe_get(qin.get)
+            if msg is None: break
+            yield self.get(msg)
+            self.qfree.put(msg[1])
+
@@ -0,0 +1,13 @@
+''' Unit testing for each module in :mod:`arachnid.core.parallel`
+
+.. currentmodule:: arachnid.core.parallel.tests
+
+.. autosummary::
+    :nosignatures:
+    :toctree: api_generated/
+    :template: api_module.rst
+    
+    test_mpi_utility
+    test_process_tasks
+
+'''
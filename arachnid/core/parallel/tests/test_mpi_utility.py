@@ -0,0 +1,109 @@
+''' Unit tests for the mpi_utility module
+
+The reductions are tested with a communicator that stands in for the other
+nodes by adding one to each value, so they run without MPI.
+'''
+from .. import mpi_utility
+import numpy.testing
+
+class _MPI(object):
+    '''
+    '''
+    
+    IN_PLACE = 'in_place'
+    SUM = 'sum'
+    __TypeDict__ = dict([(c, c) for c in 'bhilqfdFD'])
+
+class _Request(object):
+    '''
+    '''
+    
+    def __init__(self, comm):
+        self.comm = comm
+        comm.in_flight += 1
+        comm.max_in_flight = max(comm.max_in_flight, comm.in_flight)
+    
+    def Wait(self):
+        self.comm.in_flight -= 1
+
+class _Comm(object):
+    '''
+    '''
+    
+    def __init__(self, rank=0, nonblocking=True):
+        self.rank = rank
+        self.nonblocking = nonblocking
+        self.calls = []
+        self.buffers = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+    
+    def Get_rank(self):
+        return self.rank
+    
+    def Reduce(self, sendbuf, recvbuf, op, root):
+        self.calls.append('Reduce')
+        self.buffers.append(recvbuf[0] if sendbuf == _MPI.IN_PLACE else sendbuf[0])
+        if sendbuf == _MPI.IN_PLACE: recvbuf[0] += 1
+    
+    def Ireduce(self, sendbuf, recvbuf, op, root):
+        if not self.nonblocking: raise NotImplementedError
+        self.calls.append('Ireduce')
+        self.buffers.append(recvbuf[0] if sendbuf == _MPI.IN_PLACE else sendbuf[0])
+        if sendbuf == _MPI.IN_PLACE: recvbuf[0] += 1
+        return _Request(self)
+
+def _pipeline_reduce(data, comm, **extra):
+    '''
+    '''
+    
+    MPI = mpi_utility.MPI
+    mpi_utility.MPI = _MPI
+    try: return mpi_utility.pipeline_reduce(data, comm=comm, **extra)
+    finally: mpi_utility.MPI = MPI
+
+def test_pipeline_reduce():
+    '''
+    '''
+    
+    comm = _Comm()
+    data = _pipeline_reduce(numpy.arange(10, dtype=numpy.float32), comm, batch_size=3, pipeline_depth=2)
+    numpy.testing.assert_allclose(data, numpy.arange(10)+1)
+    assert(comm.calls == ['Ireduce']*4)
+    assert(comm.in_flight == 0 and comm.max_in_flight == 2)
+
+def test_pipeline_reduce_client():
+    '''
+    '''
+    
+    comm = _Comm(rank=1)
+    data = _pipeline_reduce(numpy.arange(10, dtype=numpy.float32), comm, batch_size=3)
+    numpy.testing.assert_allclose(data, numpy.arange(10))
+    assert(comm.calls == ['Ireduce']*4 and comm.in_flight == 0)
+
+def test_pipeline_reduce_blocking():
+    '''
+    '''
+    
+    comm = _Comm(nonblocking=False)
+    data = _pipeline_reduce(numpy.arange(10, dtype=numpy.float32), comm, batch_size=3)
+    numpy.testing.assert_allclose(data, numpy.arange(10)+1)
+    assert(comm.calls == ['Reduce']*4)
+
+def test_pipeline_reduce_in_place():
+    '''
+    '''
+    
+    for order in ('C', 'F'):
+        comm = _Comm()
+        data = numpy.arange(24, dtype=numpy.complex64).reshape((2,3,4), order=order)
+        expected = data+1
+        out = _pipeline_reduce(data, comm, batch_size=5)
+        assert(out is data)
+        numpy.testing.assert_allclose(data, expected)
+        assert(len(comm.buffers) == 5)
+        assert(all([numpy.may_share_memory(b, data) for b in comm.buffers]))
+    
+    try: _pipeline_reduce(numpy.zeros((4,4))[:, :2], _Comm())
+    except ValueError: pass
+    else: assert(False)
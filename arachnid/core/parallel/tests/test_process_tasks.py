@@ -0,0 +1,117 @@
+''' Unit tests for the process_tasks module
+'''
+from .. import process_tasks, process_queue
+import numpy.testing
+import time
+
+def _tuple_worker(val, idx):
+    '''
+    '''
+    
+    if idx % 2 == 0: return (idx, 'even')
+    return val*2
+
+def _tuple_sum(vals, process_number):
+    '''
+    '''
+    
+    total = 0
+    for idx, val in vals:
+        assert(isinstance(val, tuple))
+        total += val[0]
+    return total
+
+def _slow_worker(val, **extra):
+    '''
+    '''
+    
+    if val == 4: time.sleep(1.0)
+    return val*2
+
+def _sum_shmem(vals, process_number, total, count):
+    '''
+    '''
+    
+    for idx, val in vals:
+        total += val
+        count[idx % count.shape[0]] += 1
+    return None
+
+def test_iterate_reduce_shmem():
+    '''
+    '''
+    
+    vals = [numpy.arange(1000, dtype=numpy.float32)*i for i in xrange(10)]
+    info = dict(total=numpy.zeros(1000, dtype=numpy.float32), count=numpy.zeros((4, 3), dtype=numpy.complex128))
+    res = list(process_tasks.iterate_reduce(iter(vals), _sum_shmem, 3, shmem_array_info=info))
+    assert(len(res) == 3)
+    numpy.testing.assert_allclose(sum([r['total'] for r in res]), numpy.sum(vals, axis=0))
+    res = list(process_tasks.iterate_reduce(iter(vals), _sum_shmem, 3, shmem_array_info=info, shmem_reduce=True))
+    assert(len(res) == 1)
+    numpy.testing.assert_allclose(res[0]['total'], numpy.sum(vals, axis=0))
+    numpy.testing.assert_allclose(res[0]['count'], [[3]*3, [3]*3, [2]*3, [2]*3])
+
+def test_process_mp_stream():
+    '''
+    '''
+    
+    start = time.time()
+    res = {}
+    first = None
+    for index, val in process_tasks.process_mp(_slow_worker, range(10), 2, chunk_size=5):
+        if first is None: first = time.time()-start
+        res[index] = val
+    assert(first < 0.5)
+    assert(res == dict([(i, i*2) for i in xrange(10)]))
+
+def test_start_chunk_workers():
+    '''
+    '''
+    
+    qin, qout = process_tasks.start_chunk_workers(_slow_worker, 2)
+    try:
+        res = {}
+        for key, beg in enumerate((0, 10)):
+            qin.put((key, [(i, i) for i in xrange(beg, beg+3)]))
+            while True:
+                val = process_queue.safe_get(qout.get)
+                assert(val[0] == key)
+                i, out = val[1]
+                if i is None: break
+                res[i] = out
+        assert(res == dict([(i, i*2) for i in (0, 1, 2, 10, 11, 12)]))
+    finally:
+        process_queue.stop_workers(2, qin)
+
+def test_for_process_mp_shmem_tuple():
+    '''
+    '''
+    
+    imgs = [numpy.ones((4,5))*i for i in xrange(10)]
+    res = dict(process_tasks.for_process_mp(iter(imgs), _tuple_worker, (4,5), 3, shmem_transport=True))
+    assert(len(res) == 10)
+    for i in xrange(10):
+        if i % 2 == 0: assert(res[i] == (i, 'even'))
+        else: numpy.testing.assert_allclose(imgs[i]*2, res[i])
+
+def test_iterate_map_shmem_tuple():
+    '''
+    '''
+    
+    vals = [(i, numpy.zeros(3)) for i in xrange(10)]
+    total = sum(process_tasks.iterate_map(iter(vals), _tuple_sum, 3, shmem_transport=True))
+    assert(total == sum(xrange(10)))
+
+def test_task_costs():
+    '''
+    '''
+    
+    files = ['/missing/mic_%04d.spi'%i for i in xrange(4)]
+    stamps = dict([(f, (f, (i+1)*10, 0.0)) for i, f in enumerate(files[:3])])
+    costs = process_tasks.task_costs(files, stamps=stamps)
+    numpy.testing.assert_allclose(costs, [10, 20, 30, 1])
+    assert(process_tasks.task_costs([(1, files)]) is None)
+    chunks = process_tasks.schedule_chunks(files, 2, chunk_size=1, costs=costs)
+    assert([c.tolist() for c in chunks] == [[2], [1], [0], [3]])
+    chunks = process_tasks.schedule_chunks(files, 2, lambda f: 1, chunk_size=1, costs=costs)
+    assert([c.tolist() for c in chunks] == [[2], [1], [0], [3]])
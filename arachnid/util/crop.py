@@ -157,7 +157,7 @@ This is not a complete list of options available to this script, for additional
 .. Created on Nov 27, 2010
 .. codeauthor:: Robert Langlois <rl2528@columbia.edu>
 '''
-from ..core.app import program
+from ..core.app import program, file_processor
 from ..core.image import ndimage_utility
 from ..core.image import ndimage_file
 from ..core.image import ndimage_filter
@@ -176,6 +176,8 @@ import psutil
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 
+prefetch, release_prefetch = file_processor.prefetch_images, file_processor.release_images
+
 def process(filename, id_len=0, frame_beg=0, frame_end=0, single_stack=False, **extra):
     '''Crop a set of particles from a micrograph file with the specified
     coordinate file and write particles to an image stack.
@@ -216,6 +218,7 @@ def process(filename, id_len=0, frame_beg=0, frame_end=0, single_stack=False, **
             _logger.exception("Failed to read coordinates file")
         return filename, 0, os.getpid()
     global_selection=extra['global_selection']
+    selection_begin = len(global_selection)
 
     if tot is None:
         try:
@@ -268,31 +271,31 @@ def process(filename, id_len=0, frame_beg=0, frame_end=0, single_stack=False, **
                     mic[:] = ndimage_utility.fourier_shift(mic, -align[i].dx/bin_factor, -align[i].dy/bin_factor)
                 #scp /catalina.F30/frames/13nov23c/rawdata/13*en.frames.mrc.bz2
             _logger.info("Extract %d windows from movie %d frame %d - %d of %d"%(len(coords), fid, frame, i, frame_end))
-            for index, win in enumerate(ndimage_utility.for_each_window(mic, coords, window, bin_factor)):
-                win = enhance_window(win, noise, **extra)
-                if win.min() == win.max():
-                    coord = coords[index]
-                    x, y = (coord.x, coord.y) if hasattr(coord, 'x') else (coord[1], coord[2])
-                    _logger.warn("Window %d at coordinates %d,%d has an issue - clamp_window may need to be increased"%(index+1, x, y))
-                if single_stack:
-                    try:
-                        ndimage_file.write_image(output, win, len(global_selection), header=dict(apix=extra['apix']))
-                    except Exception, exp:
-                        _logger.error("Error writing to image - %s"%str(exp))
-                        raise
-                    global_selection.append((len(global_selection)+1, fid, index+1, ))
-                else:
+            start = len(global_selection) if single_stack else 0
+            with ndimage_file.stack_writer(output, header=dict(apix=extra['apix']), index=start, count=len(coords)) as writer:
+                for index, win in enumerate(ndimage_utility.for_each_window(mic, coords, window, bin_factor)):
+                    win = enhance_window(win, noise, **extra)
+                    if win.min() == win.max():
+                        coord = coords[index]
+                        x, y = (coord.x, coord.y) if hasattr(coord, 'x') else (coord[1], coord[2])
+                        _logger.warn("Window %d at coordinates %d,%d has an issue - clamp_window may need to be increased"%(index+1, x, y))
                     try:
-                        ndimage_file.write_image(output, win, index, header=dict(apix=extra['apix']))
+                        writer.write(win)
                     except Exception, exp:
                         _logger.error("Error writing to image - %s"%str(exp))
                         raise
+                    if single_stack:
+                        global_selection.append((len(global_selection)+1, fid, index+1, ))
             #_logger.info("Extract %d windows from movie %d frame %d - %d of %d - finished"%(len(coords), fid, frame, i, tot))
     except ndimage_file.InvalidHeaderException:
         _logger.warn("Skipping: %s - invalid header"%filename)
         return filename, 0, os.getpid()
-    if len(global_selection) > 0:
-        format.write(output, numpy.asarray(global_selection), prefix="sel_", header="id,micrograph,stack_id".split(','))
+    if len(global_selection) > selection_begin:
+        selection_writer = extra['selection_writer']
+        if output not in selection_writer:
+            selection_writer[output] = format.DocumentWriter(output, prefix="sel_", header="id,micrograph,stack_id".split(','))
+        selection_writer[output].write(numpy.asarray(global_selection[selection_begin:]))
+        selection_writer[output].flush()
     return filename, len(coords), os.getpid()
 
 def iter_micrographs(filename, index=None, bin_factor=1.0, sigma=1.0, disable_bin=False, invert=False, window=None, gain=None, **extra):
@@ -586,6 +589,7 @@ def initialize(files, param):
     if len(files) == 0 and len(param['finished']) == 0: return []
     filename = files[0] if len(files) > 0 else param['finished'][0]
     param['global_selection']=[]
+    param['selection_writer']={}
     
     if len(param['finished']) > 0 and param['single_stack']:
         raise ValueError, "Cannot restart with --single-stack -- please use --force or force: True or delete the output files"
@@ -725,8 +729,9 @@ def reduce_all(val, count, id_len, **extra):
     if isinstance(filename, tuple): filename=filename[0]
     return filename, str(filename)+" - %d windows - %d windows in total in %d files - %1f gigs"%(total, count[0], count[1], psutil.Process(pid).get_memory_info().rss/131072.0)
 
-def finalize(files, count=[0], **extra):
+def finalize(files, count=[0], selection_writer={}, **extra):
     # Finalize global parameters for the script
+    for writer in selection_writer.itervalues(): writer.close()
     _logger.info("Extracted %d windows"%count[0])
     _logger.info("Completed")
     
@@ -232,7 +232,7 @@ def batch(files, relion2spider=False, frame_stack_file="", renormalize=0, **extr
         vals = []
         for f in files:
             try:
-                vals.append(format.read(f, numeric=True))
+                vals.append(format.read(f, numeric=True, cache=True))
             except:
                 raise ValueError, "Input not an image or a selection file"
         if len(vals) > 1:
@@ -367,7 +367,7 @@ def generate_relion_selection_file(files, img, output, param_file, selection_fil
     defocus_dict = read_defocus(**extra)
     if selection_file != "": 
         if os.path.exists(selection_file):
-            select = format.read(selection_file, numeric=True)
+            select = format.read(selection_file, numeric=True, cache=True)
             files = selection_utility.select_file_subset(files, select)
             old = defocus_dict
             defocus_dict = {}
@@ -416,7 +416,7 @@ def generate_relion_selection_file(files, img, output, param_file, selection_fil
                 mic = spider_utility.spider_id(filename)
                 if good_file != "":
                     if not os.path.exists(spider_utility.spider_filename(good_file, mic)): continue
-                    select_vals = format.read(good_file, spiderid=mic, numeric=True)
+                    select_vals = format.read(good_file, spiderid=mic, numeric=True, cache=True)
                     if len(select_vals) > 0 and not hasattr(select_vals[0], 'id'):
                         raise ValueError, "Error with selection file (`--good-file`) missing `id` in header, return with `--good-file filename=id` or `--good-file filename=id,select` indicating which column has the id and select"
                     if len(select_vals) > 0 and 'select' in select_vals[0]._fields:
@@ -788,7 +788,7 @@ def select_good(vals, class_file, good_file, min_defocus, max_defocus, apix=0, p
                 mic,pid1 = relion_utility.relion_id(v.rlnImageName)
                 if mic != last:
                     try:
-                        select_vals = set([s.id for s in format.read(good_file, spiderid=mic, numeric=True)])
+                        select_vals = set([s.id for s in format.read(good_file, spiderid=mic, numeric=True, cache=True)])
                     except:
                         if _logger.isEnabledFor(logging.DEBUG):
                             _logger.exception("Error reading selection file")
@@ -797,7 +797,7 @@ def select_good(vals, class_file, good_file, min_defocus, max_defocus, apix=0, p
                 if pid1 in select_vals:
                     subset.append(v)
         else:
-            select_vals = set([s.id for s in format.read(good_file, numeric=True)])
+            select_vals = set([s.id for s in format.read(good_file, numeric=True, cache=True)])
             for v in vals:
                 _,pid1 = relion_utility.relion_id(v.rlnImageName)
                 if pid1 in select_vals:
@@ -905,6 +905,11 @@ def create_movie(vals, frame_stack_file, output, frame_limit=0, reindex_file="",
     '''
     
     _logger.info("Creating movie mode relion selection file: %d"%frame_limit)
+    header = list(vals[0]._fields)
+    header.append('rlnParticleName')
+    if single_stack:
+        header.append('araOriginalrlnImageName')
+    frame_writer = format.DocumentWriter(output, header=header)
     frame_vals = []
     idlen=None
     consecutive=None if reindex_file == "" else True
@@ -913,6 +918,7 @@ def create_movie(vals, frame_stack_file, output, frame_limit=0, reindex_file="",
     stack_filename = format_utility.add_prefix(output, 'image_stack_')
     stack_index = 0
     last_percent = -1
+    writer = ndimage_file.stack_writer(stack_filename) if single_stack else None
     for offset, v in enumerate(vals):
         percent = int(float(offset)/len(vals)*100)
         if (percent%10) == 0 and percent != last_percent:
@@ -920,6 +926,8 @@ def create_movie(vals, frame_stack_file, output, frame_limit=0, reindex_file="",
             last_percent=percent
         mic,pid1 = relion_utility.relion_id(v.rlnImageName)
         if mic != last:
+            frame_writer.write(frame_vals)
+            frame_vals = []
             frames = glob.glob(spider_utility.spider_filename(frame_stack_file, mic))
             if consecutive is None:
                 avg_count = ndimage_file.count_images(relion_utility.relion_file(v.rlnImageName, True))
@@ -945,7 +953,7 @@ def create_movie(vals, frame_stack_file, output, frame_limit=0, reindex_file="",
         for f in frames:
             if single_stack:
                 orig_image_file = "%s@%s"%(str(pid).zfill(idlen), f)
-                ndimage_file.write_image(stack_filename, ndimage_file.read_image(f, pid-1), stack_index)
+                writer.write(ndimage_file.read_image(f, pid-1))
                 image_file = "%s@%s"%(str(stack_index+1).zfill(idlen), stack_filename)
                 stack_index += 1
                 additional = (v.rlnImageName, orig_image_file)
@@ -953,11 +961,9 @@ def create_movie(vals, frame_stack_file, output, frame_limit=0, reindex_file="",
                 image_file = "%s@%s"%(str(pid).zfill(idlen), f)
                 additional = (v.rlnImageName, )
             frame_vals.append(v._replace(rlnImageName=image_file)+additional)
-    header = list(vals[0]._fields)
-    header.append('rlnParticleName')
-    if single_stack:
-        header.append('araOriginalrlnImageName')
-    format.write(output, frame_vals, header=header)
+    frame_writer.write(frame_vals)
+    if writer is not None: writer.close()
+    frame_writer.close()
     
 def create_movie_old(vals, frame_stack_file, output, frame_limit=0, **extra):
     ''' Convert a standard relion selection file to a movie mode selection file and
@@ -1243,20 +1249,25 @@ def renormalize_images(vals, pixel_radius, apix, output, invert=False, dry_run=F
     new_vals = []
     idmap={}
     numpy.seterr(all='raise')
+    writer = None
     for v in vals:
         filename, index = relion_utility.relion_file(v.rlnImageName)
         if spider_utility.is_spider_filename(filename):
             output = spider_utility.spider_filename(output, filename)
         if filename not in idmap: idmap[filename]=0
         if not dry_run:
+            if writer is None or writer.filename != output or writer.index != idmap[filename]:
+                if writer is not None: writer.close()
+                writer = ndimage_file.stack_writer(output, header=dict(apix=apix), index=idmap[filename])
             img = ndimage_file.read_image(filename, index-1)
             if img.shape[0] != mask.shape[0]:
                 _logger.error("Image does not match mask (%d != %d) - %s"%(img.shape[0], mask.shape[0], filename))
             if invert: ndimage_utility.invert(img, img)
             ndimage_utility.normalize_standard(img, mask, True, img)
-            ndimage_file.write_image(output, img, idmap[filename], header=dict(apix=apix))
+            writer.write(img)
         idmap[filename] += 1
         new_vals.append(v._replace(rlnImageName=relion_utility.relion_identifier(output, idmap[filename])))
+    if writer is not None: writer.close()
     return new_vals
 
 def downsample_images(vals, downsample=1.0, param_file="", phase_flip=False, apix=1.0, pixel_radius=0, mask_diameter=0, pad=1, **extra):
@@ -1320,6 +1331,7 @@ def downsample_images(vals, downsample=1.0, param_file="", phase_flip=False, api
     if downsample > 1.0: _logger.info("Downsampling images")
     if phase_flip: _logger.info("Phase flipping images")
     _logger.info("Stack preprocessing started")
+    writer = None
     for i in xrange(len(vals)):
         v = vals[i]
         if (i%1000) == 0:
@@ -1338,8 +1350,12 @@ def downsample_images(vals, downsample=1.0, param_file="", phase_flip=False, api
         oindex[filename] += 1
         if spider_utility.is_spider_filename(output) and spider_utility.is_spider_filename(filename):
             output = spider_utility.spider_filename(output, filename)
-        ndimage_file.write_image(output, img, oindex[filename]-1, header=dict(apix=apix))
+        if writer is None or writer.filename != output or writer.index != oindex[filename]-1:
+            if writer is not None: writer.close()
+            writer = ndimage_file.stack_writer(output, header=dict(apix=apix), index=oindex[filename]-1)
+        writer.write(img)
         vals[i] = vals[i]._replace(rlnImageName=relion_utility.relion_identifier(output, oindex[filename]))
+    if writer is not None: writer.close()
     _logger.info("Stack preprocessing finished")
     _logger.info("Reminder - Using %f angstroms as the diameter of the mask in relion"%(pixel_radius*2*apix))
     return vals